@@ -105,3 +105,22 @@ class Constants(object):
     DATA_WINDOW_CENTER = "from_center"
     DATA_WINDOW_RANDOM = "random"
 
+    # TFRecord layouts. Legacy records store the poses as a FloatList, raw records as little-endian float32 bytes.
+    DATA_RECORD_LEGACY = "legacy"
+    DATA_RECORD_RAW = "raw"
+
+    # Storage precision of the poses in raw records and memory-mapped stores. See spl.data.pose_encoding.
+    DATA_POSES_FLOAT32 = "float32"
+    DATA_POSES_FLOAT16 = "float16"
+    DATA_POSES_INT16 = "int16"
+
+    # Storage backends of the motion data. See spl.data.mmap_dataset for the memory-mapped one.
+    DATA_BACKEND_TFRECORD = "tfrecord"
+    DATA_BACKEND_MMAP = "mmap"
+
+    # Sequence length boundaries (in frames) to batch full-length sequences of similar length together.
+    DATA_LENGTH_BUCKET_BOUNDARIES = [120, 180, 240, 360, 480, 720, 960, 1440, 1920, 2880]
+
+    # Attention capture policies. See spl.util.attention_store.
+    ATTN_CAPTURE_OFF = "off"
+    ATTN_CAPTURE_LAST_LAYER = "last_layer"
@@ -16,7 +16,6 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import numpy as np
 import quaternion
-import cv2
 import tensorflow as tf
 import sys
 
@@ -120,7 +119,7 @@ def rotmat2euler(rotmats):
     return eul
 
 
-def rotmat2euler_tf(rotmats, msg):
+def rotmat2euler_tf(rotmats, msg=None):
     """
     Converts rotation matrices to euler angles by using TF routines. This is an
     adaptation of Martinez et al.'s code to work with batched inputs.
@@ -152,7 +151,7 @@ def rotmat2euler_tf(rotmats, msg):
     # atan = tf.debugging.check_numerics(atan, "First atan nan")
     e1 = tf.where(is_special, tf.cast(atan, tf.float32), e1)
     e2 = tf.where(is_minus_one, tf.ones([n_samples])*np.pi/2, e2)
-    e2 = tf.where(is_minus_one, tf.ones([n_samples])*-np.pi/2, e2)
+    e2 = tf.where(is_one, tf.ones([n_samples])*-np.pi/2, e2)
     
     # normal cases
     is_normal = tf.logical_not(is_special)
@@ -177,6 +176,112 @@ def rotmat2euler_tf(rotmats, msg):
     return eul
 
 
+def rotmat2aa_tf(rotmats):
+    """
+    Converts rotation matrices to angle-axis by using TF routines. Same as `rotmat2aa`.
+    Args:
+        rotmats: A TF tensor of shape (..., 3, 3)
+
+    Returns:
+        A TF tensor of shape (..., 3)
+    """
+    _, u, v = tf.linalg.svd(rotmats)
+    rots = tf.matmul(u, v, transpose_b=True)
+
+    # The skew-symmetric part is sin(theta)*axis.
+    r = tf.stack([rots[..., 2, 1] - rots[..., 1, 2],
+                  rots[..., 0, 2] - rots[..., 2, 0],
+                  rots[..., 1, 0] - rots[..., 0, 1]], axis=-1)
+    s = tf.norm(r, axis=-1) * 0.5
+    c = tf.clip_by_value((tf.linalg.trace(rots) - 1.0) * 0.5, -1.0, 1.0)
+    theta = tf.atan2(s, c)
+
+    # theta/(2*sin(theta)) tends to 1/2 for small angles.
+    tiny = np.finfo(rotmats.dtype.as_numpy_dtype).eps
+    small = s < tiny
+    scale = tf.where(small, 0.5*tf.ones_like(s), theta / (2.0 * tf.where(small, tf.ones_like(s), s)))
+    aas = r * scale[..., tf.newaxis]
+
+    # Close to pi, the axis is the column of (R + R')/2 - cos(theta)*I with the largest diagonal entry.
+    sym = (rots + tf.linalg.matrix_transpose(rots)) * 0.5 - c[..., tf.newaxis, tf.newaxis] * tf.eye(3, dtype=rots.dtype)
+    col = tf.one_hot(tf.argmax(tf.linalg.diag_part(sym), axis=-1), 3, dtype=rots.dtype)
+    axis = tf.reduce_sum(sym * col[..., tf.newaxis, :], axis=-1)
+    axis_norm = tf.norm(axis, axis=-1, keepdims=True)
+    axis = axis / tf.where(axis_norm > 0, axis_norm, tf.ones_like(axis_norm))
+    sign = tf.sign(tf.reduce_sum(axis * r, axis=-1))
+    sign = tf.where(small, tf.where(axis[..., 0] < 0, -tf.ones_like(s), tf.ones_like(s)), sign)
+    aas_pi = axis * (sign * theta)[..., tf.newaxis]
+    near_pi = tf.cast(c < -0.5, rots.dtype)[..., tf.newaxis]
+    return near_pi*aas_pi + (1.0 - near_pi)*aas
+
+
+def rotmat2quat_tf(rotmats):
+    """
+    Converts rotation matrices to unit quaternions in (w, x, y, z) order with w >= 0 by using TF routines. Same as
+    `rotmat2quat`.
+    Args:
+        rotmats: A TF tensor of shape (..., 3, 3)
+
+    Returns:
+        A TF tensor of shape (..., 4)
+    """
+    r00, r01, r02 = rotmats[..., 0, 0], rotmats[..., 0, 1], rotmats[..., 0, 2]
+    r10, r11, r12 = rotmats[..., 1, 0], rotmats[..., 1, 1], rotmats[..., 1, 2]
+    r20, r21, r22 = rotmats[..., 2, 0], rotmats[..., 2, 1], rotmats[..., 2, 2]
+
+    candidates = tf.stack([tf.stack([1.0 + r00 + r11 + r22, r21 - r12, r02 - r20, r10 - r01], axis=-1),
+                           tf.stack([r21 - r12, 1.0 + r00 - r11 - r22, r01 + r10, r02 + r20], axis=-1),
+                           tf.stack([r02 - r20, r01 + r10, 1.0 - r00 + r11 - r22, r12 + r21], axis=-1),
+                           tf.stack([r10 - r01, r02 + r20, r12 + r21, 1.0 - r00 - r11 + r22], axis=-1)], axis=-2)
+    best = tf.one_hot(tf.argmax(tf.linalg.diag_part(candidates), axis=-1), 4, dtype=rotmats.dtype)
+    quats = tf.reduce_sum(candidates * best[..., tf.newaxis], axis=-2)
+    quats = quats / tf.norm(quats, axis=-1, keepdims=True)
+    return quats * tf.where(quats[..., :1] < 0, -tf.ones_like(quats[..., :1]), tf.ones_like(quats[..., :1]))
+
+
+def correct_antipodal_quaternions_tf(quats):
+    """
+    Removes discontinuities coming from the antipodal representation of quaternions by using TF routines. Same as
+    `correct_antipodal_quaternions` in preprocess_radar.py: at time step t, q or -q is chosen depending on which one
+    is closer to time step t-1. Since this only depends on the sign of the dot product of consecutive quaternions, the
+    signs are the cumulative product of these signs.
+    Args:
+        quats: A TF tensor of shape (seq_length, n_joints, 4)
+
+    Returns:
+        A TF tensor of shape (seq_length, n_joints, 4)
+    """
+    flips = tf.where(tf.reduce_sum(quats[1:] * quats[:-1], axis=-1) < 0,
+                     -tf.ones_like(quats[1:, :, 0]), tf.ones_like(quats[1:, :, 0]))
+    signs = tf.concat([tf.ones_like(quats[:1, :, 0]), tf.cumprod(flips, axis=0)], axis=0)
+    return quats * signs[..., tf.newaxis]
+
+
+def rotmat2rep_tf(poses, rep):
+    """
+    Converts a pose sequence of rotation matrices into the given representation by using TF routines.
+    Args:
+        poses: A TF tensor of shape (seq_length, n_joints*9)
+        rep: "rotmat", "aa", "quat" or "euler". Quaternions are corrected for antipodal discontinuities along time.
+
+    Returns:
+        A TF tensor of shape (seq_length, n_joints*dof)
+    """
+    seq_len = tf.shape(poses)[0]
+    rotmats = tf.reshape(poses, [seq_len, -1, 3, 3])
+    if rep == "rotmat":
+        return poses
+    elif rep == "aa":
+        converted = rotmat2aa_tf(rotmats)
+    elif rep == "quat":
+        converted = correct_antipodal_quaternions_tf(rotmat2quat_tf(rotmats))
+    elif rep == "euler":
+        converted = rotmat2euler_tf(tf.reshape(rotmats, [-1, 3, 3]))
+    else:
+        raise Exception("Unknown representation.")
+    return tf.reshape(converted, [seq_len, -1])
+
+
 def quat2euler(quats, epsilon=0):
     """
     PSA: This function assumes Tait-Bryan angles, i.e. consecutive rotations rotate around the rotated coordinate
@@ -209,26 +314,50 @@ def quat2euler(quats, epsilon=0):
     return np.reshape(eul, orig_shape)
 
 
+def _as_float_array(x):
+    """Returns `x` as a np array. Float32 and float64 inputs keep their precision, everything else is cast to float64."""
+    x = np.asarray(x)
+    if x.dtype not in (np.float32, np.float64):
+        x = x.astype(np.float64)
+    return x
+
+
+def _skew(v):
+    """Returns the skew-symmetric cross-product matrices of shape (..., 3, 3) for vectors of shape (..., 3)."""
+    zeros = np.zeros_like(v[..., 0])
+    return np.stack([np.stack([zeros, -v[..., 2], v[..., 1]], axis=-1),
+                     np.stack([v[..., 2], zeros, -v[..., 0]], axis=-1),
+                     np.stack([-v[..., 1], v[..., 0], zeros], axis=-1)], axis=-2)
+
+
 def aa2rotmat(angle_axes):
     """
-    Convert angle-axis to rotation matrices using opencv's Rodrigues formula.
+    Convert angle-axis to rotation matrices using Rodrigues' formula. Equivalent to opencv's Rodrigues but vectorized.
     Args:
         angle_axes: A np array of shape (..., 3)
 
     Returns:
         A np array of shape (..., 3, 3)
     """
-    orig_shape = angle_axes.shape[:-1]
-    aas = np.reshape(angle_axes, [-1, 3])
-    rots = np.zeros([aas.shape[0], 3, 3])
-    for i in range(aas.shape[0]):
-        rots[i] = cv2.Rodrigues(aas[i])[0]
-    return np.reshape(rots, orig_shape + (3, 3))
+    aas = _as_float_array(angle_axes)
+    theta = np.linalg.norm(aas, axis=-1)[..., np.newaxis, np.newaxis]
+
+    # R = I + sin(theta)/theta*K + (1 - cos(theta))/theta^2*K^2 where K is the cross-product matrix of the angle-axis.
+    # Second-order Taylor expansions are used for small angles.
+    small = theta < np.finfo(aas.dtype).eps ** 0.25
+    theta_safe = np.where(small, np.ones_like(theta), theta)
+    a = np.where(small, 1.0 - theta**2 / 6.0, np.sin(theta_safe) / theta_safe)
+    b = np.where(small, 0.5 - theta**2 / 24.0, 2.0 * (np.sin(theta_safe / 2.0) / theta_safe) ** 2)
+
+    k = _skew(aas)
+    rots = np.eye(3, dtype=aas.dtype) + a*k + b*np.matmul(k, k)
+    return rots.astype(aas.dtype)
 
 
 def rotmat2aa(rotmats):
     """
-    Convert rotation matrices to angle-axis using opencv's Rodrigues formula.
+    Convert rotation matrices to angle-axis. Equivalent to opencv's Rodrigues but vectorized. As in opencv, the inputs
+    are first projected onto the closest orthogonal matrices.
     Args:
         rotmats: A np array of shape (..., 3, 3)
 
@@ -236,12 +365,154 @@ def rotmat2aa(rotmats):
         A np array of shape (..., 3)
     """
     assert rotmats.shape[-1] == 3 and rotmats.shape[-2] == 3 and len(rotmats.shape) >= 3, 'invalid input dimension'
-    orig_shape = rotmats.shape[:-2]
-    rots = np.reshape(rotmats, [-1, 3, 3])
-    aas = np.zeros([rots.shape[0], 3])
-    for i in range(rots.shape[0]):
-        aas[i] = np.squeeze(cv2.Rodrigues(rots[i])[0])
-    return np.reshape(aas, orig_shape + (3,))
+    rots = _as_float_array(rotmats)
+    dtype = rots.dtype
+    u, _, vh = np.linalg.svd(rots)
+    rots = np.matmul(u, vh)
+
+    # The skew-symmetric part is sin(theta)*axis.
+    r = np.stack([rots[..., 2, 1] - rots[..., 1, 2],
+                  rots[..., 0, 2] - rots[..., 2, 0],
+                  rots[..., 1, 0] - rots[..., 0, 1]], axis=-1)
+    s = np.linalg.norm(r, axis=-1) * 0.5
+    c = np.clip((np.trace(rots, axis1=-2, axis2=-1) - 1.0) * 0.5, -1.0, 1.0)
+    theta = np.arctan2(s, c)
+
+    # theta/(2*sin(theta)) tends to 1/2 for small angles.
+    tiny = np.finfo(dtype).eps
+    s_safe = np.where(s < tiny, np.ones_like(s), s)
+    scale = np.where(s < tiny, 0.5 * np.ones_like(s), theta / (2.0 * s_safe))
+    aas = r * scale[..., np.newaxis]
+
+    # Close to pi, sin(theta) vanishes and the axis is taken from the symmetric part (R + R')/2 - cos(theta)*I which
+    # is (1 - cos(theta))*axis*axis'. Its column with the largest diagonal entry is the most accurate one.
+    near_pi = c < -0.5
+    if np.any(near_pi):
+        rots_pi = rots[near_pi]
+        c_pi = c[near_pi]
+        sym = (rots_pi + np.swapaxes(rots_pi, -1, -2)) * 0.5 - c_pi[:, np.newaxis, np.newaxis] * np.eye(3)
+        col = np.argmax(np.diagonal(sym, axis1=-2, axis2=-1), axis=-1)
+        axis = np.take_along_axis(sym, col[:, np.newaxis, np.newaxis], axis=-1)[..., 0]
+        axis /= np.linalg.norm(axis, axis=-1, keepdims=True)
+        # Pick the direction agreeing with sin(theta)*axis. At exactly pi both are valid, then x >= 0 as in opencv.
+        sign = np.sign(np.sum(axis * r[near_pi], axis=-1))
+        sign = np.where(s[near_pi] < tiny, np.where(axis[:, 0] < 0, -1.0, 1.0), sign)
+        aas[near_pi] = axis * (sign * theta[near_pi])[:, np.newaxis]
+    return aas.astype(dtype)
+
+
+def aa2quat(angle_axes):
+    """
+    Convert angle-axis to unit quaternions in (w, x, y, z) order with w >= 0.
+    Args:
+        angle_axes: A np array of shape (..., 3)
+
+    Returns:
+        A np array of shape (..., 4)
+    """
+    aas = _as_float_array(angle_axes)
+    theta = np.linalg.norm(aas, axis=-1, keepdims=True)
+
+    # sin(theta/2)/theta tends to 1/2 for small angles.
+    small = theta < np.finfo(aas.dtype).eps ** 0.25
+    theta_safe = np.where(small, np.ones_like(theta), theta)
+    scale = np.where(small, 0.5 - theta**2 / 48.0, np.sin(theta_safe / 2.0) / theta_safe)
+    quats = np.concatenate([np.cos(theta / 2.0), aas * scale], axis=-1)
+    # Rotations by more than pi are mapped to the other hemisphere.
+    quats *= np.where(quats[..., :1] < 0, -1.0, 1.0)
+    return quats.astype(aas.dtype)
+
+
+def quat2aa(quats):
+    """
+    Convert quaternions in (w, x, y, z) order to angle-axis with angles in [0, pi]. Inputs are normalized first.
+    Args:
+        quats: A np array of shape (..., 4)
+
+    Returns:
+        A np array of shape (..., 3)
+    """
+    assert quats.shape[-1] == 4
+    qs = _as_float_array(quats)
+    qs = qs / np.linalg.norm(qs, axis=-1, keepdims=True)
+    # q and -q represent the same rotation. w >= 0 gives the shorter angle.
+    qs = qs * np.where(qs[..., :1] < 0, -1.0, 1.0)
+    w = qs[..., :1]
+    xyz = qs[..., 1:]
+    n = np.linalg.norm(xyz, axis=-1, keepdims=True)
+
+    # 2*atan2(n, w)/n tends to 2/w for small angles.
+    small = n < np.finfo(qs.dtype).eps ** 0.5
+    n_safe = np.where(small, np.ones_like(n), n)
+    scale = np.where(small, 2.0 / w, 2.0 * np.arctan2(n, w) / n_safe)
+    return (xyz * scale).astype(qs.dtype)
+
+
+def quat2rotmat(quats):
+    """
+    Convert quaternions in (w, x, y, z) order to rotation matrices. Inputs are normalized first.
+    Args:
+        quats: A np array of shape (..., 4)
+
+    Returns:
+        A np array of shape (..., 3, 3)
+    """
+    assert quats.shape[-1] == 4
+    qs = _as_float_array(quats)
+    qs = qs / np.linalg.norm(qs, axis=-1, keepdims=True)
+    w, x, y, z = qs[..., 0], qs[..., 1], qs[..., 2], qs[..., 3]
+    rots = np.stack([1.0 - 2.0*(y*y + z*z), 2.0*(x*y - w*z), 2.0*(x*z + w*y),
+                     2.0*(x*y + w*z), 1.0 - 2.0*(x*x + z*z), 2.0*(y*z - w*x),
+                     2.0*(x*z - w*y), 2.0*(y*z + w*x), 1.0 - 2.0*(x*x + y*y)], axis=-1)
+    return np.reshape(rots, qs.shape[:-1] + (3, 3)).astype(qs.dtype)
+
+
+def rotmat2quat(rotmats):
+    """
+    Convert rotation matrices to unit quaternions in (w, x, y, z) order with w >= 0. Uses Shepperd's method, i.e.,
+    the largest of |w|, |x|, |y|, |z| is computed from the diagonal and the rest from the off-diagonal entries.
+    Args:
+        rotmats: A np array of shape (..., 3, 3)
+
+    Returns:
+        A np array of shape (..., 4)
+    """
+    assert rotmats.shape[-1] == 3 and rotmats.shape[-2] == 3
+    rots = _as_float_array(rotmats)
+    r00, r01, r02 = rots[..., 0, 0], rots[..., 0, 1], rots[..., 0, 2]
+    r10, r11, r12 = rots[..., 1, 0], rots[..., 1, 1], rots[..., 1, 2]
+    r20, r21, r22 = rots[..., 2, 0], rots[..., 2, 1], rots[..., 2, 2]
+
+    # Each row is proportional to the quaternion (4*w*q, 4*x*q, 4*y*q and 4*z*q, respectively).
+    candidates = np.stack([np.stack([1.0 + r00 + r11 + r22, r21 - r12, r02 - r20, r10 - r01], axis=-1),
+                           np.stack([r21 - r12, 1.0 + r00 - r11 - r22, r01 + r10, r02 + r20], axis=-1),
+                           np.stack([r02 - r20, r01 + r10, 1.0 - r00 + r11 - r22, r12 + r21], axis=-1),
+                           np.stack([r10 - r01, r02 + r20, r12 + r21, 1.0 - r00 - r11 + r22], axis=-1)], axis=-2)
+    best = np.argmax(np.diagonal(candidates, axis1=-2, axis2=-1), axis=-1)
+    quats = np.take_along_axis(candidates, best[..., np.newaxis, np.newaxis], axis=-2)[..., 0, :]
+    quats /= np.linalg.norm(quats, axis=-1, keepdims=True)
+    quats *= np.where(quats[..., :1] < 0, -1.0, 1.0)
+    return quats.astype(rots.dtype)
+
+
+def euler2rotmat(eulers):
+    """
+    Converts euler angles to rotation matrices. It is the inverse of `rotmat2euler`, i.e., R = Rx(-e1)Ry(-e2)Rz(-e3).
+    Args:
+        eulers: A np array of shape (..., 3)
+
+    Returns:
+        A np array of shape (..., 3, 3)
+    """
+    eul = _as_float_array(eulers)
+    c = np.cos(eul)
+    s = np.sin(eul)
+    c1, c2, c3 = c[..., 0], c[..., 1], c[..., 2]
+    s1, s2, s3 = s[..., 0], s[..., 1], s[..., 2]
+    rots = np.stack([c2*c3, c2*s3, -s2,
+                     s1*s2*c3 - c1*s3, s1*s2*s3 + c1*c3, s1*c2,
+                     c1*s2*c3 + s1*s3, c1*s2*s3 - s1*c3, c1*c2], axis=-1)
+    return np.reshape(rots, eul.shape[:-1] + (3, 3)).astype(eul.dtype)
 
 
 def get_closest_rotmat(rotmats):
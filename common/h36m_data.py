@@ -0,0 +1,80 @@
+"""
+
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Reads the H3.6M exponential map text files used by Martinez et al. Parsing the text files is slow, hence the parsed
+frames are cached as .npy files keyed by the path and modification time of the text file. The cache directory is
+$H36M_CACHE_DIR or ~/.cache/h36m.
+"""
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+H36M_CACHE_DIR = os.environ.get("H36M_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "h36m"))
+
+
+def read_csv_as_float(filename):
+    """
+    Reads a csv and returns a float matrix. Replaces the line-by-line parser borrowed from the SRNN code:
+    https://github.com/asheshjain399/NeuralModels/blob/master/neuralmodels/utils.py#L34
+
+    Args:
+        filename: Path to the csv file.
+    Returns:
+        The data in a float32 matrix of shape (n_lines, n_values).
+    """
+    return np.loadtxt(filename, delimiter=",", dtype=np.float32, ndmin=2)
+
+
+def get_cache_path(filename, cache_dir=H36M_CACHE_DIR):
+    """
+    Returns:
+        The path of the cached frames of `filename`. It changes if the file is modified.
+    """
+    filename = os.path.abspath(filename)
+    key = "{}:{}".format(filename, os.stat(filename).st_mtime_ns)
+    cache_file = "{}_{}.npy".format(os.path.splitext(os.path.basename(filename))[0],
+                                    hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+    return os.path.join(cache_dir, cache_file)
+
+
+def load_sequence(filename, downsample=1, cache_dir=H36M_CACHE_DIR):
+    """
+    Loads the frames of an H3.6M text file, from the cache if possible.
+
+    Args:
+        filename: Path to the text file, e.g., "<path_to_dataset>/S1/walking_1.txt".
+        downsample: Only every `downsample`-th frame is returned, e.g., 2 to go from 50 to 25 fps.
+        cache_dir: Where to cache the parsed frames. No cache is used if None.
+    Returns:
+        float32 np array of shape (n_frames, 99).
+    """
+    if cache_dir is None:
+        return read_csv_as_float(filename)[::downsample]
+
+    cache_path = get_cache_path(filename, cache_dir)
+    if os.path.exists(cache_path):
+        return np.load(cache_path)[::downsample]
+
+    sequence = read_csv_as_float(filename)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    # Write into a temporary file with a unique name first, so that processes that miss the cache for the same file
+    # at the same time never write into the same file and readers never see a partial file.
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as f_handle:
+        np.save(f_handle, sequence)
+    os.replace(f_handle.name, cache_path)
+    return sequence[::downsample]
@@ -0,0 +1,182 @@
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Checks the vectorized rotation conversions against opencv's Rodrigues and against each other, and the TF conversions
+used by the data pipeline against the NumPy ones. Run with pytest. The whole module, including the NumPy checks, is
+skipped if opencv, numpy-quaternion or TF is not installed, since common.conversions imports the latter two.
+"""
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("quaternion")
+tf = pytest.importorskip("tensorflow")
+
+from common import conversions
+
+DTYPES = [np.float32, np.float64]
+# Tolerances for comparing against opencv and for round-trips.
+ATOL = {np.float32: 2e-6, np.float64: 1e-12}
+# Up to about this angle opencv's Rodrigues returns a zero angle-axis.
+CV2_MIN_ANGLE = 1e-5
+
+
+def random_angle_axes(n, min_angle=0.0, max_angle=np.pi, seed=0):
+    """Returns float64 angle-axes of shape (n, 3) with random axes and angles in [min_angle, max_angle]."""
+    rng = np.random.RandomState(seed)
+    axes = rng.randn(n, 3)
+    axes /= np.linalg.norm(axes, axis=-1, keepdims=True)
+    return axes * rng.uniform(min_angle, max_angle, size=(n, 1))
+
+
+def angle_axes_near_zero(n, seed=1):
+    """Angles between 1e-9 and 1e-2."""
+    aas = random_angle_axes(n, seed=seed)
+    return aas / np.linalg.norm(aas, axis=-1, keepdims=True) * np.logspace(-9, -2, n)[:, np.newaxis]
+
+
+def angle_axes_near_pi(n, seed=2):
+    """Angles between pi - 1e-2 and pi - 1e-9, and exactly pi."""
+    aas = random_angle_axes(n, seed=seed)
+    angles = np.concatenate([np.pi - np.logspace(-2, -9, n - 2), [np.pi, np.pi]])
+    return aas / np.linalg.norm(aas, axis=-1, keepdims=True) * angles[:, np.newaxis]
+
+
+def cv2_aa2rotmat(angle_axes):
+    return np.stack([cv2.Rodrigues(aa)[0] for aa in angle_axes])
+
+
+def cv2_rotmat2aa(rotmats):
+    return np.stack([cv2.Rodrigues(rotmat)[0][:, 0] for rotmat in rotmats])
+
+
+def assert_angle_axes_close(actual, expected, atol, pi_band=0.0):
+    """
+    At an angle of pi, aa and -aa are the same rotation, so either one is accepted there. With `pi_band`, the
+    antipodal angle-axis is also accepted for angles that are at most this far from pi.
+    """
+    close = np.all(np.abs(actual - expected) <= atol, axis=-1)
+    at_pi = np.abs(np.linalg.norm(expected, axis=-1) - np.pi) <= max(atol, pi_band)
+    antipodal = np.all(np.abs(actual + expected) <= atol, axis=-1)
+    ok = np.logical_or(close, np.logical_and(at_pi, antipodal))
+    assert np.all(ok), "max error {}".format(np.max(np.abs(actual - expected)[~ok]))
+
+
+def assert_quaternions_close(actual, expected, atol):
+    """q and -q are the same rotation. With w == 0, both occur."""
+    close = np.all(np.abs(actual - expected) <= atol, axis=-1)
+    antipodal = np.all(np.abs(actual + expected) <= atol, axis=-1)
+    assert np.all(np.logical_or(close, antipodal))
+
+
+@pytest.fixture(params=["random", "near_zero", "near_pi"])
+def angle_axes(request):
+    if request.param == "random":
+        return random_angle_axes(200)
+    elif request.param == "near_zero":
+        return angle_axes_near_zero(50)
+    return angle_axes_near_pi(50)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_aa2rotmat_matches_cv2(angle_axes, dtype):
+    aas = angle_axes.astype(dtype)
+    rotmats = conversions.aa2rotmat(aas)
+    assert rotmats.dtype == dtype
+    np.testing.assert_allclose(rotmats, cv2_aa2rotmat(aas), atol=ATOL[dtype], rtol=0)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_rotmat2aa_matches_cv2(angle_axes, dtype):
+    rotmats = cv2_aa2rotmat(angle_axes).astype(dtype)
+    aas = conversions.rotmat2aa(rotmats)
+    assert aas.dtype == dtype
+    expected = cv2_rotmat2aa(rotmats)
+
+    # opencv snaps angles up to about CV2_MIN_ANGLE to zero and is only accurate to about 1e-11 for angles slightly
+    # above. Within CV2_MIN_ANGLE of pi, it chooses the sign of the axis heuristically, i.e., it may return the
+    # antipodal angle-axis, and it is only accurate to about 1e-8.
+    angles = np.linalg.norm(angle_axes, axis=-1)
+    tiny = angles < 2*CV2_MIN_ANGLE
+    small = np.logical_and(angles < 1e-3, np.logical_not(tiny))
+    near_pi = angles > np.pi - 1e-2
+    regular = np.logical_not(np.logical_or(angles < 1e-3, near_pi))
+    assert_angle_axes_close(aas[regular], expected[regular], ATOL[dtype])
+    assert_angle_axes_close(aas[tiny], expected[tiny], 2*CV2_MIN_ANGLE)
+    assert_angle_axes_close(aas[small], expected[small], max(ATOL[dtype], 1e-11))
+    assert_angle_axes_close(aas[near_pi], expected[near_pi], max(ATOL[dtype], 1e-7), pi_band=CV2_MIN_ANGLE)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_rotmat2aa_recovers_angle_axes(angle_axes, dtype):
+    rotmats = conversions.aa2rotmat(angle_axes).astype(dtype)
+    assert_angle_axes_close(conversions.rotmat2aa(rotmats), angle_axes, ATOL[dtype])
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_batch_shape(dtype):
+    aas = random_angle_axes(24).astype(dtype).reshape([2, 3, 4, 3])
+    rotmats = conversions.aa2rotmat(aas)
+    assert rotmats.shape == (2, 3, 4, 3, 3)
+    assert conversions.rotmat2aa(rotmats).shape == (2, 3, 4, 3)
+    assert conversions.rotmat2quat(rotmats).shape == (2, 3, 4, 4)
+    np.testing.assert_allclose(rotmats.reshape([-1, 3, 3]), conversions.aa2rotmat(aas.reshape([-1, 3])), atol=0)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_aa_rotmat_round_trip(angle_axes, dtype):
+    rotmats = conversions.aa2rotmat(angle_axes.astype(dtype))
+    np.testing.assert_allclose(conversions.aa2rotmat(conversions.rotmat2aa(rotmats)), rotmats,
+                               atol=10*ATOL[dtype], rtol=0)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_aa_quat_round_trip(angle_axes, dtype):
+    aas = angle_axes.astype(dtype)
+    quats = conversions.aa2quat(aas)
+    np.testing.assert_allclose(np.linalg.norm(quats, axis=-1), 1.0, atol=ATOL[dtype], rtol=0)
+    assert np.all(quats[..., 0] >= 0)
+    assert_angle_axes_close(conversions.quat2aa(quats), aas, 10*ATOL[dtype])
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_quat_rotmat_round_trip(angle_axes, dtype):
+    aas = angle_axes.astype(dtype)
+    quats = conversions.aa2quat(aas)
+    rotmats = conversions.quat2rotmat(quats)
+    np.testing.assert_allclose(rotmats, conversions.aa2rotmat(aas), atol=10*ATOL[dtype], rtol=0)
+    assert_quaternions_close(conversions.rotmat2quat(rotmats), quats, 10*ATOL[dtype])
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_euler_rotmat_round_trip(angle_axes, dtype):
+    rotmats = conversions.aa2rotmat(angle_axes.astype(dtype))
+    eulers = conversions.rotmat2euler(rotmats)
+    np.testing.assert_allclose(conversions.euler2rotmat(eulers), rotmats, atol=10*ATOL[dtype], rtol=0)
+
+
+def run_tf(fn, inputs):
+    with tf.Graph().as_default():
+        with tf.Session() as sess:
+            return sess.run(fn(tf.constant(inputs)))
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_rotmat2aa_tf_matches_numpy(angle_axes, dtype):
+    rotmats = conversions.aa2rotmat(angle_axes.astype(dtype))
+    aas = run_tf(conversions.rotmat2aa_tf, rotmats)
+    assert aas.dtype == dtype
+    # The SVDs of TF and NumPy round differently. Close to pi, this may flip the sign of sin(theta)*axis.
+    pi_band = 1e-3 if dtype == np.float32 else 1e-6
+    assert_angle_axes_close(aas, conversions.rotmat2aa(rotmats), 100*ATOL[dtype], pi_band)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_rotmat2quat_tf_matches_numpy(angle_axes, dtype):
+    rotmats = conversions.aa2rotmat(angle_axes.astype(dtype))
+    quats = run_tf(conversions.rotmat2quat_tf, rotmats)
+    assert quats.dtype == dtype
+    assert_quaternions_close(quats, conversions.rotmat2quat(rotmats), 10*ATOL[dtype])
@@ -0,0 +1,90 @@
+"""
+
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Measures the input pipeline throughput (samples/s) of the tfrecord and the memory-mapped data backends on the same
+split. The memory-mapped store is expected next to the tfrecord shards (see preprocessing/convert_tfrecords.py).
+
+Example:
+    python benchmark_data.py --data_dir <AMASS_DATA> --split training --window_type random --n_batches 500
+"""
+import os
+import time
+import argparse
+
+import tensorflow as tf
+
+from common.constants import Constants as C
+from spl.data.amass_tf import TFRecordMotionDataset
+from spl.data.mmap_dataset import MmapMotionDataset
+
+
+def benchmark(dataset, n_batches, n_warmup_batches):
+    """
+    Iterates over `n_warmup_batches` and then measures the time for the next `n_batches`. The iterator is
+    re-initialized if the split is exhausted.
+    Returns:
+        Number of samples, number of frames and time in seconds.
+    """
+    with tf.Session() as sess:
+        sess.run(dataset.get_iterator().initializer)
+        fetch = [dataset.get_tf_samples()[C.BATCH_SEQ_LEN]]
+        n_samples, n_frames, start_time = 0, 0, None
+        for step in range(n_warmup_batches + n_batches):
+            if step == n_warmup_batches:
+                n_samples, n_frames, start_time = 0, 0, time.perf_counter()
+            try:
+                seq_len = sess.run(fetch)[0]
+            except tf.errors.OutOfRangeError:
+                sess.run(dataset.get_iterator().initializer)
+                seq_len = sess.run(fetch)[0]
+            n_samples += seq_len.shape[0]
+            n_frames += seq_len.sum()
+        return n_samples, n_frames, time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default=os.environ.get("AMASS_DATA"), help="Data directory.")
+    parser.add_argument("--data_type", default="rotmat", choices=["rotmat", "aa", "quat"], help="Data representation.")
+    parser.add_argument("--split", default="training", help="Name of the split, e.g. training or validation_dynamic.")
+    parser.add_argument("--backends", default="tfrecord,mmap", help="Comma-separated backends to benchmark.")
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size.")
+    parser.add_argument("--window_len", type=int, default=144, help="Window length. If 0, full sequences are used.")
+    parser.add_argument("--window_type", default=C.DATA_WINDOW_RANDOM,
+                        choices=[C.DATA_WINDOW_RANDOM, C.DATA_WINDOW_BEGINNING, C.DATA_WINDOW_CENTER],
+                        help="How windows are extracted.")
+    parser.add_argument("--num_parallel_calls", type=int, default=4, help="Parallel calls of the tf.data maps.")
+    parser.add_argument("--n_batches", type=int, default=200, help="Number of timed batches.")
+    parser.add_argument("--n_warmup_batches", type=int, default=20, help="Number of batches before timing starts.")
+    args = parser.parse_args()
+
+    split_dir = os.path.join(args.data_dir, args.data_type, args.split)
+    data_path = os.path.join(split_dir, "amass-?????-of-?????")
+    meta_data_path = os.path.join(args.data_dir, args.data_type, "training", "stats.npz")
+    dataset_classes = {C.DATA_BACKEND_TFRECORD: TFRecordMotionDataset, C.DATA_BACKEND_MMAP: MmapMotionDataset}
+
+    for backend in args.backends.split(","):
+        tf.reset_default_graph()
+        dataset = dataset_classes[backend](data_path=data_path,
+                                           meta_data_path=meta_data_path,
+                                           batch_size=args.batch_size,
+                                           shuffle=args.window_type == C.DATA_WINDOW_RANDOM,
+                                           extract_windows_of=args.window_len,
+                                           window_type=args.window_type,
+                                           num_parallel_calls=args.num_parallel_calls)
+        n_samples, n_frames, elapsed = benchmark(dataset, args.n_batches, args.n_warmup_batches)
+        print("{:>10}: {:>10.1f} samples/s, {:>12.1f} frames/s ({} samples in {:.2f} s)".format(
+            backend, n_samples/elapsed, n_frames/elapsed, n_samples, elapsed))
@@ -21,6 +21,9 @@ import functools
 
 from common.constants import Constants as C
 from spl.data.base_dataset import Dataset
+from spl.data.sample_index import load_sample_index, load_shard_manifest, read_record
+from spl.data.window_index import load_window_index
+from spl.data.pose_encoding import decode_poses_tf, get_example_poses_dtype, POSES_RAW_KEYS
 
 
 class TFRecordMotionDataset(Dataset):
@@ -28,7 +31,21 @@ class TFRecordMotionDataset(Dataset):
     Dataset class for AMASS dataset stored as TFRecord files.
     """
     def __init__(self, data_path, meta_data_path, batch_size, shuffle, **kwargs):
+        keys_to_filter = kwargs.get("filter_by_key", None)
+        if keys_to_filter is not None:
+            keys_to_filter = sorted(set(key.encode("utf-8") if isinstance(key, str) else key for key in keys_to_filter))
+        # A windowed split may only store a window index into the sequences of its "_dynamic" split. The windows are
+        # then extracted from the sequences in the data pipeline.
+        self.window_index = load_window_index(os.path.dirname(data_path), keys_to_filter)
+        if self.window_index is not None:
+            data_path = os.path.join(self.window_index["sequence_dir"], os.path.basename(data_path))
+            print("Extracting {} windows from the sequences.".format(len(self.window_index["starts"])))
+            if keys_to_filter is not None:
+                keys_to_filter = sorted(set(self.window_index["sequence_ids"]))
         print("Loading motion data from {}".format(os.path.abspath(data_path)))
+        # Number of records, frames and bytes per shard. Used to split the shards among several reader processes and to
+        # determine the size of an epoch.
+        self.shard_manifest = load_shard_manifest(os.path.dirname(data_path))
         # Extract a window randomly. If the sequence is shorter, ignore it.
         self.extract_windows_of = kwargs.get("extract_windows_of", 0)
         # Determines the index of the initial frame of the window if window_type
@@ -37,16 +54,101 @@ class TFRecordMotionDataset(Dataset):
         # Whether to extract windows randomly, from the beginning or the middle
         # of the sequence.
         self.window_type = kwargs.get("window_type", True)
+        # Number of random windows extracted from each sequence per epoch if window_type is "random". If 0, the
+        # sequence is tiled with non-overlapping windows starting at a random offset, i.e., the number of windows is
+        # proportional to the sequence length.
+        self.windows_per_sequence = kwargs.get("windows_per_sequence", 1)
         self.length_threshold = kwargs.get("length_threshold", self.extract_windows_of)
         self.num_parallel_calls = kwargs.get("num_parallel_calls", 16)
         self.apply_length_filter = kwargs.get("apply_length_filter", True)
-        keys_to_filter = kwargs.get("filter_by_key", None)
-        self.tf_sample_keys = None
+        # Layout of the tfrecords, detected from the first record if not given. Raw records are parsed in batches of
+        # `parse_batch_size`.
+        self.record_format = kwargs.get("record_format", None) or self.get_record_format(data_path)
+        self.parse_batch_size = kwargs.get("parse_batch_size", 64)
+        # Storage precision of the poses in raw records, detected from the first record if not given. Poses are always
+        # decoded to float32.
+        self.poses_dtype = C.DATA_POSES_FLOAT32
+        if self.record_format == C.DATA_RECORD_RAW:
+            self.poses_dtype = kwargs.get("poses_dtype", None) or self.get_poses_dtype(data_path)
+        # Memory budget of the shuffle buffer in MB. If not given, the buffer holds batch_size*10 samples.
+        self.shuffle_buffer_mb = kwargs.get("shuffle_buffer_mb", None)
+        self.shuffle_buffer_size = None
+        # Batch samples of similar length together if sequence length boundaries are given. Otherwise every sample
+        # is padded to the longest sequence in the batch.
+        self.length_bucket_boundaries = kwargs.get("length_bucket_boundaries", None)
+        # Only the samples with the given ids are used. If the split has a sample index, the records are read directly.
+        # Otherwise, all records are parsed and filtered by looking up the sample ids in a hash table.
+        self.indexed_records = None
+        self.sample_key_table = None
         if keys_to_filter is not None:
-            self.tf_sample_keys = tf.constant(keys_to_filter)
+            sample_index = load_sample_index(os.path.dirname(data_path))
+            if sample_index is not None:
+                self.indexed_records = [sample_index[key] for key in keys_to_filter if key in sample_index]
+                print("Reading {} of {} requested samples from the sample index.".format(len(self.indexed_records),
+                                                                                         len(keys_to_filter)))
+            else:
+                # The table is initialized by tf.tables_initializer().
+                self.sample_key_table = tf.lookup.StaticHashTable(
+                    tf.lookup.KeyValueTensorInitializer(tf.constant(keys_to_filter),
+                                                        tf.ones([len(keys_to_filter)], dtype=tf.int32)),
+                    default_value=0)
+
+        if self.window_index is not None:
+            self.create_window_tables()
 
         super(TFRecordMotionDataset, self).__init__(data_path, meta_data_path, batch_size, shuffle, **kwargs)
 
+    def create_window_tables(self):
+        """
+        Creates the constants to look up the windows of a sequence. The windows of a sequence are stored in
+        consecutive rows in the order of the window index, and a hash table maps the sequence ids to the first row and
+        the number of windows.
+        """
+        sequence_ids = np.array(self.window_index["sequence_ids"])
+        order = np.argsort(sequence_ids, kind="stable")
+        unique_ids, first_rows, n_windows = np.unique(sequence_ids[order], return_index=True, return_counts=True)
+        self.window_starts = tf.constant(self.window_index["starts"][order].astype(np.int32))
+        self.window_file_ids = tf.constant(np.array(self.window_index["file_ids"])[order])
+        self.window_first_rows = tf.constant(first_rows.astype(np.int32))
+        self.window_counts = tf.constant(n_windows.astype(np.int32))
+        # The table is initialized by tf.tables_initializer().
+        self.window_table = tf.lookup.StaticHashTable(
+            tf.lookup.KeyValueTensorInitializer(tf.constant(unique_ids),
+                                                tf.range(len(unique_ids), dtype=tf.int32)),
+            default_value=-1)
+
+    @staticmethod
+    def get_record_format(data_path):
+        """
+        Determines the layout of the tfrecords by inspecting the first record.
+        Args:
+            data_path: Glob pattern of the tfrecord files.
+        Returns:
+            C.DATA_RECORD_RAW or C.DATA_RECORD_LEGACY
+        """
+        for f in sorted(tf.gfile.Glob(data_path)):
+            for serialized in tf.python_io.tf_record_iterator(f):
+                example = tf.train.Example.FromString(serialized)
+                if get_example_poses_dtype(example.features.feature) is not None:
+                    return C.DATA_RECORD_RAW
+                return C.DATA_RECORD_LEGACY
+        return C.DATA_RECORD_LEGACY
+
+    @staticmethod
+    def get_poses_dtype(data_path):
+        """
+        Determines the storage precision of the poses in raw tfrecords by inspecting the first record.
+        Args:
+            data_path: Glob pattern of the tfrecord files.
+        Returns:
+            C.DATA_POSES_FLOAT32, C.DATA_POSES_FLOAT16 or C.DATA_POSES_INT16
+        """
+        for f in sorted(tf.gfile.Glob(data_path)):
+            for serialized in tf.python_io.tf_record_iterator(f):
+                example = tf.train.Example.FromString(serialized)
+                return get_example_poses_dtype(example.features.feature) or C.DATA_POSES_FLOAT32
+        return C.DATA_POSES_FLOAT32
+
     def load_meta_data(self, meta_data_path):
         """
         Loads meta-data file given the path. It is assumed to be in numpy.
@@ -61,6 +163,91 @@ class TFRecordMotionDataset(Dataset):
         else:
             return np.load(meta_data_path, allow_pickle=True)['stats'].tolist()
 
+    def get_worker_shards(self):
+        """
+        Splits the shards among the reader processes. The shards are assigned deterministically, the largest first, to
+        the process that has the fewest bytes so far. Sizes are taken from the shard manifest if available.
+        Returns:
+            Paths of the shards read by this process.
+        """
+        shards = sorted(tf.gfile.Glob(self.data_path))
+        if len(shards) < self.num_workers:
+            raise Exception("Can't split {} shards among {} reader processes.".format(len(shards), self.num_workers))
+        if self.shard_manifest is not None:
+            manifest_sizes = {entry["shard"]: entry["bytes"] for entry in self.shard_manifest["shards"]}
+            sizes = {shard: manifest_sizes[os.path.basename(shard)] for shard in shards}
+        else:
+            sizes = {shard: tf.gfile.Stat(shard).length for shard in shards}
+
+        worker_sizes = np.zeros(self.num_workers, dtype=np.int64)
+        worker_shards = []
+        for shard in sorted(shards, key=lambda shard: (-sizes[shard], shard)):
+            worker_idx = int(np.argmin(worker_sizes))
+            worker_sizes[worker_idx] += sizes[shard]
+            if worker_idx == self.worker_index:
+                worker_shards.append(shard)
+        return sorted(worker_shards)
+
+    def get_num_samples(self):
+        """
+        Determines the number of samples per epoch read by this process from the shard manifest or the sample and
+        window indices without reading the records.
+        Returns:
+            Number of samples or None if it depends on the data, e.g., if sequences are tiled with windows, if
+            sequences are filtered by length and their lengths are not known, or if the windows of a window index are
+            split among several processes.
+        """
+        if self.extract_windows_of > 0 and self.window_type == C.DATA_WINDOW_RANDOM and self.windows_per_sequence == 0:
+            return None
+
+        # Number of sequences and minimum number of frames of a sequence per group of sequences.
+        if self.window_index is not None:
+            if self.num_workers > 1:
+                return None
+            groups = [(len(self.window_index["starts"]), self.window_index["window_size"])]
+        elif self.indexed_records is not None:
+            groups = [(1, n_frames) for _, _, _, n_frames in self.indexed_records[self.worker_index::self.num_workers]]
+        elif self.sample_key_table is None and self.shard_manifest is not None:
+            manifest_shards = {entry["shard"]: entry for entry in self.shard_manifest["shards"]}
+            shards = self.get_worker_shards() if self.num_workers > 1 else sorted(tf.gfile.Glob(self.data_path))
+            groups = [(manifest_shards[os.path.basename(shard)]["records"],
+                       manifest_shards[os.path.basename(shard)]["min_frames"]) for shard in shards]
+        else:
+            return None
+
+        n_samples = 0
+        for n_sequences, min_frames in groups:
+            if n_sequences == 0:
+                continue
+            if self.extract_windows_of > 0 and self.apply_length_filter:
+                if not min_frames:  # the lengths are not stored
+                    return None
+                if min_frames < self.length_threshold:
+                    if n_sequences > 1:  # only some of the sequences are filtered
+                        return None
+                    continue
+            n_samples += n_sequences
+
+        if self.extract_windows_of > 0 and self.window_type == C.DATA_WINDOW_RANDOM and self.windows_per_sequence > 1:
+            n_samples *= self.windows_per_sequence
+        return n_samples
+
+    def get_shuffle_buffer_size(self):
+        """
+        Converts the memory budget of the shuffle buffer into a number of samples. The size of a sample is determined
+        by the window length or, if the full sequences are used, by the longest sequence in the meta-data.
+        Returns:
+            Number of samples in the shuffle buffer.
+        """
+        if not self.shuffle_buffer_mb:
+            return self.batch_size*10
+
+        seq_len = self.extract_windows_of if self.extract_windows_of > 0 else self.meta_data["max_seq_len"]
+        sample_bytes = int(seq_len)*self.mean_channel.shape[0]*np.dtype(np.float32).itemsize
+        buffer_size = max(int(self.shuffle_buffer_mb*1024*1024 // sample_bytes), 1)
+        print("Shuffle buffer holds {} samples ({:.1f} MB).".format(buffer_size, buffer_size*sample_bytes/1024/1024))
+        return buffer_size
+
     def tf_data_transformations(self):
         """
         Loads the raw data and apply preprocessing.
@@ -68,18 +255,40 @@ class TFRecordMotionDataset(Dataset):
         """
         tf_data_opt = tf.data.Options()
         # tf_data_opt.experimental_autotune = True
+        self.shuffle_buffer_size = self.get_shuffle_buffer_size()
 
-        self.tf_data = tf.data.TFRecordDataset.list_files(self.data_path, seed=1234, shuffle=self.shuffle)
-        self.tf_data = self.tf_data.with_options(tf_data_opt)
-        self.tf_data = self.tf_data.apply(tf.data.experimental.parallel_interleave(tf.data.TFRecordDataset, cycle_length=self.num_parallel_calls, block_length=1, sloppy=self.shuffle))
-        self.tf_data = self.tf_data.map(functools.partial(self.__parse_single_tfexample_fn), num_parallel_calls=self.num_parallel_calls)
-        self.tf_data = self.tf_data.prefetch(self.batch_size*10)
-        if self.shuffle:
-            self.tf_data = self.tf_data.shuffle(self.batch_size*10)
+        if self.indexed_records is not None:
+            # Read the requested records directly instead of parsing the whole split.
+            self.tf_data = tf.data.Dataset.from_generator(functools.partial(self.__read_indexed_records),
+                                                          output_types=tf.string, output_shapes=tf.TensorShape([]))
+            self.tf_data = self.tf_data.with_options(tf_data_opt)
+        else:
+            shards = self.data_path if self.num_workers == 1 else self.get_worker_shards()
+            self.tf_data = tf.data.TFRecordDataset.list_files(shards, seed=1234, shuffle=self.shuffle)
+            self.tf_data = self.tf_data.with_options(tf_data_opt)
+            self.tf_data = self.tf_data.apply(tf.data.experimental.parallel_interleave(tf.data.TFRecordDataset, cycle_length=self.num_parallel_calls, block_length=1, sloppy=self.shuffle))
+        if self.record_format == C.DATA_RECORD_RAW:
+            # Parse a batch of examples at once, only the raw poses need to be decoded per sample.
+            self.tf_data = self.tf_data.batch(self.parse_batch_size)
+            self.tf_data = self.tf_data.map(functools.partial(self.__parse_batch_tfexample_fn), num_parallel_calls=self.num_parallel_calls)
+            self.tf_data = self.tf_data.apply(tf.data.experimental.unbatch())
+            self.tf_data = self.tf_data.map(functools.partial(self.__decode_raw_poses), num_parallel_calls=self.num_parallel_calls)
+        else:
+            self.tf_data = self.tf_data.map(functools.partial(self.__parse_single_tfexample_fn), num_parallel_calls=self.num_parallel_calls)
 
-        if self.tf_sample_keys is not None:
+        if self.sample_key_table is not None:
             self.tf_data = self.tf_data.filter(
                     functools.partial(self.__pp_name_filter))
+
+        # Quaternions are converted before extracting the windows so that the antipodal correction covers the whole
+        # sequence as in the preprocessing. The other representations are converted per window.
+        convert_sequences = self.convert_data_type and self.data_type == C.QUATERNION
+        if convert_sequences:
+            self.tf_data = self.tf_data.map(functools.partial(self.convert_poses),
+                                            num_parallel_calls=self.num_parallel_calls)
+
+        if self.window_index is not None:
+            self.tf_data = self.tf_data.flat_map(functools.partial(self.__pp_get_windows_from_index))
         
         if self.extract_windows_of > 0:
             if self.apply_length_filter:
@@ -91,12 +300,26 @@ class TFRecordMotionDataset(Dataset):
             elif self.window_type == C.DATA_WINDOW_CENTER:
                 self.tf_data = self.tf_data.map(functools.partial(self.__pp_get_windows_middle),
                                                 num_parallel_calls=self.num_parallel_calls)
+            elif self.window_type == C.DATA_WINDOW_RANDOM and self.windows_per_sequence != 1:
+                self.tf_data = self.tf_data.map(functools.partial(self.__pp_get_windows_random_multi),
+                                                num_parallel_calls=self.num_parallel_calls)
+                self.tf_data = self.tf_data.flat_map(tf.data.Dataset.from_tensor_slices)
             elif self.window_type == C.DATA_WINDOW_RANDOM:
                 self.tf_data = self.tf_data.map(functools.partial(self.__pp_get_windows_random),
                                                 num_parallel_calls=self.num_parallel_calls)
             else:
                 raise Exception("Unknown window type.")
 
+        if self.convert_data_type and not convert_sequences:
+            self.tf_data = self.tf_data.map(functools.partial(self.convert_poses),
+                                            num_parallel_calls=self.num_parallel_calls)
+
+        # Shuffle after extracting the windows so that the buffer holds windows of fixed size rather than full
+        # sequences of arbitrary length.
+        if self.shuffle:
+            self.tf_data = self.tf_data.shuffle(self.shuffle_buffer_size)
+        self.tf_data = self.tf_data.prefetch(self.batch_size*10)
+
     def tf_data_normalization(self):
         # Applies normalization.
         if self.normalize:
@@ -110,14 +333,21 @@ class TFRecordMotionDataset(Dataset):
     def tf_data_to_model(self):
         # Converts the data into the format that a model expects. Creates input, target, sequence_length, etc.
         self.tf_data = self.tf_data.map(functools.partial(self.__to_model_inputs), num_parallel_calls=self.num_parallel_calls)
-        self.tf_data = self.tf_data.padded_batch(self.batch_size, padded_shapes=self.tf_data.output_shapes)
+        if self.length_bucket_boundaries:
+            self.tf_data = self.tf_data.apply(tf.data.experimental.bucket_by_sequence_length(
+                element_length_func=lambda sample: sample[C.BATCH_SEQ_LEN],
+                bucket_boundaries=self.length_bucket_boundaries,
+                bucket_batch_sizes=[self.batch_size]*(len(self.length_bucket_boundaries) + 1),
+                padded_shapes=self.tf_data.output_shapes))
+        else:
+            self.tf_data = self.tf_data.padded_batch(self.batch_size, padded_shapes=self.tf_data.output_shapes)
         self.tf_data = self.tf_data.prefetch(2)
         if tf.test.is_gpu_available():
             self.tf_data = self.tf_data.apply(tf.data.experimental.prefetch_to_device('/device:GPU:0'))
 
     def create_meta_data(self):
-        """We assume meta data always exists."""
-        raise RuntimeError("We do not create here.")
+        """We assume meta data always exists. Use preprocessing/compute_stats.py to create it for existing data."""
+        raise RuntimeError("We do not create here. Use preprocessing/compute_stats.py.")
 
     def data_summary(self):
         pass
@@ -131,7 +361,16 @@ class TFRecordMotionDataset(Dataset):
         return tf.shape(sample["poses"])[0] >= self.length_threshold
     
     def __pp_name_filter(self, sample):
-        return tf.reduce_sum(tf.cast(tf.equal(sample["sample_id"], self.tf_sample_keys), tf.int32 )) > 0
+        return self.sample_key_table.lookup(sample["sample_id"]) > 0
+
+    def __read_indexed_records(self):
+        file_handles = dict()
+        for shard, offset, length, _ in self.indexed_records[self.worker_index::self.num_workers]:
+            if shard not in file_handles:
+                file_handles[shard] = tf.gfile.GFile(shard, "rb")
+            yield read_record(file_handles[shard], offset, length)
+        for file_handle in file_handles.values():
+            file_handle.close()
 
     def __pp_get_windows_random(self, sample):
         start = tf.random_uniform((1, 1), minval=0, maxval=tf.shape(sample["poses"])[0]-self.extract_windows_of+1, dtype=tf.int32)[0][0]
@@ -140,6 +379,46 @@ class TFRecordMotionDataset(Dataset):
         sample["shape"] = tf.shape(sample["poses"])
         return sample
 
+    def __pp_get_windows_random_multi(self, sample):
+        # Extract several windows from the sequence, stacked in the first dimension.
+        seq_len = tf.shape(sample["poses"])[0]
+        max_start = seq_len - self.extract_windows_of
+        if self.windows_per_sequence > 0:
+            starts = tf.random_uniform([self.windows_per_sequence], minval=0, maxval=max_start+1, dtype=tf.int32)
+        else:
+            offset = tf.random_uniform([], minval=0, maxval=tf.minimum(self.extract_windows_of, max_start+1), dtype=tf.int32)
+            starts = tf.range(offset, max_start+1, self.extract_windows_of)
+        n_windows = tf.shape(starts)[0]
+
+        windows = dict()
+        windows["poses"] = tf.gather(sample["poses"], starts[:, tf.newaxis] + tf.range(self.extract_windows_of)[tf.newaxis])
+        windows["shape"] = tf.tile(tf.shape(windows["poses"])[tf.newaxis, 1:], [n_windows, 1])
+        for key in ["file_id", "db_name", "sample_id"]:
+            windows[key] = tf.tile(sample[key][tf.newaxis], [n_windows])
+        return windows
+
+    def __pp_get_windows_from_index(self, sample):
+        # Extract the windows of the sequence given by the window index. The windows are the same as the stored ones.
+        sequence_idx = self.window_table.lookup(sample["sample_id"])
+        first_row = tf.gather(self.window_first_rows, tf.maximum(sequence_idx, 0))
+        n_windows = tf.gather(self.window_counts, tf.maximum(sequence_idx, 0))*tf.cast(sequence_idx >= 0, tf.int32)
+        rows = tf.range(first_row, first_row + n_windows)
+        starts = tf.gather(self.window_starts, rows)
+
+        windows = dict()
+        window_size = self.window_index["window_size"]
+        windows["poses"] = tf.gather(sample["poses"], starts[:, tf.newaxis] + tf.range(window_size)[tf.newaxis])
+        windows["shape"] = tf.tile(tf.shape(windows["poses"], out_type=sample["shape"].dtype)[tf.newaxis, 1:],
+                                   [n_windows, 1])
+        windows["file_id"] = tf.gather(self.window_file_ids, rows)
+        windows["db_name"] = tf.tile(sample["db_name"][tf.newaxis], [n_windows])
+
+        # Remove ".pkl" extension. `pos` and `len` of substr must have the same shape.
+        file_id_len = tf.strings.length(windows["file_id"]) - 4
+        file_id = tf.strings.substr(windows["file_id"], tf.zeros_like(file_id_len), file_id_len)
+        windows["sample_id"] = tf.strings.join([windows["db_name"], file_id], separator="/")
+        return tf.data.Dataset.from_tensor_slices(windows)
+
     def __pp_get_windows_beginning(self, sample):
         # Extract a window from the beginning of the sequence.
         sample["poses"] = sample["poses"][self.beginning_index:self.beginning_index+self.extract_windows_of, :]
@@ -186,3 +465,26 @@ class TFRecordMotionDataset(Dataset):
         parsed_features["sample_id"] = tf.strings.join([parsed_features["db_name"], file_id], separator="/")
 
         return parsed_features
+
+    def __parse_batch_tfexample_fn(self, protos):
+        feature_to_type = {
+            "file_id": tf.io.FixedLenFeature([], dtype=tf.string),
+            "db_name": tf.io.FixedLenFeature([], dtype=tf.string),
+            "shape": tf.io.FixedLenFeature([2], dtype=tf.int64),
+            POSES_RAW_KEYS[self.poses_dtype]: tf.io.FixedLenFeature([], dtype=tf.string),
+        }
+
+        parsed_features = tf.io.parse_example(protos, feature_to_type)
+
+        # Remove ".pkl" extension. `pos` and `len` of substr must have the same shape.
+        file_id_len = tf.strings.length(parsed_features["file_id"]) - 4
+        file_id = tf.strings.substr(parsed_features["file_id"], tf.zeros_like(file_id_len), file_id_len)
+        parsed_features["sample_id"] = tf.strings.join([parsed_features["db_name"], file_id], separator="/")
+
+        return parsed_features
+
+    def __decode_raw_poses(self, sample):
+        # Poses are stored as little-endian bytes of float32, float16 or int16.
+        poses_raw = sample.pop(POSES_RAW_KEYS[self.poses_dtype])
+        sample["poses"] = tf.reshape(decode_poses_tf(poses_raw, self.poses_dtype), sample["shape"])
+        return sample
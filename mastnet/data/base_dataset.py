@@ -18,6 +18,20 @@ import tensorflow as tf
 import numpy as np
 import os
 
+from common.constants import Constants as C
+from common.conversions import rotmat2rep_tf
+
+
+def get_stats_file(stored_data_type, data_type):
+    """
+    Returns the name of the normalization statistics file in the training split. If the poses are stored as rotation
+    matrices and converted in the data pipeline, the statistics of the converted representation are stored next to
+    the ones of the rotation matrices.
+    """
+    if stored_data_type == data_type:
+        return "stats.npz"
+    return "stats_{}.npz".format(data_type)
+
 
 class Dataset(object):
     """
@@ -33,6 +47,13 @@ class Dataset(object):
         self.normalize = kwargs.get("normalize", True)
         self.normalization_dim = kwargs.get("normalization_dim", "channel")  # "channel" or "all"
         self.use_std_norm = kwargs.get("use_std_norm", False)  # Use variance or standard deviation of the data for normalization. This was a bug :) But we found that variance works much better for amass.
+        # Representation of the stored poses and the one that is passed to the models. Only rotation matrices can be
+        # converted into the other representations.
+        self.stored_data_type = kwargs.get("stored_data_type", None)
+        self.data_type = kwargs.get("data_type", None) or self.stored_data_type
+        self.convert_data_type = self.data_type != self.stored_data_type
+        if self.convert_data_type and self.stored_data_type != C.ROT_MATRIX:
+            raise Exception("Cannot convert {} poses into {}.".format(self.stored_data_type, self.data_type))
         
         if self.normalization_dim == "channel":
             self.normalization_func = self.normalize_zero_mean_unit_variance_channel
@@ -55,6 +76,15 @@ class Dataset(object):
             self.var_all = self.meta_data['var_all']
             self.var_channel = self.meta_data['var_channel']
 
+        # Part of the data read by this process if several reader processes share the data (see `shard`).
+        self.num_workers = kwargs.get("num_workers", 1)
+        self.worker_index = kwargs.get("worker_index", 0)
+        assert 0 <= self.worker_index < self.num_workers
+
+        self.create_pipeline()
+
+    def create_pipeline(self):
+        """Creates the tf.data pipeline and the iterator."""
         self.tf_data_transformations()
         self.tf_data_normalization()
         self.tf_data_to_model()
@@ -66,6 +96,27 @@ class Dataset(object):
             self.iterator = self.tf_data.make_initializable_iterator()
             self.tf_samples = self.iterator.get_next()
 
+    def shard(self, num_workers, worker_index):
+        """
+        Restricts the dataset to the part read by process `worker_index` of `num_workers` reader processes and creates
+        the pipeline again. The data is split deterministically, i.e., every sample is read by exactly one process.
+        Must be called before the samples (see `get_tf_samples`) are used.
+        Returns:
+            The dataset.
+        """
+        assert 0 <= worker_index < num_workers
+        self.num_workers = num_workers
+        self.worker_index = worker_index
+        self.create_pipeline()
+        return self
+
+    def get_num_samples(self):
+        """
+        Returns:
+            Number of samples per epoch read by this process if it is known up front, None otherwise.
+        """
+        return None
+
     def tf_data_transformations(self):
         raise NotImplementedError('Subclass must override sample method')
 
@@ -101,6 +152,26 @@ class Dataset(object):
             sample_dict[key] = sample_dict[key] * self.var_channel + self.mean_channel
         return sample_dict
 
+    def convert_poses(self, sample_dict):
+        """
+        Converts the stored rotation matrices into `data_type`. The feature size is given by the meta-data of
+        `data_type`.
+        """
+        sample_dict["poses"] = rotmat2rep_tf(sample_dict["poses"], self.data_type)
+        sample_dict["poses"].set_shape([None, self.mean_channel.shape[0]])
+        sample_dict["shape"] = tf.cast(tf.shape(sample_dict["poses"]), sample_dict["shape"].dtype)
+        return sample_dict
+
+    def get_normalization_stats(self):
+        """
+        Returns:
+            Mean and variance (or standard deviation if use_std_norm is set) of the normalization. Used if the
+            normalization is applied by the model instead (see spl.model.base_model).
+        """
+        if self.normalization_dim == "channel":
+            return self.mean_channel, self.var_channel
+        return self.mean_all, self.var_all
+
     def get_iterator(self):
         return self.iterator
 
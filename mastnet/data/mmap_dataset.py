@@ -0,0 +1,368 @@
+"""
+
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Memory-mapped storage of motion sequences. All sequences of a split are concatenated along the time axis into a single
+little-endian file `poses.f32` of shape (total_n_frames, feature_size). Poses stored with reduced precision are
+written into `poses.f16` or `poses.i16` instead and decoded to float32 when they are read (see spl.data.pose_encoding). `index.npz` stores the frame offset,
+length and ids of every sequence. Windows are extracted by slicing the memory-mapped array, and a sequence can be
+looked up by its sample id in constant time. Since the file is read via the page cache, several processes on a host
+share the same memory.
+"""
+import tensorflow as tf
+import numpy as np
+import os
+import functools
+import shutil
+
+from common.constants import Constants as C
+from spl.data.base_dataset import Dataset
+from spl.data.window_index import load_window_index
+from spl.data.pose_encoding import encode_poses, decode_poses, POSES_NP_DTYPES
+
+MMAP_POSES_FILE = "poses.f32"
+MMAP_POSES_FILES = {C.DATA_POSES_FLOAT32: MMAP_POSES_FILE, C.DATA_POSES_FLOAT16: "poses.f16",
+                    C.DATA_POSES_INT16: "poses.i16"}
+MMAP_INDEX_FILE = "index.npz"
+
+
+class MmapMotionWriter(object):
+    """
+    Appends motion sequences to a memory-mapped store. The index is written when the writer is closed.
+    """
+    def __init__(self, output_path, poses_dtype=C.DATA_POSES_FLOAT32):
+        """
+        Args:
+            output_path: Directory of the store. Created if it does not exist.
+            poses_dtype: Storage precision of the poses, "float32", "float16" or "int16".
+        """
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        self.output_path = output_path
+        self.poses_dtype = poses_dtype
+        self.poses_file = open(os.path.join(output_path, MMAP_POSES_FILES[poses_dtype]), "wb")
+        self.offsets = []
+        self.lengths = []
+        self.file_ids = []
+        self.db_names = []
+        self.n_frames = 0
+        self.feature_size = None
+
+    def write(self, poses, file_id, db_name):
+        """
+        Args:
+            poses: np array of shape (seq_length, feature_size).
+            file_id: File id as stored in the tfrecords, i.e., "<window index>/<db name>/<file name>.pkl".
+            db_name: Name of the database.
+        """
+        assert poses.ndim == 2, "poses must have shape (seq_length, feature_size)"
+        if self.feature_size is None:
+            self.feature_size = poses.shape[1]
+        assert poses.shape[1] == self.feature_size, "All sequences must have the same feature size."
+
+        self.poses_file.write(encode_poses(poses, self.poses_dtype).tobytes())
+        self.offsets.append(self.n_frames)
+        self.lengths.append(poses.shape[0])
+        self.file_ids.append(file_id)
+        self.db_names.append(db_name)
+        self.n_frames += poses.shape[0]
+
+    def close(self):
+        self.poses_file.close()
+        # Same as the sample ids of the tfrecords, i.e., "<db name>/<file id>" without the ".pkl" extension.
+        sample_ids = ["{}/{}".format(db_name, file_id[:-4]) for db_name, file_id in zip(self.db_names, self.file_ids)]
+        np.savez(os.path.join(self.output_path, MMAP_INDEX_FILE),
+                 offsets=np.array(self.offsets, dtype=np.int64),
+                 lengths=np.array(self.lengths, dtype=np.int64),
+                 file_ids=np.array(self.file_ids, dtype=np.str_),
+                 db_names=np.array(self.db_names, dtype=np.str_),
+                 sample_ids=np.array(sample_ids, dtype=np.str_),
+                 feature_size=self.feature_size or 0,
+                 poses_dtype=self.poses_dtype)
+
+
+def merge_mmap_stores(store_dirs, output_path):
+    """
+    Concatenates stores, e.g., written by several processes, into a single store in `output_path`.
+    Args:
+        store_dirs: Directories of the stores in the order of concatenation. They must have the same precision.
+        output_path: Directory of the merged store.
+    """
+    indices = []
+    for store_dir in store_dirs:
+        with np.load(os.path.join(store_dir, MMAP_INDEX_FILE)) as index_file:
+            indices.append(dict(index_file))
+    poses_dtypes = set(str(index["poses_dtype"]) for index in indices)
+    assert len(poses_dtypes) == 1, "stores must have the same precision"
+
+    writer = MmapMotionWriter(output_path, poses_dtypes.pop())
+    for store_dir, index in zip(store_dirs, indices):
+        feature_size = int(index["feature_size"])
+        if feature_size == 0:
+            continue  # empty store
+        if writer.feature_size is None:
+            writer.feature_size = feature_size
+        assert feature_size == writer.feature_size, "All sequences must have the same feature size."
+
+        with open(os.path.join(store_dir, MMAP_POSES_FILES[writer.poses_dtype]), "rb") as poses_file:
+            shutil.copyfileobj(poses_file, writer.poses_file)
+        writer.offsets += [int(offset) + writer.n_frames for offset in index["offsets"]]
+        writer.lengths += [int(length) for length in index["lengths"]]
+        writer.file_ids += [str(file_id) for file_id in index["file_ids"]]
+        writer.db_names += [str(db_name) for db_name in index["db_names"]]
+        writer.n_frames += int(index["lengths"].sum())
+    writer.close()
+
+
+def load_mmap_store(store_dir):
+    """
+    Args:
+        store_dir: Directory of a store written by `MmapMotionWriter`.
+    Returns:
+        Memory-mapped array of shape (total_n_frames, feature_size) in the storage precision, index dictionary. The
+        precision is stored in the index as "poses_dtype".
+    """
+    with np.load(os.path.join(store_dir, MMAP_INDEX_FILE)) as index_file:
+        index = dict(index_file)
+    # Stores written before reduced precisions were supported are float32.
+    index["poses_dtype"] = str(index.get("poses_dtype", C.DATA_POSES_FLOAT32))
+    np_dtype = POSES_NP_DTYPES[index["poses_dtype"]]
+    feature_size = int(index["feature_size"])
+    n_frames = int(index["lengths"].sum())
+    if n_frames == 0:
+        return np.zeros((0, feature_size), dtype=np_dtype), index
+    poses = np.memmap(os.path.join(store_dir, MMAP_POSES_FILES[index["poses_dtype"]]), dtype=np_dtype, mode="r",
+                      shape=(n_frames, feature_size))
+    return poses, index
+
+
+class MmapMotionDataset(Dataset):
+    """
+    Dataset class for motion data stored in a memory-mapped store. Supports the same windowing options as
+    `TFRecordMotionDataset`. Windows are sliced from the memory-mapped array in a generator.
+    """
+    def __init__(self, data_path, meta_data_path, batch_size, shuffle, **kwargs):
+        # Directory of the store. A path in the directory, e.g., the glob pattern of the tfrecord shards, is also
+        # accepted so that both backends can be created from the same path.
+        if not os.path.isdir(data_path):
+            data_path = os.path.dirname(data_path)
+        print("Loading motion data from {}".format(os.path.abspath(data_path)))
+        self.extract_windows_of = kwargs.get("extract_windows_of", 0)
+        self.beginning_index = kwargs.get("beginning_index", 0)
+        self.window_type = kwargs.get("window_type", True)
+        self.windows_per_sequence = kwargs.get("windows_per_sequence", 1)
+        self.length_threshold = kwargs.get("length_threshold", self.extract_windows_of)
+        self.num_parallel_calls = kwargs.get("num_parallel_calls", 16)
+        self.apply_length_filter = kwargs.get("apply_length_filter", True)
+        self.length_bucket_boundaries = kwargs.get("length_bucket_boundaries", None)
+        self.rng = np.random.RandomState(kwargs.get("seed", 1234))
+
+        # A windowed split may only store a window index into the sequences of its "_dynamic" split. Every window is
+        # then treated as a sequence of the store of the "_dynamic" split.
+        window_index = load_window_index(data_path)
+        if window_index is not None:
+            data_path = window_index["sequence_dir"]
+
+        self.poses, index = load_mmap_store(data_path)
+        self.poses_dtype = index["poses_dtype"]
+        self.offsets = index["offsets"]
+        self.lengths = index["lengths"]
+        self.file_ids = [id_.encode("utf-8") for id_ in index["file_ids"]]
+        self.db_names = [name.encode("utf-8") for name in index["db_names"]]
+        self.sample_ids = [id_.encode("utf-8") for id_ in index["sample_ids"]]
+        self.sample_id_to_index = {id_: i for i, id_ in enumerate(self.sample_ids)}
+
+        if window_index is not None:
+            sequence_indices = [self.sample_id_to_index[id_] for id_ in window_index["sequence_ids"]]
+            self.offsets = self.offsets[sequence_indices] + window_index["starts"]
+            self.lengths = np.full(len(sequence_indices), window_index["window_size"], dtype=np.int64)
+            self.file_ids = window_index["file_ids"]
+            self.db_names = window_index["db_names"]
+            self.sample_ids = window_index["sample_ids"]
+            self.sample_id_to_index = {id_: i for i, id_ in enumerate(self.sample_ids)}
+
+        # Indices of the sequences that are used.
+        keys_to_filter = kwargs.get("filter_by_key", None)
+        if keys_to_filter is not None:
+            keys_to_filter = [key.encode("utf-8") if isinstance(key, str) else key for key in keys_to_filter]
+            self.sequence_indices = np.array([self.sample_id_to_index[key] for key in keys_to_filter
+                                              if key in self.sample_id_to_index], dtype=np.int64)
+        else:
+            self.sequence_indices = np.arange(len(self.sample_ids), dtype=np.int64)
+
+        super(MmapMotionDataset, self).__init__(data_path, meta_data_path, batch_size, shuffle, **kwargs)
+
+    def load_meta_data(self, meta_data_path):
+        """
+        Loads meta-data file given the path. It is assumed to be in numpy.
+        Args:
+            meta_data_path:
+        Returns:
+            Meta-data dictionary or False if it is not found.
+        """
+        if not meta_data_path or not os.path.exists(meta_data_path):
+            print("Meta-data not found.")
+            return False
+        else:
+            return np.load(meta_data_path, allow_pickle=True)['stats'].tolist()
+
+    def get_poses(self, sample_id):
+        """
+        Args:
+            sample_id: Sample id as str or bytes.
+        Returns:
+            float32 poses of the sequence with shape (seq_length, feature_size). Memory-mapped if stored as float32.
+        """
+        idx = self.sample_id_to_index[sample_id.encode("utf-8") if isinstance(sample_id, str) else sample_id]
+        poses = self.poses[self.offsets[idx]:self.offsets[idx] + self.lengths[idx]]
+        return poses if self.poses_dtype == C.DATA_POSES_FLOAT32 else decode_poses(poses, self.poses_dtype)
+
+    def get_windows(self):
+        """
+        Determines the windows of an epoch. Random windows are drawn again at every call.
+        Returns:
+            Sequence indices, start and end frames of the windows.
+        """
+        indices = self.sequence_indices[self.worker_index::self.num_workers]
+        lengths = self.lengths[indices]
+        window_len = self.extract_windows_of
+
+        if window_len <= 0:
+            starts = np.zeros_like(lengths)
+        else:
+            if self.apply_length_filter:
+                indices = indices[lengths >= self.length_threshold]
+                lengths = self.lengths[indices]
+
+            if self.window_type == C.DATA_WINDOW_BEGINNING:
+                starts = np.minimum(self.beginning_index, lengths)
+            elif self.window_type == C.DATA_WINDOW_CENTER:
+                starts = np.maximum(lengths//2 - window_len//2, 0)
+            elif self.window_type == C.DATA_WINDOW_RANDOM and self.windows_per_sequence > 1:
+                indices = np.repeat(indices, self.windows_per_sequence)
+                lengths = self.lengths[indices]
+                starts = self.rng.randint(0, np.maximum(lengths - window_len + 1, 1))
+            elif self.window_type == C.DATA_WINDOW_RANDOM and self.windows_per_sequence == 0:
+                # Tile the sequence with non-overlapping windows starting at a random offset.
+                indices = indices[lengths >= window_len]
+                tiled_indices, starts = [], []
+                for idx in indices:
+                    max_start = self.lengths[idx] - window_len
+                    offset = self.rng.randint(0, min(window_len, max_start + 1))
+                    seq_starts = np.arange(offset, max_start + 1, window_len)
+                    tiled_indices.append(np.full_like(seq_starts, idx))
+                    starts.append(seq_starts)
+                indices = np.concatenate(tiled_indices) if tiled_indices else np.zeros([0], dtype=np.int64)
+                starts = np.concatenate(starts) if starts else np.zeros([0], dtype=np.int64)
+                lengths = self.lengths[indices]
+            elif self.window_type == C.DATA_WINDOW_RANDOM:
+                starts = self.rng.randint(0, np.maximum(lengths - window_len + 1, 1))
+            else:
+                raise Exception("Unknown window type.")
+
+        ends = lengths if window_len <= 0 else np.minimum(starts + window_len, lengths)
+        if self.shuffle:
+            permutation = self.rng.permutation(len(indices))
+            indices, starts, ends = indices[permutation], starts[permutation], ends[permutation]
+        return indices, starts, ends
+
+    def get_num_samples(self):
+        """
+        Returns:
+            Number of windows of an epoch read by this process or None if sequences are tiled with random windows.
+        """
+        if self.extract_windows_of > 0 and self.window_type == C.DATA_WINDOW_RANDOM and self.windows_per_sequence == 0:
+            return None
+        lengths = self.lengths[self.sequence_indices[self.worker_index::self.num_workers]]
+        if self.extract_windows_of > 0 and self.apply_length_filter:
+            lengths = lengths[lengths >= self.length_threshold]
+        if self.extract_windows_of > 0 and self.window_type == C.DATA_WINDOW_RANDOM and self.windows_per_sequence > 1:
+            return len(lengths)*self.windows_per_sequence
+        return len(lengths)
+
+    def tf_data_transformations(self):
+        """
+        Creates a tf.data.Dataset from a generator slicing the windows of an epoch from the memory-mapped poses. The
+        generator is called again whenever the iterator is initialized.
+        """
+        feature_size = self.poses.shape[1]
+        output_types = {"poses": tf.float32, "shape": tf.int64, "file_id": tf.string, "db_name": tf.string,
+                        "sample_id": tf.string}
+        output_shapes = {"poses": tf.TensorShape([None, feature_size]), "shape": tf.TensorShape([2]),
+                         "file_id": tf.TensorShape([]), "db_name": tf.TensorShape([]),
+                         "sample_id": tf.TensorShape([])}
+        self.tf_data = tf.data.Dataset.from_generator(functools.partial(self.__generate_samples),
+                                                      output_types=output_types,
+                                                      output_shapes=output_shapes)
+        # Windows are sliced by the generator, hence the poses are converted per window.
+        if self.convert_data_type:
+            self.tf_data = self.tf_data.map(functools.partial(self.convert_poses),
+                                            num_parallel_calls=self.num_parallel_calls)
+        self.tf_data = self.tf_data.prefetch(self.batch_size*10)
+
+    def tf_data_normalization(self):
+        # Applies normalization. The feature size is already known from the generator.
+        if self.normalize:
+            self.tf_data = self.tf_data.map(
+                functools.partial(self.normalization_func, key="poses"),
+                num_parallel_calls=self.num_parallel_calls)
+
+    def tf_data_to_model(self):
+        # Converts the data into the format that a model expects. Creates input, target, sequence_length, etc.
+        self.tf_data = self.tf_data.map(functools.partial(self.__to_model_inputs), num_parallel_calls=self.num_parallel_calls)
+        if self.length_bucket_boundaries:
+            self.tf_data = self.tf_data.apply(tf.data.experimental.bucket_by_sequence_length(
+                element_length_func=lambda sample: sample[C.BATCH_SEQ_LEN],
+                bucket_boundaries=self.length_bucket_boundaries,
+                bucket_batch_sizes=[self.batch_size]*(len(self.length_bucket_boundaries) + 1),
+                padded_shapes=self.tf_data.output_shapes))
+        else:
+            self.tf_data = self.tf_data.padded_batch(self.batch_size, padded_shapes=self.tf_data.output_shapes)
+        self.tf_data = self.tf_data.prefetch(2)
+        if tf.test.is_gpu_available():
+            self.tf_data = self.tf_data.apply(tf.data.experimental.prefetch_to_device('/device:GPU:0'))
+
+    def create_meta_data(self):
+        """We assume meta data always exists. Use preprocessing/compute_stats.py to create it for existing data."""
+        raise RuntimeError("We do not create here. Use preprocessing/compute_stats.py.")
+
+    def data_summary(self):
+        pass
+
+    def __generate_samples(self):
+        feature_size = self.poses.shape[1]
+        indices, starts, ends = self.get_windows()
+        for idx, start, end in zip(indices, starts, ends):
+            offset = self.offsets[idx]
+            yield {"poses": decode_poses(self.poses[offset + start:offset + end], self.poses_dtype),
+                   "shape": np.array([end - start, feature_size], dtype=np.int64),
+                   "file_id": self.file_ids[idx],
+                   "db_name": self.db_names[idx],
+                   "sample_id": self.sample_ids[idx]}
+
+    def __to_model_inputs(self, tf_sample_dict):
+        """
+        Transforms a sample into a more general sample representation where we use global keys to represent the
+        required fields by the models.
+        Args:
+            tf_sample_dict:
+        Returns:
+        """
+        model_sample = dict()
+        model_sample[C.BATCH_SEQ_LEN] = tf_sample_dict["shape"][0]
+        model_sample[C.BATCH_INPUT] = tf_sample_dict["poses"]
+        model_sample[C.BATCH_TARGET] = tf_sample_dict["poses"]
+        model_sample[C.BATCH_ID] = tf_sample_dict["sample_id"]
+        return model_sample
@@ -0,0 +1,115 @@
+"""
+
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Storage precision of the poses in raw tfrecords and memory-mapped stores. Poses are stored as little-endian float32,
+float16 or int16 values and always decoded to float32. int16 is a fixed-point encoding of values in [-1, 1] with a
+resolution of 1/32767, hence it is only suited for rotation matrices and quaternions.
+
+In raw tfrecords, the feature name determines the precision, i.e., "poses_raw" (float32), "poses_raw_f16" or
+"poses_raw_i16".
+"""
+import numpy as np
+import tensorflow as tf
+
+from common.constants import Constants as C
+
+POSES_NP_DTYPES = {C.DATA_POSES_FLOAT32: '<f4', C.DATA_POSES_FLOAT16: '<f2', C.DATA_POSES_INT16: '<i2'}
+POSES_TF_DTYPES = {C.DATA_POSES_FLOAT32: tf.float32, C.DATA_POSES_FLOAT16: tf.float16, C.DATA_POSES_INT16: tf.int16}
+POSES_RAW_KEYS = {C.DATA_POSES_FLOAT32: 'poses_raw', C.DATA_POSES_FLOAT16: 'poses_raw_f16',
+                  C.DATA_POSES_INT16: 'poses_raw_i16'}
+INT16_SCALE = 32767.0
+
+
+def encode_poses(poses, poses_dtype=C.DATA_POSES_FLOAT32):
+    """
+    Args:
+        poses: np array of float poses.
+        poses_dtype: Storage precision.
+    Returns:
+        np array of the same shape in the little-endian storage dtype.
+    """
+    if poses_dtype == C.DATA_POSES_INT16:
+        # Entries of rotation matrices and quaternions may exceed [-1, 1] by rounding errors only.
+        if np.abs(poses).max(initial=0.0) > 1.0 + 1e-3:
+            raise Exception("int16 poses must be in [-1, 1]. Use float16 for this representation.")
+        poses = np.round(np.clip(poses, -1.0, 1.0)*INT16_SCALE)
+    elif poses_dtype not in POSES_NP_DTYPES:
+        raise Exception("Unknown poses dtype.")
+    return np.ascontiguousarray(poses, dtype=POSES_NP_DTYPES[poses_dtype])
+
+
+def decode_poses(poses, poses_dtype=C.DATA_POSES_FLOAT32):
+    """
+    Args:
+        poses: np array in the storage dtype.
+        poses_dtype: Storage precision.
+    Returns:
+        float32 np array of the same shape.
+    """
+    poses = np.asarray(poses, dtype=np.float32)
+    if poses_dtype == C.DATA_POSES_INT16:
+        poses = poses / np.float32(INT16_SCALE)
+    return poses
+
+
+def decode_poses_tf(poses_raw, poses_dtype=C.DATA_POSES_FLOAT32):
+    """
+    Args:
+        poses_raw: Raw bytes of the poses as a TF string tensor.
+        poses_dtype: Storage precision.
+    Returns:
+        Flat float32 TF tensor.
+    """
+    poses = tf.io.decode_raw(poses_raw, POSES_TF_DTYPES[poses_dtype], little_endian=True)
+    if poses_dtype == C.DATA_POSES_FLOAT32:
+        return poses
+    poses = tf.cast(poses, tf.float32)
+    if poses_dtype == C.DATA_POSES_INT16:
+        poses = poses / INT16_SCALE
+    return poses
+
+
+def get_example_poses_dtype(feature):
+    """
+    Args:
+        feature: Feature map of a raw tf.train.Example.
+    Returns:
+        Storage precision of the poses or None if the example is in the legacy layout.
+    """
+    for poses_dtype, key in POSES_RAW_KEYS.items():
+        if key in feature:
+            return poses_dtype
+    return None
+
+
+def decode_example(serialized):
+    """
+    Decodes a serialized tf.train.Example of either layout and any precision.
+    Returns:
+        float32 poses with shape (seq_length, feature_size), file_id, db_name
+    """
+    feature = tf.train.Example.FromString(serialized).features.feature
+    shape = list(feature["shape"].int64_list.value)
+    poses_dtype = get_example_poses_dtype(feature)
+    if poses_dtype is not None:
+        poses = np.frombuffer(feature[POSES_RAW_KEYS[poses_dtype]].bytes_list.value[0],
+                              dtype=POSES_NP_DTYPES[poses_dtype])
+        poses = decode_poses(poses, poses_dtype)
+    else:
+        poses = np.array(feature["poses"].float_list.value, dtype=np.float32)
+    file_id = feature["file_id"].bytes_list.value[0].decode("utf-8")
+    db_name = feature["db_name"].bytes_list.value[0].decode("utf-8")
+    return np.reshape(poses, shape), file_id, db_name
@@ -0,0 +1,174 @@
+"""
+
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Index of the records in the tfrecord shards of a split. For every sample id, `sample_index.npz` stores the shard, the
+byte offset of the record, the length of the serialized example and the number of frames, so that single records can
+be read directly instead of parsing the whole split.
+
+`shards.json` summarizes the index per shard, i.e., the number of records, frames and bytes and the length of the
+shortest sequence, so that readers know the size of an epoch up front and can split the shards evenly.
+
+A tfrecord is stored as
+    uint64 length, uint32 masked crc32 of length, byte data[length], uint32 masked crc32 of data
+"""
+import os
+import json
+import struct
+import numpy as np
+
+SAMPLE_INDEX_FILE = "sample_index.npz"
+SHARD_MANIFEST_FILE = "shards.json"
+TFRECORD_HEADER_BYTES = 12
+TFRECORD_FOOTER_BYTES = 4
+
+
+class SampleIndexWriter(object):
+    """
+    Keeps track of the byte offsets of the records written into the shards of a split.
+    """
+    def __init__(self, shard_paths):
+        """
+        Args:
+            shard_paths: Paths of the shards in the order of the writers.
+        """
+        self.shards = [os.path.basename(path) for path in shard_paths]
+        self.shard_sizes = [0]*len(shard_paths)
+        self.sample_ids = []
+        self.shard_indices = []
+        self.offsets = []
+        self.lengths = []
+        self.n_frames = []
+
+    def add(self, shard_idx, sample_id, n_bytes, n_frames=0):
+        """
+        Args:
+            shard_idx: Index of the shard the record is appended to.
+            sample_id: Sample id of the record.
+            n_bytes: Length of the serialized example.
+            n_frames: Number of frames of the sequence.
+        """
+        self.sample_ids.append(sample_id)
+        self.shard_indices.append(shard_idx)
+        self.offsets.append(self.shard_sizes[shard_idx])
+        self.lengths.append(n_bytes)
+        self.n_frames.append(int(n_frames))
+        self.shard_sizes[shard_idx] += TFRECORD_HEADER_BYTES + n_bytes + TFRECORD_FOOTER_BYTES
+
+    def get_smallest_shards(self):
+        """
+        Returns:
+            Indices of the shards with the fewest bytes written so far.
+        """
+        min_size = min(self.shard_sizes)
+        return [shard_idx for shard_idx, size in enumerate(self.shard_sizes) if size == min_size]
+
+    def merge(self, other):
+        """
+        Appends the records of an index of other shards of the same split, e.g., written by another process.
+        """
+        assert not set(self.shards).intersection(other.shards), "shards of merged indices must be disjoint"
+        shard_offset = len(self.shards)
+        self.shards += other.shards
+        self.shard_sizes += other.shard_sizes
+        self.sample_ids += other.sample_ids
+        self.shard_indices += [shard_idx + shard_offset for shard_idx in other.shard_indices]
+        self.offsets += other.offsets
+        self.lengths += other.lengths
+        self.n_frames += other.n_frames
+
+    def save(self, output_path):
+        """
+        Writes the index and the shard manifest.
+        """
+        np.savez(os.path.join(output_path, SAMPLE_INDEX_FILE),
+                 shards=np.array(self.shards, dtype=np.str_),
+                 sample_ids=np.array(self.sample_ids, dtype=np.str_),
+                 shard_indices=np.array(self.shard_indices, dtype=np.int64),
+                 offsets=np.array(self.offsets, dtype=np.int64),
+                 lengths=np.array(self.lengths, dtype=np.int64),
+                 n_frames=np.array(self.n_frames, dtype=np.int64))
+
+        shards = [{"shard": shard, "records": 0, "frames": 0, "bytes": size, "min_frames": None}
+                  for shard, size in zip(self.shards, self.shard_sizes)]
+        for shard_idx, n_frames in zip(self.shard_indices, self.n_frames):
+            shards[shard_idx]["records"] += 1
+            shards[shard_idx]["frames"] += n_frames
+            if shards[shard_idx]["min_frames"] is None or n_frames < shards[shard_idx]["min_frames"]:
+                shards[shard_idx]["min_frames"] = n_frames
+        manifest = {"records": len(self.sample_ids), "frames": sum(self.n_frames), "bytes": sum(self.shard_sizes),
+                    "shards": shards}
+        with open(os.path.join(output_path, SHARD_MANIFEST_FILE), "w") as f_handle:
+            json.dump(manifest, f_handle, indent=2)
+
+
+def load_sample_index(split_dir):
+    """
+    Args:
+        split_dir: Directory of the tfrecord shards.
+    Returns:
+        A dict mapping sample ids (bytes) to (shard path, byte offset, length, number of frames) or None if the split is
+        not indexed. The number of frames is 0 for indices written before it was stored.
+    """
+    index_path = os.path.join(split_dir, SAMPLE_INDEX_FILE)
+    if not os.path.exists(index_path):
+        return None
+    with np.load(index_path) as index:
+        shards = [os.path.join(split_dir, shard) for shard in index["shards"]]
+        n_frames = index["n_frames"] if "n_frames" in index else np.zeros_like(index["lengths"])
+        return {sample_id.encode("utf-8"): (shards[shard_idx], int(offset), int(length), int(frames))
+                for sample_id, shard_idx, offset, length, frames in zip(index["sample_ids"], index["shard_indices"],
+                                                                        index["offsets"], index["lengths"], n_frames)}
+
+
+def load_shard_manifest(split_dir):
+    """
+    Args:
+        split_dir: Directory of the tfrecord shards.
+    Returns:
+        The shard manifest written with the sample index, or None if the split has none. "shards" lists per shard its
+        file name, the number of records, frames and bytes and the minimum number of frames of a record.
+    """
+    manifest_path = os.path.join(split_dir, SHARD_MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f_handle:
+        return json.load(f_handle)
+
+
+def read_record(file_handle, offset, length):
+    """
+    Reads the serialized example of the record starting at `offset`.
+    """
+    file_handle.seek(offset + TFRECORD_HEADER_BYTES)
+    return file_handle.read(length)
+
+
+def scan_records(file_handle):
+    """
+    Iterates over the records of a tfrecord file without verifying the checksums.
+    Returns:
+        Generator of (byte offset, serialized example).
+    """
+    offset = 0
+    while True:
+        header = file_handle.read(TFRECORD_HEADER_BYTES)
+        if len(header) < TFRECORD_HEADER_BYTES:
+            return
+        length = struct.unpack("<Q", header[:8])[0]
+        data = file_handle.read(length)
+        file_handle.read(TFRECORD_FOOTER_BYTES)
+        yield offset, data
+        offset += TFRECORD_HEADER_BYTES + length + TFRECORD_FOOTER_BYTES
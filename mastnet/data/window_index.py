@@ -0,0 +1,109 @@
+"""
+
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Index of the windows of a windowed split. Instead of storing the windows of the validation and test splits as records,
+`window_index.npz` stores for every window the sample id of its sequence in the "_dynamic" split, the start frame and
+the file id of the window, i.e., "<window index>/<db name>/<file name>.pkl". The data loaders extract the windows from
+the sequences, which yields the same samples and sample ids as the stored windows.
+"""
+import os
+import numpy as np
+
+WINDOW_INDEX_FILE = "window_index.npz"
+
+
+class WindowIndexWriter(object):
+    """
+    Keeps track of the windows extracted from the sequences of a split.
+    """
+    def __init__(self, sequence_dir, window_size):
+        """
+        Args:
+            sequence_dir: Directory of the split storing the full sequences. It is expected next to the index.
+            window_size: Number of frames of a window.
+        """
+        self.sequence_dir = os.path.basename(os.path.normpath(sequence_dir))
+        self.window_size = window_size
+        self.sequence_ids = []
+        self.file_ids = []
+        self.db_names = []
+        self.starts = []
+
+    def add(self, sequence_id, file_id, db_name, start):
+        """
+        Args:
+            sequence_id: Sample id of the sequence in `sequence_dir`.
+            file_id: File id of the window.
+            db_name: Name of the database.
+            start: Index of the first frame of the window in the sequence.
+        """
+        self.sequence_ids.append(sequence_id)
+        self.file_ids.append(file_id)
+        self.db_names.append(db_name)
+        self.starts.append(start)
+
+    def merge(self, other):
+        """
+        Appends the windows of another index of the same split, e.g., written by another process.
+        """
+        assert (self.sequence_dir, self.window_size) == (other.sequence_dir, other.window_size)
+        self.sequence_ids += other.sequence_ids
+        self.file_ids += other.file_ids
+        self.db_names += other.db_names
+        self.starts += other.starts
+
+    def save(self, output_path):
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        np.savez(os.path.join(output_path, WINDOW_INDEX_FILE),
+                 sequence_dir=self.sequence_dir,
+                 window_size=self.window_size,
+                 sequence_ids=np.array(self.sequence_ids, dtype=np.str_),
+                 file_ids=np.array(self.file_ids, dtype=np.str_),
+                 db_names=np.array(self.db_names, dtype=np.str_),
+                 starts=np.array(self.starts, dtype=np.int64))
+
+
+def load_window_index(split_dir, keys_to_filter=None):
+    """
+    Args:
+        split_dir: Directory of the windowed split.
+        keys_to_filter: Only the windows with these sample ids (bytes) are kept if given.
+    Returns:
+        A dict with the absolute path of the sequence directory ("sequence_dir"), the window size and per window the
+        sequence id, file id, db name (all bytes), sample id (bytes) and start frame. None if the split is not indexed.
+    """
+    index_path = os.path.join(split_dir, WINDOW_INDEX_FILE)
+    if not os.path.exists(index_path):
+        return None
+    with np.load(index_path) as index_file:
+        index = {key: index_file[key] for key in ["sequence_ids", "file_ids", "db_names", "starts"]}
+        sequence_dir = os.path.join(os.path.dirname(os.path.normpath(split_dir)), str(index_file["sequence_dir"]))
+        window_size = int(index_file["window_size"])
+
+    for key in ["sequence_ids", "file_ids", "db_names"]:
+        index[key] = [value.encode("utf-8") for value in index[key]]
+    # Same as the sample ids of the tfrecords, i.e., "<db name>/<file id>" without the ".pkl" extension.
+    index["sample_ids"] = [db_name + b"/" + file_id[:-4] for db_name, file_id in zip(index["db_names"],
+                                                                                    index["file_ids"])]
+    if keys_to_filter is not None:
+        keys_to_filter = set(keys_to_filter)
+        rows = [i for i, sample_id in enumerate(index["sample_ids"]) if sample_id in keys_to_filter]
+        index = {key: [values[i] for i in rows] for key, values in index.items()}
+    index["starts"] = np.array(index["starts"], dtype=np.int64)
+    index["sequence_dir"] = sequence_dir
+    index["window_size"] = window_size
+    return index
@@ -22,6 +22,7 @@ import argparse
 import numpy as np
 import tensorflow as tf
 
+from spl.data.base_dataset import get_stats_file
 from spl.data.amass_tf import TFRecordMotionDataset
 from spl.model.zero_velocity import ZeroVelocityBaseline
 from spl.model.rnn import RNN
@@ -31,6 +32,8 @@ from spl.model.transformer_h36m import Transformer2d as Transformer2dH36M
 from spl.model.vanilla import Transformer1d
 
 from common.constants import Constants as C
+import spl.util.tf_utils as model_utils
+from spl.util.attention_store import AttentionStore
 from visualization.render import Visualizer
 from visualization.fk import H36MForwardKinematics
 from visualization.fk import SMPLForwardKinematics
@@ -122,7 +125,7 @@ def load_latest_checkpoint(session, saver, experiment_dir):
         # Check if the specific checkpoint exists
         ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
         print("Loading model checkpoint {0}".format(ckpt_name))
-        saver.restore(session, ckpt.model_checkpoint_path)
+        model_utils.restore_checkpoint(session, saver, ckpt.model_checkpoint_path)
     else:
         raise (ValueError, "Checkpoint {0} does not seem to exist".format(ckpt.model_checkpoint_path))
 
@@ -159,20 +162,28 @@ def create_and_restore_model(session, experiment_dir, data_dir, config, dynamic_
         filter_sample_keys = sample_keys
         beginning_index = 0
         window_type = C.DATA_WINDOW_CENTER
+        # Sequences can be shorter than the window.
+        length_bucket_boundaries = C.DATA_LENGTH_BUCKET_BOUNDARIES
     else:  # For quantitative evaluation.
         data_split = "test"
         filter_sample_keys = None
+        length_bucket_boundaries = None
         default_seed_len = 120
         if config["use_h36m"]:
             default_seed_len = 50
         beginning_index = default_seed_len - config["source_seq_len"]
         window_type = C.DATA_WINDOW_BEGINNING
 
-    test_data_path = os.path.join(data_dir, config["data_type"], data_split, "amass-?????-of-?????")
-    meta_data_path = os.path.join(data_dir, config["data_type"], "training", "stats.npz")
+    # Canonical data is stored as rotation matrices and converted to data_type in the data pipeline.
+    stored_data_type = C.ROT_MATRIX if config.get("canonical_data", False) else config["data_type"]
+    test_data_path = os.path.join(data_dir, stored_data_type, data_split, "amass-?????-of-?????")
+    meta_data_path = os.path.join(data_dir, stored_data_type, "training", get_stats_file(stored_data_type,
+                                                                                           config["data_type"]))
     print("Loading test data from " + test_data_path)
     
     # Create dataset.
+    # If the normalization is fused into the model, the dataset passes unnormalized poses.
+    normalize = not config["no_normalization"] and not config.get("fused_normalization", False)
     with tf.name_scope("test_data"):
         window_length = config["source_seq_len"] + config["target_seq_len"]
         test_data = TFRecordMotionDataset(data_path=test_data_path,
@@ -182,12 +193,15 @@ def create_and_restore_model(session, experiment_dir, data_dir, config, dynamic_
                                           extract_windows_of=window_length,
                                           window_type=window_type,
                                           num_parallel_calls=4,
-                                          normalize=not config["no_normalization"],
+                                          normalize=normalize,
+                                          stored_data_type=stored_data_type,
+                                          data_type=config["data_type"],
                                           normalization_dim=config.get("normalization_dim", "channel"),
                                           use_std_norm=config.get("use_std_norm", False),
                                           beginning_index=beginning_index,
                                           filter_by_key=filter_sample_keys,
-                                          apply_length_filter=False)
+                                          apply_length_filter=False,
+                                          length_bucket_boundaries=length_bucket_boundaries)
         test_pl = test_data.get_tf_samples()
 
     # Create model.
@@ -196,7 +210,8 @@ def create_and_restore_model(session, experiment_dir, data_dir, config, dynamic_
             config=config,
             data_pl=test_pl,
             mode=C.SAMPLE,
-            reuse=False)
+            reuse=False,
+            normalization_stats=test_data.get_normalization_stats())
         test_model.build_graph()
         test_model.summary_routines()
 
@@ -208,16 +223,18 @@ def create_and_restore_model(session, experiment_dir, data_dir, config, dynamic_
     # Restore model parameters.
     saver = tf.train.Saver(tf.global_variables(), max_to_keep=1, save_relative_paths=True)
     load_latest_checkpoint(session, saver, experiment_dir)
+    # Sample id lookup table of the data filter.
+    session.run(tf.tables_initializer())
     return test_model, test_data
 
 
 def evaluate_model(session, _eval_model, _eval_iter, _metrics_engine,
-                   undo_normalization_fn, _return_results=False):
+                   undo_normalization_fn, _return_results=False, _attention_store=None):
     # make a full pass on the validation or test dataset and compute the metrics
+    # captured attention weights are written into _attention_store (see spl.util.attention_store)
     n_batches = 0
     _eval_result = dict()
     _metrics_engine.reset()
-    _attention_weights = dict()
     session.run(_eval_iter.initializer)
 
     using_attention_model = False
@@ -251,14 +268,9 @@ def evaluate_model(session, _eval_model, _eval_iter, _metrics_engine,
                         t["poses"][k],
                         s["poses"][k])
 
-                if using_attention_model:
-                    for num_frame in [0, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55]:
-                        if num_frame <= prediction.shape[1]:
-                            for i in range(prediction.shape[0]):
-                                if num_frame == 0:
-                                    _attention_weights[data_id[i].decode("utf-8")] = [[attention[num_frame]['temporal'][i], attention[num_frame]['spatial'][i]]]
-                                else:
-                                    _attention_weights[data_id[i].decode("utf-8")] += [[attention[num_frame]['temporal'][i], attention[num_frame]['spatial'][i]]]
+                # Transformer2d returns None if attention capture is off. Transformer2dH36M does not support it.
+                if _attention_store is not None and isinstance(attention, dict):
+                    _attention_store.write(data_id, attention)
                 n_batches += 1
             
             if n_batches % 5 == 0:
@@ -269,7 +281,7 @@ def evaluate_model(session, _eval_model, _eval_iter, _metrics_engine,
     print("Evaluated on " + str(n_batches) + " batches.")
         # finalize the computation of the metrics
     final_metrics = _metrics_engine.get_final_metrics()
-    return final_metrics, _eval_result, _attention_weights
+    return final_metrics, _eval_result
 
 def visualize_temporal(mat, save_path, num_frame):
     # mat: (num_layers, num_joints, num_heads, seq_len)
@@ -388,13 +400,21 @@ def evaluate(session, test_model, test_data, args, eval_dir, use_h36m):
             model_identifier=exp_id,
             static_values=static_values)
 
+    attention_store = None
+    if using_attention_model and getattr(test_model, "attention_capture", None) is not None:
+        attention_store = AttentionStore(os.path.join(eval_dir, "attention"), test_model.attention_capture)
+
     print("Evaluating test set...")
-    test_metrics, eval_result, attention_weights = evaluate_model(session,
-                                                                  test_model,
-                                                                  test_iter,
-                                                                  metrics_engine,
-                                                                  test_data.unnormalization_func,
-                                                                  _return_results=True)
+    test_metrics, eval_result = evaluate_model(session,
+                                               test_model,
+                                               test_iter,
+                                               metrics_engine,
+                                               test_data.unnormalization_func,
+                                               _return_results=True,
+                                               _attention_store=attention_store)
+    if attention_store is not None:
+        attention_store.close()
+        print("Attention weights are saved in " + attention_store.store_dir)
 
     print(metrics_engine.get_summary_string_all(test_metrics, target_lengths,
                                                 pck_thresholds))
@@ -443,10 +463,11 @@ def evaluate(session, test_model, test_data, args, eval_dir, use_h36m):
                 
                 print(out_dir + ' visualizing.')
 
-                # if using_attention_model:
-                #     for num_frame in range(12):
-                #         visualize_temporal(attention_weights[k][num_frame][0], out_dir, num_frame*5)
-                #         visualize_spatial(attention_weights[k][num_frame][1], out_dir, num_frame*5)
+                # if attention_store is not None:
+                #     attention_ids, attention_weights = load_attention_store(attention_store.store_dir)
+                #     for num_frame in range(attention_weights['temporal'].shape[1]):
+                #         visualize_temporal(attention_weights['temporal'][attention_ids.index(k), num_frame], out_dir, num_frame*5)
+                #         visualize_spatial(attention_weights['spatial'][attention_ids.index(k), num_frame], out_dir, num_frame*5)
 
                 prediction, target, seed = eval_result[k]
 
@@ -521,6 +542,9 @@ if __name__ == '__main__':
                         help="Create a Google sheet entry if available.")
     parser.add_argument('--new_experiment_id', required=False, default=None,
                         type=str, help="Not used. only for leonhard.")
+    parser.add_argument('--attention_capture', required=False, default=C.ATTN_CAPTURE_OFF, type=str,
+                        help="Attention weights of transformer2d to save in float16: off, last_layer or a selection "
+                             "of layers and predicted frames, i.e., layers=0,7/frames=0,5,10.")
 
     _args = parser.parse_args()
     if ',' in _args.model_id:
@@ -545,6 +569,7 @@ if __name__ == '__main__':
             tf.reset_default_graph()
             _config = json.load(open(os.path.abspath(os.path.join(_experiment_dir, 'config.json')), 'r'))
             _config["experiment_dir"] = _experiment_dir
+            _config["attention_capture"] = _args.attention_capture
 
             if _args.seq_length_out is not None and _config["target_seq_len"] != _args.seq_length_out:
                 print("!!! Prediction length for training and sampling is different !!!")
@@ -22,6 +22,7 @@ import argparse
 import numpy as np
 import tensorflow as tf
 
+from spl.data.base_dataset import get_stats_file
 from spl.data.amass_tf import TFRecordMotionDataset
 from spl.model.zero_velocity import ZeroVelocityBaseline
 from spl.model.rnn import RNN
@@ -30,6 +31,7 @@ from spl.model.transformer import Transformer2d
 from spl.model.vanilla import Transformer1d
 
 from common.constants import Constants as C
+import spl.util.tf_utils as model_utils
 from visualization.fk import SMPLForwardKinematics
 from common.conversions import get_closest_rotmat, sparse_to_full, is_valid_rotmat
 
@@ -37,6 +39,7 @@ from metrics.distribution_metrics import power_spectrum
 from metrics.distribution_metrics import ps_entropy
 from metrics.distribution_metrics import ps_kld
 from metrics.distribution_metrics import compute_npss
+from metrics.distribution_metrics import PowerSpectrumAccumulator
 
 from metrics.motion_metrics import MetricsEngine
 import matplotlib.pyplot as plt
@@ -120,7 +123,7 @@ def load_latest_checkpoint(session, saver, experiment_dir):
         # Check if the specific checkpoint exists
         ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
         print("Loading model checkpoint {0}".format(ckpt_name))
-        saver.restore(session, ckpt.model_checkpoint_path)
+        model_utils.restore_checkpoint(session, saver, ckpt.model_checkpoint_path)
     else:
         raise (ValueError, "Checkpoint {0} does not seem to exist".format(ckpt.model_checkpoint_path))
 
@@ -141,10 +144,11 @@ def get_model_cls(model_type):
 
 
 def create_training_data(data_dir, config, seq_len):
-    train_data_path = os.path.join(data_dir, config["data_type"], "training",
+    stored_data_type = C.ROT_MATRIX if config.get("canonical_data", False) else config["data_type"]
+    train_data_path = os.path.join(data_dir, stored_data_type, "training",
                                    "amass-?????-of-?????")
-    meta_data_path = os.path.join(data_dir, config["data_type"], "training",
-                                  "stats.npz")
+    meta_data_path = os.path.join(data_dir, stored_data_type, "training",
+                                  get_stats_file(stored_data_type, config["data_type"]))
     # Create dataset.
     with tf.name_scope("training_data"):
         train_data = TFRecordMotionDataset(data_path=train_data_path,
@@ -154,7 +158,9 @@ def create_training_data(data_dir, config, seq_len):
                                            extract_windows_of=seq_len,
                                            window_type=C.DATA_WINDOW_RANDOM,
                                            num_parallel_calls=2,
-                                           normalize=False)
+                                           normalize=False,
+                                           stored_data_type=stored_data_type,
+                                           data_type=config["data_type"])
         return train_data
 
 
@@ -169,18 +175,24 @@ def create_and_restore_model(session, experiment_dir, data_dir, config, dynamic_
             filter_sample_keys = None
         beginning_index = 0
         window_type = C.DATA_WINDOW_CENTER
+        # Sequences can be shorter than the window.
+        length_bucket_boundaries = C.DATA_LENGTH_BUCKET_BOUNDARIES
     else:  # For quantitative evaluation.
         data_split = "test"
         filter_sample_keys = None
+        length_bucket_boundaries = None
         default_seed_len = 120
         if config["use_h36m"]:
             default_seed_len = 50
         beginning_index = default_seed_len - config["source_seq_len"]
         window_type = C.DATA_WINDOW_BEGINNING
 
-    train_data_path = os.path.join(data_dir, config["data_type"], "training", "amass-?????-of-?????")
-    test_data_path = os.path.join(data_dir, config["data_type"], data_split, "amass-?????-of-?????")
-    meta_data_path = os.path.join(data_dir, config["data_type"], "training", "stats.npz")
+    # Canonical data is stored as rotation matrices and converted to data_type in the data pipeline.
+    stored_data_type = C.ROT_MATRIX if config.get("canonical_data", False) else config["data_type"]
+    train_data_path = os.path.join(data_dir, stored_data_type, "training", "amass-?????-of-?????")
+    test_data_path = os.path.join(data_dir, stored_data_type, data_split, "amass-?????-of-?????")
+    meta_data_path = os.path.join(data_dir, stored_data_type, "training", get_stats_file(stored_data_type,
+                                                                                           config["data_type"]))
     print("Loading test data from " + test_data_path)
     
     # Create dataset.
@@ -196,6 +208,8 @@ def create_and_restore_model(session, experiment_dir, data_dir, config, dynamic_
     #                                        normalize=False)
     train_data = None
     
+    # If the normalization is fused into the model, the dataset passes unnormalized poses.
+    normalize = not config["no_normalization"] and not config.get("fused_normalization", False)
     with tf.name_scope("test_data"):
         window_length = config["source_seq_len"] + config["target_seq_len"]
         test_data = TFRecordMotionDataset(data_path=test_data_path,
@@ -205,12 +219,15 @@ def create_and_restore_model(session, experiment_dir, data_dir, config, dynamic_
                                           extract_windows_of=window_length,
                                           window_type=window_type,
                                           num_parallel_calls=2,
-                                          normalize=not config["no_normalization"],
+                                          normalize=normalize,
+                                          stored_data_type=stored_data_type,
+                                          data_type=config["data_type"],
                                           normalization_dim=config.get("normalization_dim", "channel"),
                                           use_std_norm=config.get("use_std_norm", False),
                                           beginning_index=beginning_index,
                                           filter_by_key=filter_sample_keys,
-                                          apply_length_filter=False)
+                                          apply_length_filter=False,
+                                          length_bucket_boundaries=length_bucket_boundaries)
         test_pl = test_data.get_tf_samples()
 
     # Create model.
@@ -219,7 +236,8 @@ def create_and_restore_model(session, experiment_dir, data_dir, config, dynamic_
             config=config,
             data_pl=test_pl,
             mode=C.SAMPLE,
-            reuse=False)
+            reuse=False,
+            normalization_stats=test_data.get_normalization_stats())
         test_model.build_graph()
         test_model.summary_routines()
 
@@ -231,6 +249,8 @@ def create_and_restore_model(session, experiment_dir, data_dir, config, dynamic_
     # Restore model parameters.
     saver = tf.train.Saver(tf.global_variables(), max_to_keep=1, save_relative_paths=True)
     load_latest_checkpoint(session, saver, experiment_dir)
+    # Sample id lookup table of the data filter.
+    session.run(tf.tables_initializer())
     return test_model, test_data, train_data
 
 
@@ -240,7 +260,6 @@ def evaluate_model(session, _eval_model, _eval_iter, _metrics_engine,
     n_batches = 0
     _eval_result = dict()
     _metrics_engine.reset()
-    _attention_weights = dict()
     session.run(_eval_iter.initializer)
 
     using_attention_model = False
@@ -279,7 +298,7 @@ def evaluate_model(session, _eval_model, _eval_iter, _metrics_engine,
     print("Evaluated on " + str(n_batches) + " batches.")
         # finalize the computation of the metrics
     # final_metrics = _metrics_engine.get_final_metrics()
-    return None, _eval_result, _attention_weights
+    return None, _eval_result
 
 
 def to_3d_pos(angles, fk_engine, dof=9, force_valid_rot=True, is_sparse=True):
@@ -309,13 +328,20 @@ def to_3d_pos(angles, fk_engine, dof=9, force_valid_rot=True, is_sparse=True):
     return pos
 
 
-def load_data_samples(session, data_dir, config, seq_len=120, n_samples=1):
+def compute_train_power_spectrum(session, data_dir, config, seq_len=120, n_samples=1, to_pos=True):
+    """
+    Streams training windows from the TFRecord dataset into a `PowerSpectrumAccumulator` so that the training samples
+    never have to be kept in memory.
+    Returns:
+        The normalized power spectrum of the training samples, see `power_spectrum`.
+    """
     # Create dataset
     assert config["data_type"] == "rotmat"
-    train_data_path = os.path.join(data_dir, config["data_type"], "training",
+    stored_data_type = C.ROT_MATRIX if config.get("canonical_data", False) else config["data_type"]
+    train_data_path = os.path.join(data_dir, stored_data_type, "training",
                                    "amass-?????-of-?????")
-    meta_data_path = os.path.join(data_dir, config["data_type"], "training",
-                                  "stats.npz")
+    meta_data_path = os.path.join(data_dir, stored_data_type, "training",
+                                  get_stats_file(stored_data_type, config["data_type"]))
     with tf.name_scope("training_data"):
         dataset = TFRecordMotionDataset(data_path=train_data_path,
                                         meta_data_path=meta_data_path,
@@ -327,22 +353,25 @@ def load_data_samples(session, data_dir, config, seq_len=120, n_samples=1):
                                         normalize=False)
     data_pl = dataset.get_tf_samples()
     session.run(dataset.iterator.initializer)
-    
-    all_samples = []
+
+    fk_engine = SMPLForwardKinematics() if to_pos else None
+    accumulator = PowerSpectrumAccumulator(chunk_len=seq_len)
     i = 0
     while i < n_samples:
         try:
             batch = session.run(data_pl)
             np_batch = batch["inputs"]
-            all_samples.append(np_batch)
-            i += np_batch.shape[0]
+            batch_size, batch_seq_len = np_batch.shape[:2]
+            if to_pos:
+                np_batch = to_3d_pos(np_batch, fk_engine)
+            np_batch = np.reshape(np_batch, [batch_size, batch_seq_len, -1, 3 if to_pos else 9])
+            accumulator.update(np.transpose(np_batch, (0, 2, 1, 3)))
+            i += batch_size
         except tf.errors.OutOfRangeError:
             session.run(dataset.iterator.initializer)
     print("# samples: ", i)
 
-    all_samples = np.vstack(all_samples)
-    all_samples = np.reshape(all_samples, [all_samples.shape[0], all_samples.shape[1], -1, 9])
-    return all_samples
+    return accumulator.finalize()
 
 
 def evaluate(session, test_model, test_data, args, eval_dir, mode="all_test"):
@@ -366,12 +395,12 @@ def evaluate(session, test_model, test_data, args, eval_dir, mode="all_test"):
     
     print("Evaluating test set...")
     undo_norm_fn = test_data.unnormalize_zero_mean_unit_variance_channel
-    test_metrics, eval_result, attention_weights = evaluate_model(session,
-                                                                  test_model,
-                                                                  test_iter,
-                                                                  metrics_engine,
-                                                                  undo_norm_fn,
-                                                                  _return_results=True)
+    test_metrics, eval_result = evaluate_model(session,
+                                               test_model,
+                                               test_iter,
+                                               metrics_engine,
+                                               undo_norm_fn,
+                                               _return_results=True)
     np.save(os.path.join(eval_dir, "eval_samples_preds_" + mode), eval_result)
     
 
@@ -398,25 +427,37 @@ def split_into_chunks(tensor, split_len, chunk_id=None):
 
 
 def calculate_dist_metrics(eval_samples, sample_keys, train_samples=None,
-                           to_pos=True, eval_seq_len=60):
+                           to_pos=True, eval_seq_len=60, ps_gt_train=None, chunk_size=1000):
+    """
+    Args:
+        eval_samples: dict of (prediction, target, seed)
+        sample_keys: Keys of `eval_samples` to use.
+        train_samples: Optional training samples of shape (n_samples, seq_len, n_joints, 9).
+        to_pos: Whether the spectra are computed on 3D positions rather than rotation matrices.
+        eval_seq_len: Length of the chunks for which the spectra are computed.
+        ps_gt_train: Optional precomputed power spectrum of the training samples, used instead of `train_samples`.
+        chunk_size: Number of training samples that are converted and added to the power spectrum at once.
+    Returns:
+        dict of metric values
+    """
     print("Computing PS KLD and PS Entropy metrics...")
     n_joints = AMASS_N_JOINTS
     results = dict()
     
-    if train_samples is not None:
+    if train_samples is not None and ps_gt_train is None:
         n_train_samples = train_samples.shape[0]
         print("# of training samples ", n_train_samples)
-        if to_pos:
-            fk_engine = SMPLForwardKinematics()
-            all_gt_train = to_3d_pos(np.reshape(train_samples, [n_train_samples, train_samples.shape[1], 135]), fk_engine)
-            all_gt_train = np.reshape(all_gt_train, [n_train_samples, -1, all_gt_train.shape[1], all_gt_train.shape[2]])
-        else:
-            all_gt_train = train_samples
-    
-        # Create chunks of length eval_seq_len.
-        all_gt_train = split_into_chunks(all_gt_train, eval_seq_len)
-        all_gt_train = np.transpose(all_gt_train, (0, 2, 1, 3))
-        ps_gt_train = power_spectrum(all_gt_train)
+        fk_engine = SMPLForwardKinematics()
+        accumulator = PowerSpectrumAccumulator(chunk_len=eval_seq_len)
+        for start in range(0, n_train_samples, chunk_size):
+            chunk = train_samples[start:start + chunk_size]
+            if to_pos:
+                chunk = to_3d_pos(np.reshape(chunk, [chunk.shape[0], chunk.shape[1], 135]), fk_engine)
+                chunk = np.reshape(chunk, [-1, train_samples.shape[1], chunk.shape[1], chunk.shape[2]])
+            accumulator.update(np.transpose(chunk, (0, 2, 1, 3)))
+        ps_gt_train = accumulator.finalize()
+
+    if ps_gt_train is not None:
         ent_gt_train = ps_entropy(ps_gt_train)
         results["entropy_gt_train"] = ent_gt_train.mean()
     
@@ -439,7 +480,7 @@ def calculate_dist_metrics(eval_samples, sample_keys, train_samples=None,
     ent_gt_test = ps_entropy(ps_gt_test)
     results["entropy_gt_test"] = ent_gt_test.mean()
     
-    if train_samples is not None:
+    if ps_gt_train is not None:
         kld_train_test = ps_kld(ps_gt_train, ps_gt_test)
         kld_test_train = ps_kld(ps_gt_test, ps_gt_train)
         results["kld_train_test"] = kld_train_test.mean()
@@ -469,7 +510,7 @@ def calculate_dist_metrics(eval_samples, sample_keys, train_samples=None,
         kld_test_pred = ps_kld(ps_gt_test, ps_pred)
         results["kld_test_prediction"].append(kld_test_pred.mean())
 
-        if train_samples is not None:
+        if ps_gt_train is not None:
             kld_pred_train = ps_kld(ps_pred, ps_gt_train)
             results["kld_prediction_train"].append(kld_pred_train.mean())
     
@@ -738,7 +779,7 @@ if __name__ == '__main__':
                 mode = "periodic"  # "periodic" or "all_test"
                 saved_metrics_p = os.path.join(_eval_dir, "dist_metrics_{}.npy".format(mode))
                 saved_predictions = os.path.join(_eval_dir, "eval_samples_preds_{}.npy".format(mode))
-                saved_training = os.path.join(_eval_dir, "amass_train_rotmat_{}.npy".format(eval_seq_len))
+                saved_training = os.path.join(_eval_dir, "amass_train_ps_{}.npy".format(eval_seq_len))
 
                 exp_id = os.path.split(_eval_dir)[-1].split("-")[0] + "-" + mode
                 model_name = '-'.join(os.path.split(_eval_dir)[-1].split('-')[1:])
@@ -751,8 +792,8 @@ if __name__ == '__main__':
                     evaluate(sess, _test_model, _test_data, _args, _eval_dir, mode)
 
                 if not os.path.exists(saved_training):  # Load training data for dist. metrics.
-                    training_samples = load_data_samples(sess, _data_dir, _config, n_samples=20000, seq_len=eval_seq_len)
-                    np.save(os.path.join(_eval_dir, "amass_train_rotmat_" + str(eval_seq_len)), training_samples)
+                    ps_training = compute_train_power_spectrum(sess, _data_dir, _config, n_samples=20000, seq_len=eval_seq_len)
+                    np.save(os.path.join(_eval_dir, "amass_train_ps_" + str(eval_seq_len)), ps_training)
 
                 if os.path.exists(saved_predictions):  # NPSS.
                     _eval_samples = np.load(saved_predictions).tolist()
@@ -771,9 +812,9 @@ if __name__ == '__main__':
 
                     _eval_samples = np.load(saved_predictions).tolist()
 
-                    _train_samples = None
+                    _ps_gt_train = None
                     if os.path.exists(saved_training):
-                        _train_samples = np.load(saved_training)
+                        _ps_gt_train = np.load(saved_training)
 
                     if mode == "periodic":
                         _sample_keys = list(sample_keys_amass)
@@ -782,7 +823,7 @@ if __name__ == '__main__':
                     else:
                         raise Exception("Unknown mode.")
 
-                    dist_results = calculate_dist_metrics(_eval_samples, _sample_keys, train_samples=_train_samples, to_pos=True, eval_seq_len=eval_seq_len)
+                    dist_results = calculate_dist_metrics(_eval_samples, _sample_keys, ps_gt_train=_ps_gt_train, to_pos=True, eval_seq_len=eval_seq_len)
                     np.save(os.path.join(_eval_dir, "dist_metrics_" + mode), dist_results)
                     log_metrics(_args, dist_results, exp_id, model_name)
                 
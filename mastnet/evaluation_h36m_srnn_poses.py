@@ -101,6 +101,8 @@ def create_and_restore_model(session, experiment_dir, data_dir, config):
     print("Loading H3.6M (SRNN poses) test data from " + srnn_path)
     
     # Create model and data for SRNN evaluation
+    # If the normalization is fused into the model, the dataset passes unnormalized poses.
+    normalize = not config["no_normalization"] and not config.get("fused_normalization", False)
     with tf.name_scope("srnn_data"):
         srnn_data = SRNNTFRecordMotionDataset(data_path=srnn_path,
                                               meta_data_path=meta_data_path,
@@ -109,7 +111,7 @@ def create_and_restore_model(session, experiment_dir, data_dir, config):
                                               seed_len=config["source_seq_len"],
                                               target_len=config["target_seq_len"],
                                               num_parallel_calls=4,
-                                              normalize=not config["no_normalization"],
+                                              normalize=normalize,
                                               normalization_dim=config.get("normalization_dim", "channel"),
                                               use_std_norm=config.get("use_std_norm", False),)
         srnn_pl = srnn_data.get_tf_samples()
@@ -120,7 +122,8 @@ def create_and_restore_model(session, experiment_dir, data_dir, config):
             data_pl=srnn_pl,
             mode=C.SAMPLE,
             reuse=False,
-            dtype=tf.float32)
+            dtype=tf.float32,
+            normalization_stats=srnn_data.get_normalization_stats())
         srnn_model.build_graph()
 
     num_param = 0
@@ -25,6 +25,8 @@ necessary information. Although we didn't pass it read-only, we assume that the
 - Data is passed via a number of placeholders (i.e., data_pl) which we create by using tf.data. Our dataset class
 (i.e., spl.data.amass_tf.TFRecordMotionDataset) wraps tf.data API to implement the required preprocessing and
 normalization operations. Hence, the data is passed automatically. We no longer need feed_dict during training.
+If `fused_normalization` is set in the config, the normalization is the first and the last layer of the model instead
+and the dataset passes unnormalized poses (see `BaseModel.normalize`).
 You can see `sampled_step` method implementation to do autoregressive sampling. Similarly, one can use tf.placeholder
 instead of tf.data. Is should be straightforward. You just need to create placeholders and pass them within a
 dictionary. There are 4 data placeholders in `data_pl` dictionary:
@@ -50,6 +52,7 @@ from __future__ import print_function
 
 import time
 import tensorflow as tf
+import spl.util.tf_utils as model_utils
 from common.constants import Constants as C
 from spl.model.spl import SPL
 
@@ -65,9 +68,20 @@ class BaseModel(object):
         self.target_seq_len = config["target_seq_len"]
         self.batch_size = config["batch_size"]
         
+        # Zero-mean unit-variance normalization as the first and last layer of the model. The statistics of the
+        # training data (`normalization_stats` kwarg) are stored as constants and the dataset passes raw poses.
+        self.fused_normalization = config.get("fused_normalization", False) and not config.get("no_normalization", False)
+        self.normalization_mean = None
+        self.normalization_var = None
+        if self.fused_normalization:
+            normalization_mean, normalization_var = kwargs["normalization_stats"]
+            with tf.name_scope("normalization"):
+                self.normalization_mean = tf.constant(normalization_mean, dtype=tf.float32, name="mean")
+                self.normalization_var = tf.constant(normalization_var, dtype=tf.float32, name="var")
+
         # Data placeholders. Output of dataset iterator.
-        self.data_inputs = data_pl[C.BATCH_INPUT]
-        self.data_targets = data_pl[C.BATCH_TARGET]
+        self.data_inputs = self.normalize(data_pl[C.BATCH_INPUT])
+        self.data_targets = self.normalize(data_pl[C.BATCH_TARGET])
         self.data_seq_len = data_pl[C.BATCH_SEQ_LEN]
         self.data_ids = data_pl[C.BATCH_ID]
 
@@ -89,6 +103,7 @@ class BaseModel(object):
 
         # Set by the child model classes.
         self.outputs = None  # List of predicted frames. Set by `build_graph`.
+        self.unnormalized_outputs = None  # `outputs` in the scale of the dataset. Set by `build_graph`.
         self.prediction_targets = None  # Targets in pose loss term.
         self.prediction_inputs = None  # Inputs that are used to make predictions.
         self.loss_all_frames = None  # Whether to apply training loss on the seed sequence or not.
@@ -98,6 +113,12 @@ class BaseModel(object):
         self.gradient_norms = None  # Set by `optimization_routines`.
         self.parameter_update = None  # Parameter update op: optimizer output. Set by `optimization_routines`.
         self.summary_update = None  # Summary op to write summaries. Set by `summary_routines`.
+
+        # Sampling. Set by `build_sampling_graph`.
+        self.sampling_seed = None  # Seed sequence of the rollout. Read from the dataset unless it is fed.
+        self.sampling_targets = None  # Ground-truth continuation of the seed sequence.
+        self.sampling_steps = None  # Number of frames to predict. Defaults to target_seq_len.
+        self.sampled_outputs = None  # Predicted frames (batch_size, sampling_steps, pose_size).
         
         # Hard-coded parameters.
         self.JOINT_SIZE = 4 if self.use_quat else 3 if self.use_aa or self.use_euler else 9
@@ -108,8 +129,21 @@ class BaseModel(object):
     def build_graph(self):
         """Creates Tensorflow training graph by building the actual network and calculating the loss operation."""
         self.outputs = self.build_network()
+        self.unnormalized_outputs = self.unnormalize(self.outputs)
         self.loss = self.build_loss()
 
+    def normalize(self, poses):
+        """Applies the fused normalization if it is enabled. Otherwise, poses are returned as they are."""
+        if not self.fused_normalization:
+            return poses
+        return (poses - self.normalization_mean) / self.normalization_var
+
+    def unnormalize(self, poses):
+        """Reverts the fused normalization if it is enabled. Otherwise, poses are returned as they are."""
+        if not self.fused_normalization:
+            return poses
+        return poses*self.normalization_var + self.normalization_mean
+
     def build_network(self):
         """Builds the network.
         
@@ -186,12 +220,13 @@ class BaseModel(object):
                 raise Exception("Unknown loss.")
             return loss_
     
-    def build_prediction_layer(self, inputs):
+    def build_prediction_layer(self, inputs, prediction_inputs=None):
         """Given a context representation (i.e., rnn outputs), makes pose prediction by either using structured
         prediction layer (SPL) or standard dense layer.
         
         Args:
             inputs: A tensor or (batch_size, seq_len, representation_size)
+            prediction_inputs: Poses the residual connection is applied on. Defaults to self.prediction_inputs.
         Returns:
             predicted pose sequence: A tensor or (batch_size, seq_len, pose_size)
         """
@@ -220,8 +255,37 @@ class BaseModel(object):
                 pose_prediction = sp_layer.build(inputs)
         
         if self.residual_velocity:
-            pose_prediction += self.prediction_inputs[:, 0:tf.shape(pose_prediction)[1], :self.HUMAN_SIZE]
+            if prediction_inputs is None:
+                prediction_inputs = self.prediction_inputs
+            pose_prediction += prediction_inputs[:, 0:tf.shape(pose_prediction)[1], :self.HUMAN_SIZE]
         return pose_prediction
+
+    def build_sampling_graph(self):
+        """Builds the auto-regressive rollout as a single op so that `sample` and `sampled_step` require only one
+        session.run call.
+
+        The seed sequence is taken from the dataset after replacing the zero paddings with the last frame. It is
+        possible to feed `sampling_seed` and `sampling_steps` instead. Seed, targets and outputs are in the scale of
+        the dataset, i.e., unnormalized if the normalization is fused into the model.
+        """
+        data_inputs = model_utils.fill_sequence_padding(self.data_placeholders[C.BATCH_INPUT], self.data_seq_len)
+        self.sampling_seed = data_inputs[:, :self.source_seq_len]
+        self.sampling_targets = data_inputs[:, self.source_seq_len:]
+        self.sampling_steps = tf.placeholder_with_default(self.target_seq_len, shape=(), name="sampling_steps")
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            sampled_outputs = self.build_rollout(self.normalize(self.sampling_seed), self.sampling_steps)
+            self.sampled_outputs = self.unnormalize(sampled_outputs)
+
+    def build_rollout(self, seed_sequence, prediction_steps):
+        """Builds the auto-regressive rollout by using tf.while_loop. Model variables are reused.
+
+        Args:
+            seed_sequence: A tensor of (batch_size, seq_len, pose_size).
+            prediction_steps: A scalar tensor.
+        Returns:
+            predicted pose sequence: A tensor of (batch_size, prediction_steps, pose_size)
+        """
+        pass
     
     def optimization_routines(self):
         """Creates and optimizer, applies gradient regularizations and sets the parameter_update operation."""
@@ -282,13 +346,16 @@ class BaseModel(object):
             config['seed'] = args.seed
             config['model_type'] = args.model_type
             config['data_type'] = args.data_type
+            config['canonical_data'] = args.canonical_data
             config['use_h36m'] = args.use_h36m
     
             config['no_normalization'] = args.no_normalization
             config['normalization_dim'] = args.normalization_dim
             config['use_std_norm'] = args.use_std_norm
+            config['fused_normalization'] = args.fused_normalization
             
             config['batch_size'] = args.batch_size
+            config['windows_per_sequence'] = args.windows_per_sequence
             config['source_seq_len'] = args.source_seq_len
             config['target_seq_len'] = args.target_seq_len
             
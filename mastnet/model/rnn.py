@@ -18,11 +18,9 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 Autoregressive RNN model in its vanilla form or with our structured prediction layer (SPL).
 """
 
-import numpy as np
 import tensorflow as tf
 import spl.util.tf_utils as model_utils
 from spl.model.base_model import BaseModel
-from common.constants import Constants as C
 
 
 class RNN(BaseModel):
@@ -87,7 +85,43 @@ class RNN(BaseModel):
                                                             sequence_length=self.prediction_seq_len,
                                                             initial_state=self.initial_states,
                                                             dtype=tf.float32)
-        return self.build_prediction_layer(rnn_outputs)
+        outputs = self.build_prediction_layer(rnn_outputs)
+        if self.is_eval:
+            self.build_sampling_graph()
+        return outputs
+
+    def build_rollout(self, seed_sequence, prediction_steps):
+        """
+        Feeds the seed sequence and then the predictions at t+1 in a tf.while_loop. The first prediction step
+        corresponds to the last input step.
+        Args:
+            seed_sequence: (batch_size, seq_len, feature_size)
+            prediction_steps: number of prediction steps.
+        Returns:
+            Prediction with shape (batch_size, prediction_steps, feature_size)
+        """
+        batch_size = tf.shape(seed_sequence)[0]
+        initial_states = self.cell.zero_state(batch_size=batch_size, dtype=tf.float32)
+        inputs_hidden = self.build_input_layer(seed_sequence)
+        with tf.variable_scope("rnn_layer"):
+            rnn_outputs, state = tf.nn.dynamic_rnn(self.cell, inputs_hidden, initial_state=initial_states)
+        prediction = self.build_prediction_layer(rnn_outputs[:, -1:], seed_sequence[:, -1:])
+
+        predictions = tf.TensorArray(tf.float32, size=prediction_steps, element_shape=[None, self.HUMAN_SIZE])
+        predictions = predictions.write(0, prediction[:, 0])
+
+        def _step(step, prediction_, state_, predictions_):
+            inputs_hidden_ = self.build_input_layer(prediction_)
+            with tf.variable_scope("rnn_layer"):
+                rnn_outputs_, state_ = tf.nn.dynamic_rnn(self.cell, inputs_hidden_, initial_state=state_)
+            prediction_ = self.build_prediction_layer(rnn_outputs_, prediction_)
+            return step + 1, prediction_, state_, predictions_.write(step, prediction_[:, 0])
+
+        _, _, _, predictions = tf.while_loop(lambda step, *_: step < prediction_steps,
+                                             _step,
+                                             [tf.constant(1), prediction, state, predictions],
+                                             back_prop=False)
+        return tf.transpose(predictions.stack(), [1, 0, 2])
 
     def build_loss(self):
         return super(RNN, self).build_loss()
@@ -128,24 +162,9 @@ class RNN(BaseModel):
         """
         assert self.is_eval, "Only works in sampling mode."
 
-        batch = session.run(self.data_placeholders)
-        data_id = batch[C.BATCH_ID]
-        data_sample = batch[C.BATCH_INPUT]
-
-        # To get rid of 0 paddings.
-        seq_len = batch[C.BATCH_SEQ_LEN]
-        max_len = seq_len.max()
-        if (seq_len != max_len).sum() != 0:
-            for i in range(seq_len.shape[0]):
-                len_ = seq_len[i]
-                data_sample[i, len_:] = np.tile(data_sample[i, len_ - 1],
-                                                (max_len - len_, 1))
-        
-        targets = data_sample[:, self.source_seq_len:]
-        # Get the model state by feeding the seed sequence.
-        seed_sequence = data_sample[:, :self.source_seq_len]
-        predictions = self.sample(session, seed_sequence, prediction_steps=self.target_seq_len)
-
+        # Zero paddings are replaced with the last frame in the graph. See build_sampling_graph.
+        output_feed = [self.sampled_outputs, self.sampling_targets, self.sampling_seed, self.data_ids]
+        predictions, targets, seed_sequence, data_id = session.run(output_feed)
         return predictions, targets, seed_sequence, data_id
 
     def sample(self, session, seed_sequence, prediction_steps, **kwargs):
@@ -161,22 +180,9 @@ class RNN(BaseModel):
             Prediction with shape (batch_size, prediction_steps, feature_size)
         """
         assert self.is_eval, "Only works in sampling mode."
-        one_step_seq_len = np.ones(seed_sequence.shape[0])
-
-        feed_dict = {self.prediction_inputs: seed_sequence,
-                     self.prediction_seq_len: np.ones(seed_sequence.shape[0])*seed_sequence.shape[1]}
-        state, prediction = session.run([self.rnn_state, self.outputs], feed_dict=feed_dict)
-
-        prediction = prediction[:, -1:]
-        predictions = [prediction]
-        for step in range(prediction_steps-1):
-            # get the prediction
-            feed_dict = {self.prediction_inputs: prediction,
-                         self.initial_states: state,
-                         self.prediction_seq_len: one_step_seq_len}
-            state, prediction = session.run([self.rnn_state, self.outputs], feed_dict=feed_dict)
-            predictions.append(prediction)
-        return np.concatenate(predictions, axis=1)
+        feed_dict = {self.sampling_seed: seed_sequence,
+                     self.sampling_steps: prediction_steps}
+        return session.run(self.sampled_outputs, feed_dict=feed_dict)
     
     @classmethod
     def get_model_config(cls, args, from_config=None):
@@ -172,9 +172,12 @@ class Seq2SeqModel(BaseModel):
           unique sample IDs.
         """
         assert self.is_eval, "Only works in sampling mode."
-        prediction, targets, seed_sequence, data_id = session.run([self.outputs,
-                                                                   self.decoder_outputs,
-                                                                   self.data_inputs[:, :self.source_seq_len],
+        # Fetched in the scale of the dataset. See BaseModel.normalize.
+        data_inputs = self.data_placeholders[C.BATCH_INPUT]
+        target_end = self.source_seq_len + self.target_seq_len
+        prediction, targets, seed_sequence, data_id = session.run([self.unnormalized_outputs,
+                                                                   data_inputs[:, self.source_seq_len:target_end],
+                                                                   data_inputs[:, :self.source_seq_len],
                                                                    self.data_ids])
         return prediction, targets, seed_sequence, data_id
     
@@ -24,6 +24,8 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import numpy as np
 import tensorflow as tf
+import spl.util.tf_utils as model_utils
+from spl.util.attention_store import get_capture_policy
 from spl.model.base_model import BaseModel
 from common.constants import Constants as C
 
@@ -42,6 +44,11 @@ class Transformer2d(BaseModel):
 
         super(Transformer2d, self).__init__(config, data_pl, mode, reuse, **kwargs)
 
+        # attention weights are only captured in sampling mode and if a capture policy is set
+        self.attention_capture = None
+        if self.is_eval:
+            self.attention_capture = get_capture_policy(config.get('attention_capture'), self.num_layers)
+
         self.window_len = config.get('transformer_window_length')#self.source_seq_len  # attention window length
 
         # data
@@ -50,6 +57,7 @@ class Transformer2d(BaseModel):
         self.look_ahead_mask = self.create_look_ahead_mask()
         self.target_input = self.prediction_targets[:, :-1, :]
         self.target_real = self.prediction_targets[:, 1:, :]
+        self.sampled_attention_weights = None  # Attention weights of the rollout. Set by build_rollout.
         
     @classmethod
     def get_model_config(cls, args, from_config=None):
@@ -190,15 +198,15 @@ class Transformer2d(BaseModel):
     def sep_split_heads(self, x, batch_size, seq_len, num_heads):
         '''
         split the embedding vector for different heads for the temporal attention
-        :param x: the embedding vector (batch_size, seq_len, d_model)
+        :param x: the embedding vector (batch_size, seq_len, num_joints, d_model)
         :param batch_size: batch size
         :param seq_len: sequence length
         :param num_heads: number of temporal heads
-        :return: the split vector (batch_size, num_heads, seq_len, depth)
+        :return: the split vector (batch_size, num_joints, num_heads, seq_len, depth)
         '''
         depth = self.d_model // num_heads
-        x = tf.reshape(x, (batch_size, seq_len, num_heads, depth))
-        return tf.transpose(x, perm=[0, 2, 1, 3])
+        x = tf.reshape(x, (batch_size, seq_len, self.NUM_JOINTS, num_heads, depth))
+        return tf.transpose(x, perm=[0, 2, 3, 1, 4])
 
     def sep_temporal_attention(self, x, mask, scope):
         '''
@@ -208,58 +216,42 @@ class Transformer2d(BaseModel):
         :param scope: the name of the scope
         :return: the output (batch_size, seq_len, num_joints, d_model)
         '''
-        
-        outputs = []
-        attn_weights = []
         batch_size = tf.shape(x)[0]
         seq_len = tf.shape(x)[1]
-        x = tf.transpose(x, perm=[2, 0, 1, 3])  # (num_joints, batch_size, seq_len, d_model)
 
         # different joints have different embedding matrices
-        for joint_idx in range(self.NUM_JOINTS):
-            joint_var_scope = scope + "joint_" + str(joint_idx)
-            with tf.variable_scope(joint_var_scope, reuse=tf.AUTO_REUSE):
-                # with tf.variable_scope('joint_' + str(joint_idx), reuse=self.reuse):
-
-                # get the representation vector of the joint
-                joint_rep = x[joint_idx]  # (batch_size, seq_len, d_model)
-
-                # embed it to query, key and value vectors
-                with tf.variable_scope('_query', reuse=self.reuse):
-                    q = tf.layers.dense(joint_rep, self.d_model)  # (batch_size, seq_len, d_model)
-                with tf.variable_scope('_key', reuse=self.reuse):
-                    k = tf.layers.dense(joint_rep, self.d_model)  # (batch_size, seq_len, d_model)
-                with tf.variable_scope('_value', reuse=self.reuse):
-                    v = tf.layers.dense(joint_rep, self.d_model)  # (batch_size, seq_len, d_model)
-
-                # split it to several attention heads
-                q = self.sep_split_heads(q, batch_size, seq_len, self.num_heads_temporal)
-                # (batch_size, num_heads, seq_len, depth)
-                k = self.sep_split_heads(k, batch_size, seq_len, self.num_heads_temporal)
-                # (batch_size, num_heads, seq_len, depth)
-                v = self.sep_split_heads(v, batch_size, seq_len, self.num_heads_temporal)
-                # (batch_size, num_heads, seq_len, depth)
-                # calculate the updated encoding by scaled dot product attention
-                scaled_attention, attention_weights = self.scaled_dot_product_attention(q, k, v, mask)
-                # (batch_size, num_heads, seq_len, depth)
-                scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])
-                # (batch_size, seq_len, num_heads, depth)
-
-                # concatenate the outputs from different heads
-                concat_attention = tf.reshape(scaled_attention, [batch_size, seq_len, self.d_model])
-                # (batch_size, seq_len, d_model)
-
-                # go through a fully connected layer
-                with tf.variable_scope(scope + '_output_dense', reuse=self.reuse):
-                    output = tf.expand_dims(tf.layers.dense(concat_attention, self.d_model), axis=2)
-                # (batch_size, seq_len, 1, d_model)
-                outputs += [output]
-
-                last_attention_weights = attention_weights[:, :, -1, :]  # (batch_size, num_heads, seq_len)
-                attn_weights += [last_attention_weights]
-
-        outputs = tf.concat(outputs, axis=2)  # (batch_size, seq_len, num_joints, d_model)
-        attn_weights = tf.stack(attn_weights, axis=1)  # (batch_size, num_joints, num_heads, seq_len)
+        # embed it to query, key and value vectors
+        q = model_utils.joint_dense(x, self.d_model, self.NUM_JOINTS, name=scope + '_query', reuse=self.reuse,
+                                    legacy_scope=scope + "joint_{}/_query/dense")  # (batch_size, seq_len, num_joints, d_model)
+        k = model_utils.joint_dense(x, self.d_model, self.NUM_JOINTS, name=scope + '_key', reuse=self.reuse,
+                                    legacy_scope=scope + "joint_{}/_key/dense")  # (batch_size, seq_len, num_joints, d_model)
+        v = model_utils.joint_dense(x, self.d_model, self.NUM_JOINTS, name=scope + '_value', reuse=self.reuse,
+                                    legacy_scope=scope + "joint_{}/_value/dense")  # (batch_size, seq_len, num_joints, d_model)
+
+        # split it to several attention heads
+        q = self.sep_split_heads(q, batch_size, seq_len, self.num_heads_temporal)
+        # (batch_size, num_joints, num_heads, seq_len, depth)
+        k = self.sep_split_heads(k, batch_size, seq_len, self.num_heads_temporal)
+        # (batch_size, num_joints, num_heads, seq_len, depth)
+        v = self.sep_split_heads(v, batch_size, seq_len, self.num_heads_temporal)
+        # (batch_size, num_joints, num_heads, seq_len, depth)
+        # calculate the updated encoding by scaled dot product attention
+        scaled_attention, attention_weights = self.scaled_dot_product_attention(q, k, v, mask)
+        # (batch_size, num_joints, num_heads, seq_len, depth)
+        scaled_attention = tf.transpose(scaled_attention, perm=[0, 3, 1, 2, 4])
+        # (batch_size, seq_len, num_joints, num_heads, depth)
+
+        # concatenate the outputs from different heads
+        concat_attention = tf.reshape(scaled_attention, [batch_size, seq_len, self.NUM_JOINTS, self.d_model])
+        # (batch_size, seq_len, num_joints, d_model)
+
+        # go through a fully connected layer
+        outputs = model_utils.joint_dense(concat_attention, self.d_model, self.NUM_JOINTS,
+                                          name=scope + '_output_dense', reuse=self.reuse,
+                                          legacy_scope=scope + "joint_{}/" + scope + "_output_dense/dense")
+        # (batch_size, seq_len, num_joints, d_model)
+
+        attn_weights = attention_weights[:, :, :, -1, :]  # (batch_size, num_joints, num_heads, seq_len)
         return outputs, attn_weights
 
 
@@ -291,17 +283,10 @@ class Transformer2d(BaseModel):
         with tf.variable_scope(scope + '_value', reuse=self.reuse):
             v = tf.layers.dense(x, self.d_model)  # (batch_size, seq_len, num_joints, d_model)
         # Different joints have different query embedding matrices
-        x = tf.transpose(x, perm=[2, 0, 1, 3])  # (num_joints, batch_size, seq_len, d_model)
-        q_joints = []
-        for joint_idx in range(self.NUM_JOINTS):
-            query_var_scope = "_query_" + str(joint_idx)
-            with tf.variable_scope(query_var_scope, reuse=tf.AUTO_REUSE):
-                q = tf.expand_dims(tf.layers.dense(x[joint_idx], self.d_model), axis=2)  # (batch_size, seq_len, d_model)
-                q_joints += [q]
-        q_joints = tf.concat(q_joints, axis=2)  # (batch_size, seq_len, num_joints, d_model)
+        q_joints = model_utils.joint_dense(x, self.d_model, self.NUM_JOINTS, name=scope + '_query', reuse=self.reuse,
+                                           legacy_scope="_query_{}/dense")  # (batch_size, seq_len, num_joints, d_model)
         batch_size = tf.shape(q_joints)[0]
         seq_len = tf.shape(q_joints)[1]
-        # q_joints = tf.reshape(q_joints, [batch_size, seq_len, self.NUM_JOINTS, self.d_model])
 
         # split it to several attention heads
         q_joints = self.split_heads(q_joints, batch_size, seq_len,
@@ -337,17 +322,13 @@ class Transformer2d(BaseModel):
         :param scope: the name of the scope
         :return: outputs (batch_size, seq_len, num_joints, d_model)
         '''
-        inputs = tf.transpose(inputs, [2, 0, 1, 3])  # (num_joints, batch_size, seq_len, d_model)
-        outputs = []
         # different joints have different embedding matrices
-        for idx in range(self.NUM_JOINTS):
-            with tf.variable_scope(scope + '_ff1_' + str(idx), reuse=self.reuse):
-                joint_outputs = tf.layers.dense(inputs[idx], self.dff, activation='relu')
-            with tf.variable_scope(scope + '_ff2_' + str(idx), reuse=self.reuse):
-                joint_outputs = tf.layers.dense(joint_outputs, self.d_model)
-            outputs += [joint_outputs]
-        outputs = tf.concat(outputs, axis=-1)  # (batch_size, seq_len, num_joints * d_model)
-        outputs = tf.reshape(outputs, [tf.shape(outputs)[0], tf.shape(outputs)[1], self.NUM_JOINTS, self.d_model])
+        outputs = model_utils.joint_dense(inputs, self.dff, self.NUM_JOINTS, activation=C.RELU,
+                                          name=scope + '_ff1', reuse=self.reuse,
+                                          legacy_scope=scope + "_ff1_{}/dense")  # (batch_size, seq_len, num_joints, dff)
+        outputs = model_utils.joint_dense(outputs, self.d_model, self.NUM_JOINTS,
+                                          name=scope + '_ff2', reuse=self.reuse,
+                                          legacy_scope=scope + "_ff2_{}/dense")  # (batch_size, seq_len, num_joints, d_model)
         return outputs
 
     def para_transformer_layer(self, x, look_ahead_mask, scope):
@@ -390,18 +371,13 @@ class Transformer2d(BaseModel):
         The attention blocks
         :param inputs: inputs (batch_size, seq_len, num_joints, joint_size)
         :param look_ahead_mask: the look ahead mask
-        :return: outputs (batch_size, seq_len, num_joints, joint_size)
+        :return: outputs (batch_size, seq_len, num_joints, d_model), see output_layer for the decoding, and the
+        attention weights of the layers selected by the attention capture policy (None if it is off)
         '''
         # encode each rotation matrix to the feature space (d_model)
         # different joints have different encoding matrices
-        inputs = tf.transpose(inputs, [2, 0, 1, 3])  # (num_joints, batch_size, seq_len, joint_size)
-        embed = []
-        for joint_idx in range(self.NUM_JOINTS):
-            with tf.variable_scope("embedding_" + str(joint_idx), reuse=self.reuse):
-                joint_rep = tf.layers.dense(inputs[joint_idx], self.d_model)  # (batch_size, seq_len, d_model)
-                embed += [joint_rep]
-        x = tf.concat(embed, axis=-1)
-        x = tf.reshape(x, [tf.shape(x)[0], tf.shape(x)[1], self.NUM_JOINTS, self.d_model])
+        x = model_utils.joint_dense(inputs, self.d_model, self.NUM_JOINTS, name="embedding", reuse=self.reuse,
+                                    legacy_scope="embedding_{}/dense")  # (batch_size, seq_len, num_joints, d_model)
         
         # add the positional encoding
         x += self.pos_encoding
@@ -413,30 +389,32 @@ class Transformer2d(BaseModel):
         # (batch_size, seq_len, num_joints, d_model)
         attention_weights_temporal = []
         attention_weights_spatial = []
-        attention_weights = {}
+        attention_weights = None
         
         for i in range(self.num_layers):
             x, block1, block2 = self.para_transformer_layer(x, look_ahead_mask, scope="transformer_layer_" + str(i))
-            attention_weights_temporal += [block1]  # (batch_size, num_joints, num_heads, seq_len)
-            attention_weights_spatial += [block2]  # (batch_size, num_heads, num_joints, num_joints)
+            if self.attention_capture is not None and i in self.attention_capture['layers']:
+                attention_weights_temporal += [block1]  # (batch_size, num_joints, num_heads, seq_len)
+                attention_weights_spatial += [block2]  # (batch_size, num_heads, num_joints, num_joints)
         # (batch_size, seq_len, num_joints, d_model)
 
-        attention_weights['temporal'] = tf.stack(attention_weights_temporal, axis=1)  # (batch_size, num_layers, num_joints, num_heads, seq_len)
-        attention_weights['spatial'] = tf.stack(attention_weights_spatial, axis=1)  # (batch_size, num_layers, num_heads, num_joints, num_joints)
+        if attention_weights_temporal:
+            attention_weights = dict()
+            attention_weights['temporal'] = tf.stack(attention_weights_temporal, axis=1)  # (batch_size, num_captured_layers, num_joints, num_heads, seq_len)
+            attention_weights['spatial'] = tf.stack(attention_weights_spatial, axis=1)  # (batch_size, num_captured_layers, num_heads, num_joints, num_joints)
 
-        # decode each feature to the rotation matrix space
+        return x, attention_weights
+
+    def output_layer(self, x, reuse):
+        '''
+        decode each feature to the rotation matrix space
+        :param x: the transformer outputs (batch_size, seq_len, num_joints, d_model)
+        :param reuse: whether to reuse the variables
+        :return: outputs (batch_size, seq_len, num_joints, joint_size)
+        '''
         # different joints have different decoding matrices
-        x = tf.transpose(x, [2, 0, 1, 3])  # (num_joints, batch_size, seq_len, joint_size)
-        output = []
-        for joint_idx in range(self.NUM_JOINTS):
-            with tf.variable_scope("final_output_" + str(joint_idx), reuse=self.reuse):
-                joint_output = tf.layers.dense(x[joint_idx], self.JOINT_SIZE)
-                output += [joint_output]
-        final_output = tf.concat(output, axis=-1)
-        final_output = tf.reshape(final_output, [tf.shape(final_output)[0], tf.shape(final_output)[1],
-                                                 self.NUM_JOINTS, self.JOINT_SIZE])
-        
-        return final_output, attention_weights
+        return model_utils.joint_dense(x, self.JOINT_SIZE, self.NUM_JOINTS, name="final_output", reuse=reuse,
+                                       legacy_scope="final_output_{}/dense")
 
     def build_network(self):
         shape = tf.shape(self.target_input)
@@ -444,13 +422,64 @@ class Transformer2d(BaseModel):
         seq_len = shape[1]
         target_input = self.target_input
         target_input = tf.reshape(target_input, [batch_siz, seq_len, self.NUM_JOINTS, self.JOINT_SIZE])
-        outputs, self.attn_weights = self.transformer(target_input, self.look_ahead_mask)
+        hidden, self.attn_weights = self.transformer(target_input, self.look_ahead_mask)
+        outputs = self.output_layer(hidden, self.reuse)
         outputs = tf.reshape(outputs, [batch_siz, seq_len, self.HUMAN_SIZE])
         if self.residual_velocity:
             outputs += self.target_input
 
+        if self.is_eval:
+            self.build_sampling_graph()
         return outputs
 
+    def build_rollout(self, seed_sequence, prediction_steps):
+        '''
+        autoregressive sampling in a tf.while_loop. the window is shifted by one frame after every prediction
+        :param seed_sequence: the seed sequence (batch_size, seed_len, human_size)
+        :param prediction_steps: number of frames to predict
+        :return: predictions (batch_size, prediction_steps, human_size)
+        '''
+        batch_size = tf.shape(seed_sequence)[0]
+        window = seed_sequence[:, -self.window_len:]
+        capture = self.attention_capture is not None
+
+        loop_vars = [tf.constant(0), window, tf.TensorArray(tf.float32, size=prediction_steps)]
+        if capture:
+            loop_vars += [tf.TensorArray(tf.float32, size=prediction_steps),
+                          tf.TensorArray(tf.float32, size=prediction_steps)]
+
+        def _step(step, window_, predictions_, *attention_):
+            inputs = tf.reshape(window_, [batch_size, self.window_len, self.NUM_JOINTS, self.JOINT_SIZE])
+            hidden, attention_weights = self.transformer(inputs, self.look_ahead_mask)
+            # only the prediction for the last frame is required
+            prediction = self.output_layer(hidden[:, -1:], True)
+            prediction = tf.reshape(prediction, [batch_size, 1, self.HUMAN_SIZE])
+            if self.residual_velocity:
+                prediction += window_[:, -1:]
+
+            window_ = tf.concat([window_[:, 1:], prediction], axis=1)
+            outputs = [step + 1, window_, predictions_.write(step, prediction[:, 0])]
+            if capture:
+                outputs += [attention_[0].write(step, attention_weights['temporal']),
+                            attention_[1].write(step, attention_weights['spatial'])]
+            return outputs
+
+        outputs = tf.while_loop(lambda step, *_: step < prediction_steps, _step, loop_vars, back_prop=False)
+
+        if capture:
+            # (num_frames, batch_size, num_captured_layers, ...)
+            attn_temporal = outputs[3].stack()
+            attn_spatial = outputs[4].stack()
+            if self.attention_capture['frames'] is not None:
+                frames = tf.constant(self.attention_capture['frames'], dtype=tf.int32)
+                frames = tf.boolean_mask(frames, frames < prediction_steps)
+                attn_temporal = tf.gather(attn_temporal, frames)
+                attn_spatial = tf.gather(attn_spatial, frames)
+            # (batch_size, num_frames, num_captured_layers, ...)
+            self.sampled_attention_weights = {'temporal': tf.transpose(attn_temporal, [1, 0, 2, 3, 4, 5]),
+                                              'spatial': tf.transpose(attn_spatial, [1, 0, 2, 3, 4, 5])}
+        return tf.transpose(outputs[2].stack(), [1, 0, 2])  # (batch_size, prediction_steps, human_size)
+
     def build_loss(self):
         predictions_pose = self.outputs
         targets_pose = self.target_real
@@ -492,43 +521,22 @@ class Transformer2d(BaseModel):
     def sampled_step(self, session, prediction_steps=None):
         prediction_steps = prediction_steps or self.target_seq_len
         assert self.is_eval, "Only works in sampling mode."
-        batch = session.run(self.data_placeholders)
-        data_id = batch[C.BATCH_ID]
-        data_sample = batch[C.BATCH_INPUT]
-        # To get rid of 0 paddings.
-        seq_len = batch[C.BATCH_SEQ_LEN]
-        max_len = seq_len.max()
-        if (seq_len != max_len).sum() != 0:
-            for i in range(seq_len.shape[0]):
-                len_ = seq_len[i]
-                data_sample[i, len_:] = np.tile(data_sample[i, len_ - 1],
-                                                (max_len - len_, 1))
-                
-        targets = data_sample[:, self.source_seq_len:, :]
-        seed_sequence = data_sample[:, :self.source_seq_len, :]
-        prediction, attentions = self.sample(session=session,
-                                             seed_sequence=seed_sequence,
-                                             prediction_steps=prediction_steps)
-        return prediction, targets, seed_sequence, data_id, attentions
+        # Zero paddings are replaced with the last frame in the graph. See build_sampling_graph.
+        output_feed = [self.sampled_outputs, self.sampling_targets, self.sampling_seed, self.data_ids]
+        if self.sampled_attention_weights is not None:
+            output_feed.append(self.sampled_attention_weights)
+        outputs = session.run(output_feed, feed_dict={self.sampling_steps: prediction_steps})
+        attention = outputs[4] if self.sampled_attention_weights is not None else None
+        return outputs[0], outputs[1], outputs[2], outputs[3], attention
 
     def sample(self, session, seed_sequence, prediction_steps, **kwargs):
+        '''
+        :return: predictions (batch_size, prediction_steps, human_size) and the attention weights selected by the
+        attention capture policy (None if it is off)
+        '''
         assert self.is_eval, "Only works in sampling mode."
-
-        input_sequence = seed_sequence[:, -self.window_len:, :]
-        num_steps = prediction_steps
-        dummy_frame = np.zeros([seed_sequence.shape[0], 1, seed_sequence.shape[2]])
-        predictions = []
-        attentions = []
-
-        for step in range(num_steps):
-            # Insert a dummy frame since the model shifts the inputs by one step.
-            model_inputs = np.concatenate([input_sequence, dummy_frame], axis=1)
-            model_outputs, attention = session.run([self.outputs, self.attn_weights], feed_dict={self.data_inputs: model_inputs})
-            prediction = model_outputs[:, -1:, :]
-            predictions.append(prediction)
-            attentions += [attention]
-            input_sequence = np.concatenate([input_sequence, predictions[-1]], axis=1)
-            # input_sequence = input_sequence[:, 1:, :]
-            input_sequence = input_sequence[:, -self.window_len:]
-
-        return np.concatenate(predictions, axis=1), attentions
\ No newline at end of file
+        feed_dict = {self.sampling_seed: seed_sequence,
+                     self.sampling_steps: prediction_steps}
+        if self.sampled_attention_weights is None:
+            return session.run(self.sampled_outputs, feed_dict=feed_dict), None
+        return session.run([self.sampled_outputs, self.sampled_attention_weights], feed_dict=feed_dict)
\ No newline at end of file
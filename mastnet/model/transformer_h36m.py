@@ -617,14 +617,10 @@ class Transformer2d(BaseModel):
         batch = session.run(self.data_placeholders)
         data_id = batch[C.BATCH_ID]
         data_sample = batch[C.BATCH_INPUT]
-        # To get rid of 0 paddings.
+        # To get rid of 0 paddings, repeat the last valid frame of each sequence.
         seq_len = batch[C.BATCH_SEQ_LEN]
-        max_len = seq_len.max()
-        if (seq_len != max_len).sum() != 0:
-            for i in range(seq_len.shape[0]):
-                len_ = seq_len[i]
-                data_sample[i, len_:] = np.tile(data_sample[i, len_ - 1],
-                                                (max_len - len_, 1))
+        frame_idx = np.minimum(np.arange(data_sample.shape[1])[np.newaxis], seq_len[:, np.newaxis] - 1)
+        data_sample = np.take_along_axis(data_sample, frame_idx[:, :, np.newaxis], axis=1)
                 
         targets = data_sample[:, self.source_seq_len:, :]
         seed_sequence = data_sample[:, :self.source_seq_len, :]
@@ -645,7 +641,9 @@ class Transformer2d(BaseModel):
         for step in range(num_steps):
             # Insert a dummy frame since the model shifts the inputs by one step.
             model_inputs = np.concatenate([input_sequence, dummy_frame], axis=1)
-            model_outputs, attention = session.run([self.outputs, self.attn_weights], feed_dict={self.data_inputs: model_inputs})
+            # Inputs and outputs are in the scale of the dataset. See BaseModel.normalize.
+            model_outputs, attention = session.run([self.unnormalized_outputs, self.attn_weights],
+                                                   feed_dict={self.data_placeholders[C.BATCH_INPUT]: model_inputs})
             prediction = model_outputs[:, -1:, :]
             predictions.append(prediction)
             attentions += [attention]
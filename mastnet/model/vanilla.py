@@ -263,8 +263,29 @@ class Transformer1d(BaseModel):
         outputs, attention_weights = self.transformer(self.target_input, self.look_ahead_mask, self.HUMAN_SIZE)
         if self.residual_velocity:
             outputs += self.target_input
+        if self.is_eval:
+            self.build_sampling_graph()
         return outputs
 
+    def build_rollout(self, seed_sequence, prediction_steps):
+        batch_size = tf.shape(seed_sequence)[0]
+        window = seed_sequence[:, -self.window_len:]
+        predictions = tf.TensorArray(tf.float32, size=prediction_steps)
+
+        def _step(step, window_, predictions_):
+            outputs, _ = self.transformer(window_, self.look_ahead_mask, self.HUMAN_SIZE)
+            prediction = outputs[:, -1:]
+            if self.residual_velocity:
+                prediction += window_[:, -1:]
+            window_ = tf.concat([window_[:, 1:], prediction], axis=1)
+            return step + 1, window_, predictions_.write(step, tf.reshape(prediction, [batch_size, self.HUMAN_SIZE]))
+
+        _, _, predictions = tf.while_loop(lambda step, *_: step < prediction_steps,
+                                          _step,
+                                          [tf.constant(0), window, predictions],
+                                          back_prop=False)
+        return tf.transpose(predictions.stack(), [1, 0, 2])
+
     def build_loss(self):
         predictions_pose = self.outputs
         targets_pose = self.target_real
@@ -305,44 +326,16 @@ class Transformer1d(BaseModel):
 
     def sampled_step(self, session, prediction_steps=None):
         assert self.is_eval, "Only works in sampling mode."
-        batch = session.run(self.data_placeholders)
-        data_id = batch[C.BATCH_ID]
-        data_sample = batch[C.BATCH_INPUT]
-        targets = data_sample[:, self.source_seq_len:, :]
-
-        # To get rid of 0 paddings.
-        seq_len = batch[C.BATCH_SEQ_LEN]
-        max_len = seq_len.max()
-        if (seq_len != max_len).sum() != 0:
-            for i in range(seq_len.shape[0]):
-                len_ = seq_len[i]
-                data_sample[i, len_:] = np.tile(data_sample[i, len_ - 1],
-                                                (max_len - len_, 1))
-        
-        seed_sequence = data_sample[:, :self.source_seq_len, :]
-        prediction = self.sample(session=session,
-                                 seed_sequence=seed_sequence,
-                                 prediction_steps=self.target_seq_len)
+        # Zero paddings are replaced with the last frame in the graph. See build_sampling_graph.
+        output_feed = [self.sampled_outputs, self.sampling_targets, self.sampling_seed, self.data_ids]
+        prediction, targets, seed_sequence, data_id = session.run(output_feed)
         return prediction, targets, seed_sequence, data_id
 
     def sample(self, session, seed_sequence, prediction_steps, **kwargs):
         assert self.is_eval, "Only works in sampling mode."
-
-        input_sequence = seed_sequence[:, -self.window_len:, :]
-        num_steps = prediction_steps
-        dummy_frame = np.zeros([seed_sequence.shape[0], 1, seed_sequence.shape[2]])
-        predictions = []
-
-        for step in range(num_steps):
-            # Insert a dummy frame since the model shifts the inputs by one step.
-            model_inputs = np.concatenate([input_sequence, dummy_frame], axis=1)
-            model_outputs = session.run(self.outputs, feed_dict={self.data_inputs: model_inputs})
-            prediction = model_outputs[:, -1:, :]
-            predictions.append(prediction)
-            input_sequence = np.concatenate([input_sequence, predictions[-1]], axis=1)
-            input_sequence = input_sequence[:, 1:, :]
-
-        return np.concatenate(predictions, axis=1)
+        feed_dict = {self.sampling_seed: seed_sequence,
+                     self.sampling_steps: prediction_steps}
+        return session.run(self.sampled_outputs, feed_dict=feed_dict)
 
 
 
@@ -17,6 +17,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import time
 import tensorflow as tf
 
+from common.constants import Constants as C
 from spl.model.base_model import BaseModel
 
 
@@ -63,9 +64,11 @@ class ZeroVelocityBaseline(BaseModel):
     
     def sampled_step(self, session, prediction_steps=None):
         assert self.is_eval, "Only works in sampling mode."
-        prediction, targets, seed_sequence, data_id = session.run([self.outputs,
-                                                                   self.prediction_targets,
-                                                                   self.data_inputs[:, :self.source_seq_len],
+        # Fetched in the scale of the dataset. See BaseModel.normalize.
+        data_inputs = self.data_placeholders[C.BATCH_INPUT]
+        prediction, targets, seed_sequence, data_id = session.run([self.unnormalized_outputs,
+                                                                   data_inputs[:, self.source_seq_len:],
+                                                                   data_inputs[:, :self.source_seq_len],
                                                                    self.data_ids])
         return prediction, targets, seed_sequence, data_id
 
@@ -28,7 +28,10 @@ import numpy as np
 import tensorflow as tf
 
 from common.constants import Constants as C
+import spl.util.tf_utils as model_utils
+from spl.data.base_dataset import get_stats_file
 from spl.data.amass_tf import TFRecordMotionDataset
+from spl.data.mmap_dataset import MmapMotionDataset
 from spl.data.srnn_tf import SRNNTFRecordMotionDataset
 from spl.model.zero_velocity import ZeroVelocityBaseline
 from spl.model.rnn import RNN
@@ -75,13 +78,23 @@ tf.app.flags.DEFINE_string("glog_comment", None, "A descriptive text for Google
 # Data
 tf.app.flags.DEFINE_enum("data_type", "rotmat", ["rotmat", "aa", "quat", "euler"],
                          "Which data representation: rotmat (rotation matrix), aa (angle axis), quat (quaternion).")
+tf.app.flags.DEFINE_boolean("canonical_data", False, "Read the rotmat shards and convert them to data_type in the "
+                                                     "data pipeline.")
 tf.app.flags.DEFINE_boolean("use_h36m", False, "Use H36M for training and validation.")
 tf.app.flags.DEFINE_boolean("no_normalization", False, "If set, do not use zero-mean unit-variance normalization.")
+tf.app.flags.DEFINE_boolean("fused_normalization", False, "Normalize the poses in the model rather than in the data "
+                                                          "pipeline.")
 tf.app.flags.DEFINE_float("random_noise_ratio", 0, "Random uniform noise on inputs.")
 tf.app.flags.DEFINE_integer("source_seq_len", 120, "Number of frames to feed into the encoder.")
 tf.app.flags.DEFINE_integer("target_seq_len", 24, "Number of frames that the decoder has to predict.")
 tf.app.flags.DEFINE_integer("loss_seq_len", 0, "# of frames for training objective.")
 tf.app.flags.DEFINE_integer("batch_size", 32, "Batch size to use during training.")
+tf.app.flags.DEFINE_integer("windows_per_sequence", 1, "# of random training windows extracted from each sequence per "
+                                                       "epoch. If 0, sequences are tiled with non-overlapping windows.")
+tf.app.flags.DEFINE_integer("shuffle_buffer_mb", 0, "Memory budget of the training shuffle buffer in MB. If 0, it holds "
+                                                    "batch_size*10 windows.")
+tf.app.flags.DEFINE_enum("data_backend", "tfrecord", ["tfrecord", "mmap"], "Read the tfrecord shards or the "
+                                                                         "memory-mapped store of each split.")
 # Training loop.
 tf.app.flags.DEFINE_integer("num_epochs", 1000, "Training epochs.")
 tf.app.flags.DEFINE_boolean("exhaustive_validation", False, "Use entire validation samples (takes much longer).")
@@ -157,7 +170,7 @@ def load_latest_checkpoint(sess, saver, experiment_dir):
         # Check if the specific checkpoint exists
         ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
         print("Loading model checkpoint {0}".format(ckpt_name))
-        saver.restore(sess, ckpt.model_checkpoint_path)
+        model_utils.restore_checkpoint(sess, saver, ckpt.model_checkpoint_path)
     else:
         raise (ValueError, "Checkpoint {0} does not seem to exist".format(ckpt.model_checkpoint_path))
 
@@ -212,17 +225,21 @@ def create_model(session):
     if config["use_h36m"]:
         data_dir = os.path.join(data_dir, '../h3.6m/tfrecords/')
 
-    train_data_path = os.path.join(data_dir, config["data_type"], "training", "amass-?????-of-?????")
-    test_data_path = os.path.join(data_dir, config["data_type"], "test", "amass-?????-of-?????")
-    meta_data_path = os.path.join(data_dir, config["data_type"], "training", "stats.npz")
+    # Canonical data is stored as rotation matrices and converted to data_type in the data pipeline. The
+    # normalization statistics of every representation are stored next to each other.
+    stored_data_type = C.ROT_MATRIX if config.get("canonical_data", False) else config["data_type"]
+    train_data_path = os.path.join(data_dir, stored_data_type, "training", "amass-?????-of-?????")
+    test_data_path = os.path.join(data_dir, stored_data_type, "test", "amass-?????-of-?????")
+    meta_data_path = os.path.join(data_dir, stored_data_type, "training", get_stats_file(stored_data_type,
+                                                                                           config["data_type"]))
     
     # Exhaustive validation uses all motion windows extracted from the sequences Since it takes much longer, it is
     # advised to use the default validation procedure. It basically extracts a window randomly or from the center of a
     # motion sequence. The latter one is deterministic and reproducible.
     if config.get("exhaustive_validation", False):
-        valid_data_path = os.path.join(data_dir, config["data_type"], "validation", "amass-?????-of-?????")
+        valid_data_path = os.path.join(data_dir, stored_data_type, "validation", "amass-?????-of-?????")
     else:
-        valid_data_path = os.path.join(data_dir, config["data_type"], "validation_dynamic", "amass-?????-of-?????")
+        valid_data_path = os.path.join(data_dir, stored_data_type, "validation_dynamic", "amass-?????-of-?????")
 
     # Data splits.
     # Each sample in training data is a full motion clip. We extract windows
@@ -235,49 +252,65 @@ def create_model(session):
     if config["use_h36m"]:
         default_seed_len = 50
     beginning_index = default_seed_len - config["source_seq_len"]
+
+    dataset_cls = MmapMotionDataset if args.data_backend == C.DATA_BACKEND_MMAP else TFRecordMotionDataset
+    # If the normalization is fused into the model, the datasets pass unnormalized poses.
+    normalize = not config["no_normalization"] and not config.get("fused_normalization", False)
     
     with tf.name_scope("training_data"):
         window_length = config["source_seq_len"] + config["target_seq_len"]
-        train_data = TFRecordMotionDataset(data_path=train_data_path,
-                                           meta_data_path=meta_data_path,
-                                           batch_size=config["batch_size"],
-                                           shuffle=True,
-                                           extract_windows_of=window_length,
-                                           window_type=C.DATA_WINDOW_RANDOM,
-                                           num_parallel_calls=4,
-                                           normalize=not config["no_normalization"],
-                                           normalization_dim=config.get("normalization_dim", "channel"),
-                                           use_std_norm=config.get("use_std_norm", False))
+        train_data = dataset_cls(data_path=train_data_path,
+                                 meta_data_path=meta_data_path,
+                                 batch_size=config["batch_size"],
+                                 shuffle=True,
+                                 extract_windows_of=window_length,
+                                 window_type=C.DATA_WINDOW_RANDOM,
+                                 windows_per_sequence=config.get("windows_per_sequence", 1),
+                                 shuffle_buffer_mb=args.shuffle_buffer_mb,
+                                 num_parallel_calls=4,
+                                 normalize=normalize,
+                                 stored_data_type=stored_data_type,
+                                 data_type=config["data_type"],
+                                 normalization_dim=config.get("normalization_dim", "channel"),
+                                 use_std_norm=config.get("use_std_norm", False))
         train_pl = train_data.get_tf_samples()
+        num_train_samples = train_data.get_num_samples()
+        if num_train_samples is not None:
+            print("Training epoch: {} samples, {} batches".format(
+                num_train_samples, int(np.ceil(num_train_samples/config["batch_size"]))))
     
     with tf.name_scope("validation_data"):
         if config.get("exhaustive_validation", False):
             window_length = 0
-        valid_data = TFRecordMotionDataset(data_path=valid_data_path,
-                                           meta_data_path=meta_data_path,
-                                           batch_size=config["batch_size"] * 2,
-                                           shuffle=False,
-                                           extract_windows_of=window_length,
-                                           window_type=C.DATA_WINDOW_CENTER,
-                                           num_parallel_calls=4,
-                                           normalize=not config["no_normalization"],
-                                           normalization_dim=config.get("normalization_dim", "channel"),
-                                           use_std_norm=config.get("use_std_norm", False))
+        valid_data = dataset_cls(data_path=valid_data_path,
+                                 meta_data_path=meta_data_path,
+                                 batch_size=config["batch_size"] * 2,
+                                 shuffle=False,
+                                 extract_windows_of=window_length,
+                                 window_type=C.DATA_WINDOW_CENTER,
+                                 num_parallel_calls=4,
+                                 normalize=normalize,
+                                 stored_data_type=stored_data_type,
+                                 data_type=config["data_type"],
+                                 normalization_dim=config.get("normalization_dim", "channel"),
+                                 use_std_norm=config.get("use_std_norm", False))
         valid_pl = valid_data.get_tf_samples()
     
     with tf.name_scope("test_data"):
         window_length = config["source_seq_len"] + config["target_seq_len"]
-        test_data = TFRecordMotionDataset(data_path=test_data_path,
-                                          meta_data_path=meta_data_path,
-                                          batch_size=config["batch_size"] * 2,
-                                          shuffle=False,
-                                          extract_windows_of=window_length,
-                                          window_type=C.DATA_WINDOW_BEGINNING,
-                                          num_parallel_calls=4,
-                                          normalize=not config["no_normalization"],
-                                          normalization_dim=config.get("normalization_dim", "channel"),
-                                          beginning_index=beginning_index,
-                                          use_std_norm=config.get("use_std_norm", False))
+        test_data = dataset_cls(data_path=test_data_path,
+                                meta_data_path=meta_data_path,
+                                batch_size=config["batch_size"] * 2,
+                                shuffle=False,
+                                extract_windows_of=window_length,
+                                window_type=C.DATA_WINDOW_BEGINNING,
+                                num_parallel_calls=4,
+                                normalize=normalize,
+                                stored_data_type=stored_data_type,
+                                data_type=config["data_type"],
+                                normalization_dim=config.get("normalization_dim", "channel"),
+                                beginning_index=beginning_index,
+                                use_std_norm=config.get("use_std_norm", False))
         test_pl = test_data.get_tf_samples()
 
     # Models.
@@ -286,7 +319,8 @@ def create_model(session):
             config=config,
             data_pl=train_pl,
             mode=C.TRAIN,
-            reuse=False)
+            reuse=False,
+            normalization_stats=train_data.get_normalization_stats())
         train_model.build_graph()
 
     with tf.name_scope(C.SAMPLE):
@@ -294,7 +328,8 @@ def create_model(session):
             config=config,
             data_pl=valid_pl,
             mode=C.SAMPLE,
-            reuse=True)
+            reuse=True,
+            normalization_stats=train_data.get_normalization_stats())
         valid_model.build_graph()
 
     with tf.name_scope(C.TEST):
@@ -302,7 +337,8 @@ def create_model(session):
             config=config,
             data_pl=test_pl,
             mode=C.SAMPLE,
-            reuse=True)
+            reuse=True,
+            normalization_stats=train_data.get_normalization_stats())
         test_model.build_graph()
 
     # Return of this function.
@@ -327,7 +363,7 @@ def create_model(session):
                                                   # extract_windows_of=extract_windows_of,
                                                   # extract_random_windows=False,
                                                   num_parallel_calls=4,
-                                                  normalize=not config["no_normalization"],
+                                                  normalize=normalize,
                                                   normalization_dim=config.get("normalization_dim", "channel"),
                                                   use_std_norm=config.get("use_std_norm", False))
             srnn_pl = srnn_data.get_tf_samples()
@@ -338,7 +374,8 @@ def create_model(session):
                 data_pl=srnn_pl,
                 mode=C.SAMPLE,
                 reuse=True,
-                dtype=tf.float32)
+                dtype=tf.float32,
+                normalization_stats=train_data.get_normalization_stats())
             srnn_model.build_graph()
 
         models.append(srnn_model)
@@ -0,0 +1,108 @@
+"""
+Attention weights of the Transformer2d model are only captured if an attention capture policy is set. The policy is
+passed via `config["attention_capture"]` and is one of
+    - "off" or None: attention weights are not captured (default).
+    - "last_layer": attention weights of the last layer for every predicted frame.
+    - a selection of layers and predicted frames, either as a dict {"layers": [0, 7], "frames": [0, 5, 10]} or as a
+      string "layers=0,7/frames=0,5,10". If one of them is omitted, all layers or frames are captured.
+
+Captured weights are written into an `AttentionStore` in float16 rather than being kept in memory.
+"""
+import os
+import json
+import numpy as np
+from common.constants import Constants as C
+
+
+def get_capture_policy(policy, num_layers):
+    """
+    Parses the attention capture policy.
+
+    Args:
+        policy: None, a string or a dict. See the module docstring.
+        num_layers: Number of transformer layers.
+    Returns:
+        None if the attention weights are not captured. Otherwise a dict with "layers" (list of layer indices) and
+        "frames" (list of predicted frame indices or None for all frames).
+    """
+    if policy is None or policy == C.ATTN_CAPTURE_OFF:
+        return None
+    if policy == C.ATTN_CAPTURE_LAST_LAYER:
+        return {"layers": [num_layers - 1], "frames": None}
+
+    if isinstance(policy, str):
+        selection = dict()
+        for item in policy.split("/"):
+            key, values = item.split("=")
+            selection[key.strip()] = [int(v) for v in values.split(",")]
+        policy = selection
+
+    unknown_keys = set(policy.keys()) - {"layers", "frames"}
+    if unknown_keys:
+        raise Exception("Unknown attention capture policy keys: {}".format(unknown_keys))
+    layers = sorted(policy.get("layers") or range(num_layers))
+    if layers[0] < 0 or layers[-1] >= num_layers:
+        raise Exception("Attention capture layers must be in [0, {}).".format(num_layers))
+    frames = policy.get("frames")
+    return {"layers": layers, "frames": sorted(frames) if frames else None}
+
+
+class AttentionStore(object):
+    """
+    Appends captured attention weights to float16 files on disk.
+
+    Every attention type (i.e., temporal and spatial) is written into a separate binary file `<type>.f16` where each
+    record corresponds to a sample. Sample ids and record shapes are stored in `index.json` when the store is closed.
+    Use `load_attention_store` to read the weights back as memory-mapped arrays.
+    """
+    def __init__(self, store_dir, policy=None):
+        """
+        Args:
+            store_dir: Directory of the store. Created if it does not exist.
+            policy: Attention capture policy. Only kept in the index for reference.
+        """
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.store_dir = store_dir
+        self.policy = policy
+        self.sample_ids = []
+        self.shapes = dict()
+        self.files = dict()
+
+    def write(self, sample_ids, attention):
+        """
+        Args:
+            sample_ids: Sample ids of the batch.
+            attention: A dict of attention weights with shape (batch_size, num_frames, num_layers, ...).
+        """
+        for key, weights in attention.items():
+            if key not in self.files:
+                self.shapes[key] = list(weights.shape[1:])
+                self.files[key] = open(os.path.join(self.store_dir, key + ".f16"), "wb")
+            assert list(weights.shape[1:]) == self.shapes[key], "Attention weights must have the same shape."
+            self.files[key].write(np.ascontiguousarray(weights, dtype=np.float16).tobytes())
+        self.sample_ids.extend([id_.decode("utf-8") if isinstance(id_, bytes) else id_ for id_ in sample_ids])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = dict()
+        with open(os.path.join(self.store_dir, "index.json"), "w") as f:
+            json.dump({"ids": self.sample_ids, "shapes": self.shapes, "policy": self.policy}, f)
+
+
+def load_attention_store(store_dir):
+    """
+    Args:
+        store_dir: Directory of an `AttentionStore`.
+    Returns:
+        list of sample ids, dict of memory-mapped float16 arrays with shape (num_samples, num_frames, num_layers, ...)
+    """
+    with open(os.path.join(store_dir, "index.json"), "r") as f:
+        index = json.load(f)
+    num_samples = len(index["ids"])
+    weights = dict()
+    for key, shape in index["shapes"].items():
+        weights[key] = np.memmap(os.path.join(store_dir, key + ".f16"), dtype=np.float16, mode="r",
+                                 shape=tuple([num_samples] + shape))
+    return index["ids"], weights
@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 from common.constants import Constants as C
 from tensorflow.python.ops import array_ops
@@ -41,6 +42,116 @@ def get_activation_fn(activation=C.RELU):
         raise Exception("Activation function is not implemented.")
     
 
+# Stores "<stacked variable name>=<per-joint variable name format>" strings. See `joint_dense`.
+JOINT_DENSE_LEGACY_COLLECTION = "joint_dense_legacy_variables"
+
+
+def joint_dense(inputs, units, num_joints, activation=None, use_bias=True, name=None, reuse=None, legacy_scope=None):
+    """
+    A dense layer with separate parameters for every joint. It is equivalent to calling `tf.layers.dense` on each joint
+    in a python loop, but keeps the weights in a single stacked kernel of shape (num_joints, input_size, units) and
+    applies them with one batched matmul.
+
+    Args:
+        inputs: A tensor of shape (..., num_joints, input_size).
+        units: Output size per joint.
+        num_joints: Number of joints.
+        activation: Activation function or None.
+        use_bias: Whether to add a joint-specific bias.
+        name: Variable scope name.
+        reuse: Whether to reuse the variables.
+        legacy_scope: Format string of the per-joint scope that the loop implementation used, relative to the current
+            variable scope (i.e., "embedding_{}/dense"). If given, old checkpoints can be restored via
+            `restore_checkpoint`.
+    Returns:
+        A tensor of shape (..., num_joints, units).
+    """
+    input_size = inputs.get_shape().as_list()[-1]
+    parent_scope = tf.get_variable_scope().name
+    with tf.variable_scope(name, default_name="joint_dense", reuse=reuse):
+        # Same as glorot uniform initialization of `tf.layers.dense`. The default initializer would consider the joint
+        # dimension as receptive field.
+        limit = np.sqrt(6.0 / (input_size + units))
+        kernel = tf.get_variable("kernel", [num_joints, input_size, units],
+                                 initializer=tf.random_uniform_initializer(-limit, limit))
+        flat_inputs = tf.reshape(inputs, [-1, num_joints, input_size])
+        outputs = tf.einsum("nji,jio->njo", flat_inputs, kernel)
+        variables = [kernel]
+        if use_bias:
+            bias = tf.get_variable("bias", [num_joints, units], initializer=tf.zeros_initializer())
+            outputs += bias
+            variables.append(bias)
+        activation_fn = get_activation_fn(activation)
+        if activation_fn is not None:
+            outputs = activation_fn(outputs)
+
+        outputs = tf.reshape(outputs, tf.concat([tf.shape(inputs)[:-1], [units]], axis=0))
+        outputs.set_shape(inputs.get_shape()[:-1].concatenate([units]))
+
+    if legacy_scope is not None:
+        prefix = parent_scope + "/" if parent_scope else ""
+        registered = tf.get_collection(JOINT_DENSE_LEGACY_COLLECTION)
+        for var_ in variables:
+            entry = "{}={}{}/{}".format(var_.op.name, prefix, legacy_scope, var_.op.name.split("/")[-1])
+            if entry not in registered:
+                tf.add_to_collection(JOINT_DENSE_LEGACY_COLLECTION, entry)
+    return outputs
+
+
+def restore_checkpoint(session, saver, checkpoint_path):
+    """
+    Restores the model parameters. Checkpoints that were created before the joint-specific layers were stacked store
+    one variable per joint. They are stacked and loaded into the corresponding `joint_dense` variables.
+
+    Args:
+        session: TF session object.
+        saver: A tf.train.Saver object.
+        checkpoint_path: Path to the checkpoint.
+    """
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    saved_variables = reader.get_variable_to_shape_map()
+    missing_variables = [v for v in tf.global_variables() if v.op.name not in saved_variables]
+    if not missing_variables:
+        saver.restore(session, checkpoint_path)
+        return
+
+    print("Mapping per-joint variables of {} onto stacked variables.".format(checkpoint_path))
+    legacy_map = dict(entry.split("=", 1) for entry in tf.get_collection(JOINT_DENSE_LEGACY_COLLECTION))
+    legacy_values = dict()
+    for var_ in missing_variables:
+        name = var_.op.name
+        # Optimizer slots (i.e., kernel/Adam) are stored next to the variable.
+        stacked_name = [k for k in legacy_map if name == k or name.startswith(k + "/")]
+        if not stacked_name:
+            raise ValueError("Variable {} not found in checkpoint {}.".format(name, checkpoint_path))
+        suffix = name[len(stacked_name[0]):]
+        legacy_names = [legacy_map[stacked_name[0]].format(j) + suffix for j in range(var_.shape.as_list()[0])]
+        for legacy_name in legacy_names:
+            if legacy_name not in saved_variables:
+                raise ValueError("Variable {} not found in checkpoint {}.".format(legacy_name, checkpoint_path))
+        legacy_values[var_] = np.stack([reader.get_tensor(n) for n in legacy_names])
+
+    restored_variables = [v for v in tf.global_variables() if v.op.name in saved_variables]
+    tf.train.Saver(restored_variables).restore(session, checkpoint_path)
+    for var_, value in legacy_values.items():
+        var_.load(value, session)
+
+
+def fill_sequence_padding(inputs, seq_len):
+    """
+    Replaces the zero paddings of a padded batch with the last valid frame of the corresponding sequence.
+
+    Args:
+        inputs: A tensor of shape (batch_size, max_seq_len, feature_size).
+        seq_len: A tensor of shape (batch_size, ) with the actual sequence lengths.
+    Returns:
+        A tensor with the same shape as `inputs`.
+    """
+    frame_idx = tf.range(tf.shape(inputs)[1])[tf.newaxis]
+    frame_idx = tf.minimum(frame_idx, tf.expand_dims(tf.cast(seq_len, tf.int32), axis=1) - 1)
+    return tf.gather(inputs, frame_idx, batch_dims=1)
+
+
 def get_reduce_loss_func(op_type="sum_mean", seq_len=None):
     """
 
@@ -0,0 +1,111 @@
+"""
+
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Reports the error introduced by storing the poses with reduced precision (see spl.data.pose_encoding). The float32
+poses of a held-out split are encoded and decoded again. The decoded poses are evaluated against the float32 ones
+with the same metrics as the models, i.e., the reported numbers are the error of a perfect model trained and evaluated
+on the reduced precision data. The first `seq_len` frames of every sequence are evaluated.
+
+Example:
+    python validate_pose_encoding.py --data_dir <AMASS_DATA> --data_type rotmat --poses_dtype int16
+"""
+import os
+import glob
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+from common.constants import Constants as C
+from spl.data.pose_encoding import encode_poses, decode_poses, decode_example
+from visualization.fk import H36MForwardKinematics
+from visualization.fk import SMPLForwardKinematics
+from metrics.motion_metrics import MetricsEngine
+
+
+def read_split(split_dir):
+    """
+    Returns:
+        Generator of the float32 poses of all records in the tfrecord shards of `split_dir`.
+    """
+    for shard in sorted(glob.glob(os.path.join(split_dir, "*-?????-of-?????"))):
+        for serialized in tf.python_io.tf_record_iterator(shard):
+            yield decode_example(serialized)[0]
+
+
+def validate(split_dir, poses_dtype, metrics_engine, seq_len, batch_size):
+    """
+    Encodes and decodes the poses of the split and aggregates the metrics of the decoded poses.
+    Returns:
+        Number of evaluated sequences, maximum absolute error and root mean squared error of the decoded poses.
+    """
+    n_sequences, max_error, sum_squared_error, n_values = 0, 0.0, 0.0, 0
+    batch_targets, batch_predictions = [], []
+    for poses in read_split(split_dir):
+        if poses.shape[0] < seq_len:
+            continue
+        targets = poses[:seq_len]
+        predictions = decode_poses(encode_poses(targets, poses_dtype), poses_dtype)
+
+        error = predictions - targets
+        max_error = max(max_error, float(np.abs(error).max()))
+        sum_squared_error += float(np.sum(np.square(error, dtype=np.float64)))
+        n_values += error.size
+        n_sequences += 1
+
+        batch_targets.append(targets)
+        batch_predictions.append(predictions)
+        if len(batch_targets) == batch_size:
+            metrics_engine.compute_and_aggregate(np.stack(batch_predictions), np.stack(batch_targets))
+            batch_targets, batch_predictions = [], []
+
+    if batch_targets:
+        metrics_engine.compute_and_aggregate(np.stack(batch_predictions), np.stack(batch_targets))
+    return n_sequences, max_error, np.sqrt(sum_squared_error/max(n_values, 1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default=os.environ.get("AMASS_DATA"), help="Data directory.")
+    parser.add_argument("--data_type", default="rotmat", choices=["rotmat", "aa", "quat"], help="Data representation.")
+    parser.add_argument("--split", default="validation_dynamic", help="Name of the held-out split.")
+    parser.add_argument("--poses_dtype", default=C.DATA_POSES_FLOAT16,
+                        choices=[C.DATA_POSES_FLOAT16, C.DATA_POSES_INT16], help="Storage precision to validate.")
+    parser.add_argument("--use_h36m", action="store_true", help="Evaluate with the H36M skeleton.")
+    parser.add_argument("--batch_size", type=int, default=64, help="Number of sequences per metric computation.")
+    args = parser.parse_args()
+
+    if args.use_h36m:
+        fk_engine = H36MForwardKinematics()
+        target_lengths = C.METRIC_TARGET_LENGTHS_H36M_25FPS
+    else:
+        fk_engine = SMPLForwardKinematics()
+        target_lengths = C.METRIC_TARGET_LENGTHS_AMASS
+
+    metrics_engine = MetricsEngine(fk_engine,
+                                   target_lengths,
+                                   force_valid_rot=True,
+                                   pck_threshs=C.METRIC_PCK_THRESHS,
+                                   rep=args.data_type)
+    metrics_engine.reset()
+
+    split_dir = os.path.join(args.data_dir, args.data_type, args.split)
+    n_sequences, max_error, rmse = validate(split_dir, args.poses_dtype, metrics_engine, max(target_lengths),
+                                            args.batch_size)
+    print("Validated {} with {} poses on {} sequences.".format(split_dir, args.poses_dtype, n_sequences))
+    print("Max. absolute error: {:.6f}   RMSE: {:.6f}".format(max_error, rmse))
+    print(metrics_engine.get_summary_string_all(metrics_engine.get_final_metrics(), target_lengths,
+                                                C.METRIC_PCK_THRESHS, report_pck=True))
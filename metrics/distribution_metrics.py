@@ -29,6 +29,74 @@ def power_spectrum(seq):
     return seq_ps_global
 
 
+class PowerSpectrumAccumulator(object):
+    """
+    Computes the same normalized power spectrum as `power_spectrum` but consumes the sequences batch by batch, so that
+    the full data set never has to be in memory. It keeps the running sum of the power per joint and feature and the
+    running mean and variance of the joint values, which determine `dims_to_use` once all batches have been seen.
+    """
+    def __init__(self, chunk_len=None):
+        """
+        Args:
+            chunk_len: If given, sequences longer than `chunk_len` are split into non-overlapping chunks of this length
+              before computing the spectrum (cf. `split_into_chunks`).
+        """
+        self.chunk_len = chunk_len
+        self.n_samples = 0
+        self.n_values = 0
+        self.mean = None
+        self.m2 = None
+        self.ps_sum = None
+
+    def update(self, seq):
+        """
+        Args:
+            seq: (batch_size, n_joints, seq_len, feature_size)
+        """
+        seq = np.asarray(seq, dtype=np.float64)
+        seq_len = seq.shape[2]
+        if self.chunk_len is not None and self.chunk_len < seq_len:
+            n_chunks = seq_len // self.chunk_len
+            seq = seq[:, :, :n_chunks*self.chunk_len]
+            seq = np.reshape(seq, seq.shape[:2] + (n_chunks, self.chunk_len, seq.shape[-1]))
+            seq = np.reshape(np.transpose(seq, [2, 0, 1, 3, 4]), (-1,) + seq.shape[1:2] + seq.shape[3:])
+            seq_len = self.chunk_len
+
+        if self.ps_sum is None:
+            self.mean = np.zeros([seq.shape[1], seq.shape[3]])
+            self.m2 = np.zeros([seq.shape[1], seq.shape[3]])
+            self.ps_sum = np.zeros([seq_len, seq.shape[1], seq.shape[3]])
+        assert self.ps_sum.shape == (seq_len, seq.shape[1], seq.shape[3]), "sequences must have the same shape"
+
+        # merge mean and variance of the batch with the running statistics (Chan et al.)
+        n_batch = seq.shape[0]*seq_len
+        batch_mean = seq.mean(axis=(0, 2))
+        batch_m2 = np.square(seq - batch_mean[np.newaxis, :, np.newaxis]).sum(axis=(0, 2))
+        n_total = self.n_values + n_batch
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta*n_batch/n_total
+        self.m2 = self.m2 + batch_m2 + np.square(delta)*self.n_values*n_batch/n_total
+        self.n_values = n_total
+
+        # |fft|^2 of real sequences is symmetric, so the full spectrum is obtained by mirroring the output of `rfft`
+        seq_ps = np.square(np.abs(np.fft.rfft(seq, axis=2)))
+        seq_ps = np.concatenate([seq_ps, seq_ps[:, :, seq_len - seq_ps.shape[2]:0:-1]], axis=2)
+        self.ps_sum += np.transpose(seq_ps.sum(axis=0), [1, 0, 2])
+        self.n_samples += seq.shape[0]
+
+    def finalize(self):
+        """
+        Returns:
+            The normalized power spectrum as returned by `power_spectrum`.
+        """
+        assert self.ps_sum is not None, "no sequences have been added"
+        std = np.sqrt(self.m2 / self.n_values)
+        dims_to_use = np.where((std >= 1e-4).all(axis=-1))[0]
+        seq_ps_global = np.reshape(self.ps_sum[:, dims_to_use], [1, self.ps_sum.shape[0], -1]) + 1e-8
+        seq_ps_global /= seq_ps_global.sum(axis=1, keepdims=True)
+        return seq_ps_global
+
+
 def ps_entropy(seq_ps):
     """
     
@@ -51,7 +119,37 @@ def ps_kld(seq_ps_from, seq_ps_to):
     return np.sum(seq_ps_from * np.log(seq_ps_from / seq_ps_to), axis=1)
 
 
-def compute_npss(euler_gt_sequences, euler_pred_sequences):
+def _npss_emd(euler_gt_sequences, euler_pred_sequences):
+    """
+    EMD between the power spectra of ground-truth and predicted sequences, see `compute_npss`.
+
+    Args:
+        euler_gt_sequences: (n_sequences, seq_len, feature_size)
+        euler_pred_sequences: (n_sequences, seq_len, feature_size)
+    Returns:
+        EMD and total ground-truth power per sequence and feature dimension, both (n_sequences, feature_size).
+    """
+    seq_len = euler_gt_sequences.shape[1]
+    sequences = np.stack([euler_gt_sequences, euler_pred_sequences]).astype(np.float64)
+
+    # the reference implementation assigns the fourier coefficients to a real-valued array, i.e. the power is computed
+    # on the real part only. We keep this so that values remain comparable to published results. For real inputs the
+    # real part is symmetric, so the full spectrum is obtained by mirroring the output of `rfft`.
+    coeffs = np.fft.rfft(sequences, axis=2).real
+    coeffs = np.concatenate([coeffs, coeffs[:, :, seq_len - coeffs.shape[2]:0:-1]], axis=2)
+    power = np.square(coeffs)  # (2, n_sequences, seq_len, feature_size)
+
+    # normalizing power per sequence per dim, sequences with zero power stay at zero
+    total_power = np.sum(power, axis=2, keepdims=True)
+    norm_power = np.divide(power, total_power, out=np.zeros_like(power), where=total_power != 0)
+
+    # computing cumsum over freq and EMD
+    cdf_power = np.cumsum(norm_power, axis=2)
+    emd = np.sum(np.abs(cdf_power[1] - cdf_power[0]), axis=1)
+    return emd, total_power[0, :, 0]
+
+
+def compute_npss(euler_gt_sequences, euler_pred_sequences, chunk_size=256):
     """
     Computing normalized Normalized Power Spectrum Similarity (NPSS)
     Taken from @github.com neural_temporal_models/blob/master/metrics.py#L51
@@ -62,71 +160,26 @@ def compute_npss(euler_gt_sequences, euler_pred_sequences):
     4) cumsum over freq.
     5) EMD
     
+    Sequences are processed in chunks of `chunk_size` so that long rollouts do not require all intermediate spectra
+    to be in memory at once.
+    
     Args:
-        euler_gt_sequences:
-        euler_pred_sequences:
+        euler_gt_sequences: (n_sequences, seq_len, feature_size)
+        euler_pred_sequences: (n_sequences, seq_len, feature_size)
+        chunk_size: Number of sequences processed at once.
     Returns:
+        EMD averaged over sequences and feature dimensions, weighted by the power of the ground-truth sequences.
     """
-    gt_fourier_coeffs = np.zeros(euler_gt_sequences.shape)
-    pred_fourier_coeffs = np.zeros(euler_pred_sequences.shape)
-    
-    # power vars
-    gt_power = np.zeros((gt_fourier_coeffs.shape))
-    pred_power = np.zeros((gt_fourier_coeffs.shape))
-    
-    # normalizing power vars
-    gt_norm_power = np.zeros(gt_fourier_coeffs.shape)
-    pred_norm_power = np.zeros(gt_fourier_coeffs.shape)
-    
-    cdf_gt_power = np.zeros(gt_norm_power.shape)
-    cdf_pred_power = np.zeros(pred_norm_power.shape)
-    
-    emd = np.zeros(cdf_pred_power.shape[0:3:2])
-    
-    # used to store powers of feature_dims and sequences used for avg later
-    seq_feature_power = np.zeros(euler_gt_sequences.shape[0:3:2])
-    power_weighted_emd = 0
-    
-    for s in range(euler_gt_sequences.shape[0]):
-        
-        for d in range(euler_gt_sequences.shape[2]):
-            gt_fourier_coeffs[s, :, d] = np.fft.fft(
-                euler_gt_sequences[s, :, d])  # slice is 1D array
-            pred_fourier_coeffs[s, :, d] = np.fft.fft(
-                euler_pred_sequences[s, :, d])
-            
-            # computing power of fft per sequence per dim
-            gt_power[s, :, d] = np.square(
-                np.absolute(gt_fourier_coeffs[s, :, d]))
-            pred_power[s, :, d] = np.square(
-                np.absolute(pred_fourier_coeffs[s, :, d]))
-            
-            # matching power of gt and pred sequences
-            gt_total_power = np.sum(gt_power[s, :, d])
-            pred_total_power = np.sum(pred_power[s, :, d])
-            # power_diff = gt_total_power - pred_total_power
-            
-            # adding power diff to zero freq of pred seq
-            # pred_power[s,0,d] = pred_power[s,0,d] + power_diff
-            
-            # computing seq_power and feature_dims power
-            seq_feature_power[s, d] = gt_total_power
-            
-            # normalizing power per sequence per dim
-            if gt_total_power != 0:
-                gt_norm_power[s, :, d] = gt_power[s, :, d]/gt_total_power
-            
-            if pred_total_power != 0:
-                pred_norm_power[s, :, d] = pred_power[s, :, d]/pred_total_power
-            
-            # computing cumsum over freq
-            cdf_gt_power[s, :, d] = np.cumsum(gt_norm_power[s, :, d])  # slice is 1D
-            cdf_pred_power[s, :, d] = np.cumsum(pred_norm_power[s, :, d])
-            
-            # computing EMD
-            emd[s, d] = np.linalg.norm((cdf_pred_power[s, :, d] - cdf_gt_power[s, :, d]), ord=1)
-    
+    assert euler_gt_sequences.shape == euler_pred_sequences.shape
+    weighted_emd_sum = 0.0
+    power_sum = 0.0
+    for start in range(0, euler_gt_sequences.shape[0], chunk_size):
+        emd, seq_feature_power = _npss_emd(euler_gt_sequences[start:start + chunk_size],
+                                           euler_pred_sequences[start:start + chunk_size])
+        weighted_emd_sum += np.sum(emd * seq_feature_power)
+        power_sum += np.sum(seq_feature_power)
+
     # computing weighted emd (by sequence and feature powers)
-    power_weighted_emd = np.average(emd, weights=seq_feature_power)
-    
-    return power_weighted_emd
+    if power_sum == 0:
+        raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+    return weighted_emd_sum / power_sum
@@ -13,13 +13,12 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import numpy as np
-import cv2
 import quaternion
 import tensorflow as tf
 import copy
 
 from common.conversions import is_valid_rotmat, rotmat2euler, aa2rotmat
-from common.conversions import get_closest_rotmat, sparse_to_full, local_rot_to_global
+from common.conversions import get_closest_rotmat, sparse_to_full
 
 
 def pck(predictions, targets, thresh):
@@ -63,13 +62,15 @@ def angle_diff(predictions, targets):
     # compute R1 * R2.T, if prediction and target match, this will be the identity matrix
     r = np.matmul(preds, np.transpose(targs, [0, 2, 1]))
 
-    # convert `r` to angle-axis representation and extract the angle, which is our measure of difference between
-    # the predicted and target orientations
-    angles = []
-    for i in range(r.shape[0]):
-        aa, _ = cv2.Rodrigues(r[i])
-        angles.append(np.linalg.norm(aa))
-    angles = np.array(angles)
+    # the angle of `r` is our measure of difference between the predicted and target orientations. The trace gives
+    # cos(angle) and the skew-symmetric part sin(angle). Using atan2 on both instead of arccos(cos(angle)) keeps the
+    # result accurate close to 0 and pi, where arccos is ill-conditioned.
+    cos_angle = (np.trace(r, axis1=-2, axis2=-1) - 1.0) / 2.0
+    skew = np.stack([r[:, 2, 1] - r[:, 1, 2],
+                     r[:, 0, 2] - r[:, 2, 0],
+                     r[:, 1, 0] - r[:, 0, 1]], axis=-1)
+    sin_angle = np.linalg.norm(skew, axis=-1) / 2.0
+    angles = np.arctan2(sin_angle, cos_angle)
 
     return np.reshape(angles, ori_shape)
 
@@ -264,12 +265,12 @@ class MetricsEngine(object):
 
         metrics = dict()
 
-        if "positional" in self.which or "pck" in self.which:
-            # need to compute positions - only do this once for efficiency
-            pred_pos = self.fk_engine.from_rotmat(pred)  # (-1, full_n_joints, 3)
-            targ_pos = self.fk_engine.from_rotmat(targ)  # (-1, full_n_joints, 3)
+        if "positional" in self.which or "joint_angle" in self.which or any(m.startswith("pck") for m in self.which):
+            # need to compute positions and global rotations - only traverse the kinematic chain once for efficiency
+            pred_pos, pred_global = self.fk_engine.from_rotmat(pred, return_rotations=True)  # (-1, full_n_joints, 3)
+            targ_pos, targ_global = self.fk_engine.from_rotmat(targ, return_rotations=True)  # (-1, full_n_joints, 3)
         else:
-            pred_pos = targ_pos = None
+            pred_pos = targ_pos = pred_global = targ_global = None
 
         select_joints = self.fk_engine.major_joints if self.is_sparse else list(range(self.fk_engine.n_joints))
         reduce_fn_np = np.mean if reduce_fn == "mean" else np.sum
@@ -285,10 +286,6 @@ class MetricsEngine(object):
                 metrics[metric] = reduce_fn_np(v, axis=-1)
             elif metric == "joint_angle":
                 # compute the joint angle diff on the global rotations, not the local ones, which is a harder metric
-                pred_global = local_rot_to_global(pred, self.fk_engine.parents, left_mult=self.fk_engine.left_mult,
-                                                  rep="rotmat")  # (-1, full_n_joints, 3, 3)
-                targ_global = local_rot_to_global(targ, self.fk_engine.parents, left_mult=self.fk_engine.left_mult,
-                                                  rep="rotmat")  # (-1, full_n_joints, 3, 3)
                 v = angle_diff(pred_global[:, select_joints], targ_global[:, select_joints])  # (-1, n_joints)
                 v = np.reshape(v, [batch_size, seq_length, n_joints])
                 metrics[metric] = reduce_fn_np(v, axis=-1)
@@ -0,0 +1,156 @@
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Computes the normalization statistics (stats.npz) of an existing training split from its tfrecord shards or its
+memory-mapped store, e.g., after files were removed from the split, without running the preprocessing again. The shards
+or sequences are split among --n_workers processes which read them in a single pass. The statistics of the processes
+are merged as in preprocess_radar.py.
+
+With --stats_reps, the statistics of other representations are computed as well (stats_<rep>.npz). This requires
+that the split stores rotation matrices. With --window_size, the statistics are computed over windows of the sequences
+and sequences shorter than a window are skipped. With --weighting sequence, every sample (sequence or window) has the
+same weight instead of every frame. The variances are then corrected with the number of samples rather than frames.
+"""
+import argparse
+import glob
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from mastnet.preprocessing.preprocess_radar import StatsAccumulator
+from mastnet.preprocessing.preprocess_radar import rotmat2rep
+from mastnet.preprocessing.preprocess_radar import run_workers
+from mastnet.preprocessing.preprocess_radar import save_stats
+from mastnet.preprocessing.preprocess_radar import split_into_windows
+from mastnet.data.mmap_dataset import load_mmap_store
+from mastnet.data.pose_encoding import decode_example, decode_poses
+
+
+def read_tfrecord_sequences(shards):
+    """
+    Yields:
+        float32 poses and file id of every record in the given shards.
+    """
+    for shard in shards:
+        for serialized in tf.python_io.tf_record_iterator(shard):
+            poses, file_id, _ = decode_example(serialized)
+            yield poses, file_id
+
+
+def read_mmap_sequences(store_dir, indices):
+    """
+    Yields:
+        float32 poses and file id of the sequences of the store with the given indices.
+    """
+    poses, index = load_mmap_store(store_dir)
+    for idx in indices:
+        offset, length = index["offsets"][idx], index["lengths"][idx]
+        yield decode_poses(poses[offset:offset + length], index["poses_dtype"]), str(index["file_ids"][idx])
+
+
+def compute_part_stats(data_path, part, use_mmap, stats_reps=(), window=None, weighting="frame", file_ids=None):
+    """
+    Computes the statistics of the part of a split read by one worker.
+
+    Args:
+        data_path: Directory of the shards or of the memory-mapped store.
+        part: Shard paths or, if `use_mmap`, sequence indices of the store.
+        use_mmap: Whether to read from the memory-mapped store.
+        stats_reps: Other representations to compute the statistics of. The split must store rotation matrices.
+        window: (window_size, stride) to compute the statistics over windows of the sequences, or None.
+        weighting: "frame" if every frame has the same weight, "sequence" if every sample has the same weight.
+        file_ids: Only samples of the files with these ids, e.g., "<db name>/<file name>.pkl", are used. All if None.
+    Returns:
+        The state of the `StatsAccumulator` per statistics file and the number of samples.
+    """
+    sequences = read_mmap_sequences(data_path, part) if use_mmap else read_tfrecord_sequences(part)
+    stats_files = ['stats.npz'] + ['stats_{}.npz'.format(stats_rep) for stats_rep in stats_reps]
+    stats_accumulators = {stats_file: StatsAccumulator() for stats_file in stats_files}
+    n_samples = 0
+
+    for poses, file_id in sequences:
+        # file ids of the records are "<window index>/<db name>/<file name>.pkl"
+        if file_ids is not None and file_id.split('/', 1)[1] not in file_ids:
+            continue
+        samples = poses[np.newaxis, ...] if window is None else split_into_windows(poses, window[0], window[1])
+        for sample in samples:
+            weight = 1.0 / sample.shape[0] if weighting == "sequence" else 1.0
+            stats_accumulators['stats.npz'].update(sample, weight)
+            for stats_rep in stats_reps:
+                stats_accumulators['stats_{}.npz'.format(stats_rep)].update(rotmat2rep(sample, stats_rep), weight)
+            n_samples += 1
+
+    return {stats_file: vars(accumulator) for stats_file, accumulator in stats_accumulators.items()}, n_samples
+
+
+def compute_stats(data_path, output_path, use_mmap=False, stats_reps=(), window=None, weighting="frame",
+                  file_ids=None, n_workers=1):
+    """
+    Computes and saves the statistics of a split. See `compute_part_stats` for the arguments.
+
+    Returns:
+        The statistics as stored in `stats.npz`.
+    """
+    if use_mmap:
+        _, index = load_mmap_store(data_path)
+        sequence_indices = np.arange(len(index["lengths"]))
+        parts = [sequence_indices[worker_idx::n_workers] for worker_idx in range(n_workers)]
+    else:
+        shards = sorted(glob.glob(os.path.join(data_path, "*-?????-of-?????")))
+        if not shards:
+            raise Exception("No tfrecord shards found in {}.".format(data_path))
+        parts = [shards[worker_idx::n_workers] for worker_idx in range(min(n_workers, len(shards)))]
+
+    jobs = [(data_path, part, use_mmap, stats_reps, window, weighting, file_ids) for part in parts]
+    results = run_workers(compute_part_stats, jobs)
+
+    stats_accumulators = dict()
+    for states, _ in results:
+        for stats_file, state in states.items():
+            stats_accumulators.setdefault(stats_file, StatsAccumulator()).merge(StatsAccumulator(state))
+    n_samples = sum(n_samples for _, n_samples in results)
+    if n_samples == 0:
+        raise Exception("No samples found in {}.".format(data_path))
+    print('{:>20} -> {:>4d} samples'.format('Total', n_samples))
+
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    for stats_file, accumulator in stats_accumulators.items():
+        save_stats(accumulator.get_stats(n_samples), output_path, stats_file)
+    return stats_accumulators['stats.npz'].get_stats(n_samples)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", required=True, help="Directory of the tfrecord shards or of the memory-mapped "
+                                                          "store of the training split.")
+    parser.add_argument("--output_dir", help="Where to store the statistics. Defaults to data_dir.")
+    parser.add_argument("--mmap", action="store_true", help="Read the memory-mapped store instead of the shards.")
+    parser.add_argument("--stats_reps", nargs="*", default=[], choices=["aa", "quat", "euler", "rotmat"],
+                        help="Also compute the statistics of these representations from the rotation matrices.")
+    parser.add_argument("--window_size", type=int, default=0, help="Compute the statistics over windows of this many "
+                                                                   "frames instead of the full sequences.")
+    parser.add_argument("--window_stride", type=int, default=0, help="Stride of the windows. Defaults to window_size.")
+    parser.add_argument("--weighting", default="frame", choices=["frame", "sequence"],
+                        help="Whether every frame or every sample (sequence or window) has the same weight.")
+    parser.add_argument("--fnames", help="Text file with the file ids to use, e.g., training_fnames.txt. All files are "
+                                         "used if not given.")
+    parser.add_argument("--n_workers", type=int, default=1, help="Number of processes reading the data.")
+
+    args = parser.parse_args()
+
+    file_ids = None
+    if args.fnames is not None:
+        with open(args.fnames, 'r') as fh:
+            file_ids = set(line.strip() for line in fh.readlines() if line.strip())
+
+    window = None
+    if args.window_size > 0:
+        window = (args.window_size, args.window_stride if args.window_stride > 0 else args.window_size)
+
+    compute_stats(args.data_dir, args.output_dir or args.data_dir, args.mmap, args.stats_reps, window, args.weighting,
+                  file_ids, args.n_workers)
@@ -0,0 +1,139 @@
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Converts tfrecord shards written in the legacy layout (poses stored as FloatList) into the raw layout (poses stored as
+little-endian float32 bytes). All other features are copied as they are. Files that are not tfrecord shards (e.g.,
+stats.npz) are copied to the output directory.
+
+The sample index and the shard manifest of the converted shards are rebuilt (see spl.data.sample_index). With
+--index_only, only the index of the shards in the input directory is written, e.g., for splits that were created before
+the index was introduced.
+
+With --to_mmap, the shards of either layout are converted into a memory-mapped store (see spl.data.mmap_dataset)
+instead. The store can be written into the input directory.
+
+With --poses_dtype float16 or int16, the poses of the shards or the store are stored with reduced precision (see
+spl.data.pose_encoding). Use validate_pose_encoding.py to check the resulting error before training on them.
+"""
+import argparse
+import glob
+import os
+import shutil
+
+import tensorflow as tf
+
+from common.constants import Constants as C
+from mastnet.preprocessing.preprocess_radar import poses_feature
+from mastnet.preprocessing.preprocess_radar import get_sample_id
+from mastnet.data.sample_index import SampleIndexWriter, SAMPLE_INDEX_FILE, SHARD_MANIFEST_FILE, scan_records
+from mastnet.data.mmap_dataset import MmapMotionWriter
+from mastnet.data.pose_encoding import decode_example, get_example_poses_dtype, POSES_RAW_KEYS
+
+
+def convert_example(serialized, poses_dtype=C.DATA_POSES_FLOAT32):
+    """
+    Converts a serialized tf.train.Example into the raw layout with the given precision of the poses. Examples that
+    are already stored like this are returned unchanged.
+    """
+    example = tf.train.Example.FromString(serialized)
+    feature = example.features.feature
+    if get_example_poses_dtype(feature) == poses_dtype:
+        return serialized
+    poses, _, _ = decode_example(serialized)
+    for key in ["poses"] + list(POSES_RAW_KEYS.values()):
+        if key in feature:
+            del feature[key]
+    key, poses_raw = poses_feature(poses, C.DATA_RECORD_RAW, poses_dtype)
+    feature[key].CopyFrom(poses_raw)
+    return example.SerializeToString()
+
+
+def convert_shard(input_file, output_file, poses_dtype=C.DATA_POSES_FLOAT32):
+    n_records = 0
+    writer = tf.python_io.TFRecordWriter(output_file)
+    for serialized in tf.python_io.tf_record_iterator(input_file):
+        writer.write(convert_example(serialized, poses_dtype))
+        n_records += 1
+    writer.close()
+    return n_records
+
+
+def convert_dir(input_dir, output_dir, poses_dtype=C.DATA_POSES_FLOAT32):
+    """
+    Converts all shards in `input_dir` and copies the remaining files.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    shards = sorted(glob.glob(os.path.join(input_dir, "*-?????-of-?????")))
+    for f in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, f)
+        if path in shards or not os.path.isfile(path) or f in [SAMPLE_INDEX_FILE, SHARD_MANIFEST_FILE]:
+            continue
+        shutil.copy(path, os.path.join(output_dir, f))
+
+    for i, shard in enumerate(shards):
+        n_records = convert_shard(shard, os.path.join(output_dir, os.path.basename(shard)), poses_dtype)
+        print("[{:0>5d} / {:0>5d}] converted {} records of {}".format(i + 1, len(shards), n_records, shard))
+    index_dir(output_dir)
+
+
+def index_dir(split_dir):
+    """
+    Writes the sample index of the shards in `split_dir`.
+    """
+    shards = sorted(glob.glob(os.path.join(split_dir, "*-?????-of-?????")))
+    sample_index = SampleIndexWriter(shards)
+    for shard_idx, shard in enumerate(shards):
+        with open(shard, "rb") as f:
+            for _, serialized in scan_records(f):
+                example = tf.train.Example.FromString(serialized)
+                sample_index.add(shard_idx, get_sample_id(example), len(serialized),
+                                 example.features.feature["shape"].int64_list.value[0])
+    sample_index.save(split_dir)
+    print("indexed {} records in {}".format(len(sample_index.sample_ids), split_dir))
+
+
+def convert_dir_to_mmap(input_dir, output_dir, poses_dtype=C.DATA_POSES_FLOAT32):
+    """
+    Writes all records in the shards of `input_dir` into a memory-mapped store in `output_dir` and copies the
+    statistics.
+    """
+    shards = sorted(glob.glob(os.path.join(input_dir, "*-?????-of-?????")))
+    writer = MmapMotionWriter(output_dir, poses_dtype)
+    for i, shard in enumerate(shards):
+        n_records = 0
+        for serialized in tf.python_io.tf_record_iterator(shard):
+            writer.write(*decode_example(serialized))
+            n_records += 1
+        print("[{:0>5d} / {:0>5d}] converted {} records of {}".format(i + 1, len(shards), n_records, shard))
+    writer.close()
+
+    # Also copies the statistics of the representations converted in the data pipeline, i.e., stats_<rep>.npz.
+    if os.path.abspath(input_dir) != os.path.abspath(output_dir):
+        for stats_file in glob.glob(os.path.join(input_dir, "stats*.npz")):
+            shutil.copy(stats_file, os.path.join(output_dir, os.path.basename(stats_file)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", required=True, help="Directory of a split, e.g. <data>/rotmat/training.")
+    parser.add_argument("--output_dir", default=None, help="Where to store the converted shards.")
+    parser.add_argument("--to_mmap", action="store_true", help="Convert the shards into a memory-mapped store.")
+    parser.add_argument("--index_only", action="store_true", help="Only write the sample index of the input shards.")
+    parser.add_argument("--poses_dtype", default=C.DATA_POSES_FLOAT32,
+                        choices=[C.DATA_POSES_FLOAT32, C.DATA_POSES_FLOAT16, C.DATA_POSES_INT16],
+                        help="Storage precision of the converted poses. int16 is not valid for angle-axis.")
+    args = parser.parse_args()
+
+    assert args.index_only or args.output_dir is not None, "--output_dir is required"
+    if args.index_only:
+        index_dir(args.input_dir)
+    elif args.to_mmap:
+        convert_dir_to_mmap(args.input_dir, args.output_dir, args.poses_dtype)
+    else:
+        assert os.path.abspath(args.input_dir) != os.path.abspath(args.output_dir), "shards can't be converted in place"
+        convert_dir(args.input_dir, args.output_dir, args.poses_dtype)
@@ -7,17 +7,7 @@ Aksan et al. (2021)
 import numpy as np
 from six.moves import xrange
 from common.conversions import aa2rotmat, rotmat2euler
-
-
-def read_csv_as_float(filename):
-    out_array = []
-    lines = open(filename).readlines()
-    for line in lines:
-        line = line.strip().split(",")
-        if len(line) > 0:
-            out_array.append(np.array([np.float32(x) for x in line]))
-
-    return np.array(out_array)
+from common.h36m_data import load_sequence
 
 
 def load_data(path_to_dataset, subjects, actions):
@@ -36,12 +26,8 @@ def load_data(path_to_dataset, subjects, actions):
                 filename = "{0}/S{1}/{2}_{3}.txt".format(
                     path_to_dataset, subj, action, subact
                 )
-                action_sequence = read_csv_as_float(filename)
-
-                n, d = action_sequence.shape
-                even_list = range(0, n, 2)
-
-                data[(subj, action, subact, "even")] = action_sequence[even_list, :]
+                # downsample to 25 fps
+                data[(subj, action, subact, "even")] = load_sequence(filename, downsample=2)
 
     return data
 
@@ -18,91 +18,76 @@ Processes the H36M data that Martinez uses.
 import numpy as np
 import os
 import tensorflow as tf
-import cv2
-import quaternion
 
-from mastnet.preprocessing.preprocess_radar import create_tfrecord_writers
 from mastnet.preprocessing.preprocess_radar import write_tfexample
 from mastnet.preprocessing.preprocess_radar import split_into_windows
-from mastnet.preprocessing.preprocess_radar import close_tfrecord_writers
-from common.conversions import aa2rotmat, rotmat2euler
+from mastnet.preprocessing.preprocess_radar import poses_feature
+from mastnet.preprocessing.preprocess_radar import get_sample_id
+from mastnet.preprocessing.preprocess_radar import rotmat2rep
+from mastnet.preprocessing.preprocess_radar import save_stats
+from mastnet.preprocessing.preprocess_radar import StatsAccumulator
+from mastnet.preprocessing.preprocess_radar import create_split_writers
+from mastnet.preprocessing.preprocess_radar import close_split_writers
+from mastnet.preprocessing.preprocess_radar import run_workers
+from mastnet.preprocessing.preprocess_radar import merge_worker_results
+from mastnet.preprocessing.preprocess_radar import get_meta_stats
+from mastnet.preprocessing.preprocess_radar import merge_file_stats
+from common.conversions import aa2rotmat, aa2quat, rotmat2euler
+from common.h36m_data import load_sequence
+from common.constants import Constants as C
 
 H36M_MAJOR_JOINTS = [0, 1, 2, 3, 4, 6, 7, 8, 9, 11, 12, 13, 14, 16, 17, 18, 19, 24, 25, 26, 27]
 H36M_NR_JOINTS = 32
 RNG = np.random.RandomState(42)
 
 
-def read_csv_as_float(filename):
-    """
-    Borrowed from SRNN code. Reads a csv and returns a float matrix.
-    https://github.com/asheshjain399/NeuralModels/blob/master/neuralmodels/utils.py#L34
-
-    Args
-      filename: string. Path to the csv file
-    Returns
-      returnArray: the read data in a float32 matrix
-    """
-    out_array = []
-    lines = open(filename).readlines()
-    for line in lines:
-        line = line.strip().split(',')
-        if len(line) > 0:
-            out_array.append(np.array([np.float32(x) for x in line]))
-
-    return np.array(out_array)
-
-
-def to_tfexample(poses, file_id, db_name, one_hot):
+def to_tfexample(poses, file_id, db_name, one_hot, record_format=C.DATA_RECORD_RAW, poses_dtype=C.DATA_POSES_FLOAT32):
     features = dict()
     features['file_id'] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[file_id.encode('utf-8')]))
     features['db_name'] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[db_name.encode('utf-8')]))
     features['shape'] = tf.train.Feature(int64_list=tf.train.Int64List(value=poses.shape))
-    features['poses'] = tf.train.Feature(float_list=tf.train.FloatList(value=poses.flatten()))
+    key, feature = poses_feature(poses, record_format, poses_dtype)
+    features[key] = feature
     features['one_hot'] = tf.train.Feature(float_list=tf.train.FloatList(value=one_hot))
     example = tf.train.Example(features=tf.train.Features(feature=features))
     return example
 
 
-def process_split(poses, one_hots, file_ids, output_path, n_shards, compute_stats, create_windows=None):
-    print("storing into {} computing stats {}".format(output_path, "YES" if compute_stats else "NO"))
-
-    if compute_stats:
-        assert create_windows is None, "computing the statistics should only be done when not extracting windows"
-
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-
-    # save data as tfrecords
-    tfrecord_writers = create_tfrecord_writers(os.path.join(output_path, 'amass'), n_shards)
-    if create_windows is not None:
-        if not os.path.exists(output_path + "_dynamic"):
-            os.makedirs(output_path + "_dynamic")
-        tfrecord_writers_dyn = create_tfrecord_writers(os.path.join(output_path + "_dynamic", "amass"), n_shards)
-
-    # compute normalization stats online
-    n_all, mean_all, var_all, m2_all = 0.0, 0.0, 0.0, 0.0
-    n_channel, mean_channel, var_channel, m2_channel = 0.0, 0.0, 0.0, 0.0
-    min_all, max_all = np.inf, -np.inf
-    min_seq_len, max_seq_len = np.inf, -np.inf
-
-    # keep track of some stats to print in the end
-    meta_stats_per_db = dict()
+def process_sequences(poses, one_hots, file_ids, output_path, n_shards, compute_stats, create_windows=None,
+                      record_format=C.DATA_RECORD_RAW, write_mmap=False, stats_reps=(),
+                      poses_dtype=C.DATA_POSES_FLOAT32, lazy_windows=False, worker_idx=0, n_workers=1):
+    """
+    Processes the sequences of a split handled by one worker into its shards. Returns the same as
+    `preprocess_radar.process_files`.
+    """
+    writers = create_split_writers(output_path, n_shards, create_windows, write_mmap, poses_dtype, lazy_windows,
+                                   worker_idx, n_workers)
+    window_index, mmap_writer, mmap_writer_dyn = writers['window_index'], writers['mmap'], writers['mmap_dyn']
+    stats_files = ['stats.npz'] + ['stats_{}.npz'.format(stats_rep) for stats_rep in stats_reps]
+    files = dict()
 
     for idx in range(len(poses)):
         pose = poses[idx]  # shape (seq_length, 33*3)
         assert len(pose) > 0, 'file is empty'
 
         db_name = "h36"
-        if db_name not in meta_stats_per_db:
-            meta_stats_per_db[db_name] = {'n_samples': 0, 'n_frames': 0}
+
+        # compute normalization stats online, also for the representations converted from rotation matrices on the fly
+        stats_accumulators = {stats_file: StatsAccumulator() for stats_file in stats_files} if compute_stats else {}
+        entry = {'db_name': db_name, 'hash': None, 'n_records': 0, 'n_frames': 0, 'stats': stats_accumulators}
+        files[file_ids[idx]] = entry
 
         if create_windows is not None:
             if pose.shape[0] < create_windows[0]:
                 continue
 
             # first save it without splitting into windows
-            tfexample = to_tfexample(pose, "{}/{}".format(0, file_ids[idx]), db_name, one_hots[idx])
-            write_tfexample(tfrecord_writers_dyn, tfexample)
+            tfexample = to_tfexample(pose, "{}/{}".format(0, file_ids[idx]), db_name, one_hots[idx], record_format,
+                                     poses_dtype)
+            write_tfexample(writers['tfrecord_dyn'], tfexample, writers['sample_index_dyn'])
+            if mmap_writer_dyn is not None:
+                mmap_writer_dyn.write(pose, "{}/{}".format(0, file_ids[idx]), db_name)
+            sequence_id = get_sample_id(tfexample)
 
             # then split into windows and save later
             pose_w = split_into_windows(pose, create_windows[0], create_windows[1])
@@ -113,39 +98,51 @@ def process_split(poses, one_hots, file_ids, output_path, n_shards, compute_stat
 
         for w in range(pose_w.shape[0]):
             poses_window = pose_w[w]
-            tfexample = to_tfexample(poses_window, "{}/{}".format(w, file_ids[idx]), db_name, one_hots[idx])
-            write_tfexample(tfrecord_writers, tfexample)
-
-            meta_stats_per_db[db_name]['n_samples'] += 1
-            meta_stats_per_db[db_name]['n_frames'] += poses_window.shape[0]
+            if window_index is not None:
+                window_index.add(sequence_id, "{}/{}".format(w, file_ids[idx]), db_name, w*create_windows[1])
+            else:
+                tfexample = to_tfexample(poses_window, "{}/{}".format(w, file_ids[idx]), db_name, one_hots[idx],
+                                         record_format, poses_dtype)
+                write_tfexample(writers['tfrecord'], tfexample, writers['sample_index'])
+            if mmap_writer is not None:
+                mmap_writer.write(poses_window, "{}/{}".format(w, file_ids[idx]), db_name)
+
+            entry['n_records'] += 1
+            entry['n_frames'] += poses_window.shape[0]
 
             # update normalization stats
             if compute_stats:
-                seq_len, feature_size = poses_window.shape
+                stats_accumulators['stats.npz'].update(poses_window)
+                for stats_rep in stats_reps:
+                    stats_accumulators['stats_{}.npz'.format(stats_rep)].update(rotmat2rep(poses_window, stats_rep))
 
-                # Global mean&variance
-                n_all += seq_len * feature_size
-                delta_all = poses_window - mean_all
-                mean_all = mean_all + delta_all.sum() / n_all
-                m2_all = m2_all + (delta_all * (poses_window - mean_all)).sum()
+    result = close_split_writers(writers)
+    for entry in files.values():
+        entry['stats'] = {stats_file: vars(accumulator) for stats_file, accumulator in entry['stats'].items()
+                          if accumulator.n_all > 0}
+    result['files'] = files
+    return result
 
-                # Channel-wise mean&variance
-                n_channel += seq_len
-                delta_channel = poses_window - mean_channel
-                mean_channel = mean_channel + delta_channel.sum(axis=0) / n_channel
-                m2_channel = m2_channel + (delta_channel * (poses_window - mean_channel)).sum(axis=0)
 
-                # Global min&max values.
-                min_all = np.min(poses_window) if np.min(poses_window) < min_all else min_all
-                max_all = np.max(poses_window) if np.max(poses_window) > max_all else max_all
+def process_split(poses, one_hots, file_ids, output_path, n_shards, compute_stats, create_windows=None,
+                  record_format=C.DATA_RECORD_RAW, write_mmap=False, stats_reps=(), poses_dtype=C.DATA_POSES_FLOAT32,
+                  lazy_windows=False, n_workers=1):
+    print("storing into {} computing stats {}".format(output_path, "YES" if compute_stats else "NO"))
+
+    if compute_stats:
+        assert create_windows is None, "computing the statistics should only be done when not extracting windows"
 
-                # Min&max sequence length.
-                min_seq_len = seq_len if seq_len < min_seq_len else min_seq_len
-                max_seq_len = seq_len if seq_len > max_seq_len else max_seq_len
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
 
-    close_tfrecord_writers(tfrecord_writers)
-    if create_windows is not None:
-        close_tfrecord_writers(tfrecord_writers_dyn)
+    # every worker processes every n_workers-th sequence into its own shards
+    jobs = [(poses[worker_idx::n_workers], one_hots[worker_idx::n_workers], file_ids[worker_idx::n_workers],
+             output_path, n_shards, compute_stats, create_windows, record_format, write_mmap, stats_reps, poses_dtype,
+             lazy_windows, worker_idx, n_workers)
+            for worker_idx in range(n_workers)]
+    results = run_workers(process_sequences, jobs)
+    files = merge_worker_results(results, output_path, create_windows, write_mmap)
+    meta_stats_per_db = get_meta_stats(files)
 
     # print meta stats
     print()
@@ -161,19 +158,12 @@ def process_split(poses, one_hots, file_ids, output_path, n_shards, compute_stat
 
     # finalize and save stats
     if compute_stats:
-        var_all = m2_all / (n_all - 1)
-        var_channel = m2_channel / (n_channel - 1)
+        for stats_file, accumulator in merge_file_stats(files).items():
+            stats = accumulator.get_stats(tot_samples)
 
-        # set certain std's to 1.0 like Martinez did
-        var_channel[np.where(var_channel < 1e-4)] = 1.0
-
-        stats = {'mean_all': mean_all, 'mean_channel': mean_channel, 'var_all': var_all,
-                 'var_channel': var_channel, 'min_all': min_all, 'max_all': max_all,
-                 'min_seq_len': min_seq_len, 'max_seq_len': max_seq_len, 'num_samples': tot_samples}
-
-        stats_file = os.path.join(output_path, 'stats.npz')
-        print('saving statistics to {} ...'.format(stats_file))
-        np.savez(stats_file, stats=stats)
+            # set certain std's to 1.0 like Martinez did
+            stats['var_channel'][np.where(stats['var_channel'] < 1e-4)] = 1.0
+            save_stats(stats, output_path, stats_file)
 
     return meta_stats_per_db
 
@@ -209,7 +199,8 @@ def load_data(path_to_dataset, subjects, actions, one_hot, rep):
                 print("Reading subject {0}, action {1}, subaction {2}".format(subj, action, subact))
 
                 filename = '{0}/S{1}/{2}_{3}.txt'.format(path_to_dataset, subj, action, subact)
-                action_sequence = read_csv_as_float(filename)
+                # downsample to 25 fps before converting the poses
+                action_sequence = load_sequence(filename, downsample=2)
 
                 # remove the first three dimensions (root position) and the unwanted joints
                 action_sequence = action_sequence[:, 3:]
@@ -224,15 +215,12 @@ def load_data(path_to_dataset, subjects, actions, one_hot, rep):
                     expmap = np.reshape(action_sequence, [n_samples*n_joints, 3])
                     # first three values are positions, so technically it's meaningless to convert them,
                     # but we do it anyway because later we discard this values anywho
-                    rotmats = np.zeros([n_samples*n_joints, 3, 3])
-                    for i in range(rotmats.shape[0]):
-                        rotmats[i] = cv2.Rodrigues(expmap[i])[0]
+                    rotmats = aa2rotmat(expmap)
                     rotmats = np.reshape(rotmats, [n_samples, n_joints*3*3])
                     action_sequence = rotmats
                 elif rep == "quat":
                     expmap = np.reshape(action_sequence, [n_samples * n_joints, 3])
-                    quats = quaternion.from_rotation_vector(expmap)
-                    quats = np.reshape(quaternion.as_float_array(quats), [n_samples, n_joints*4])
+                    quats = np.reshape(aa2quat(expmap), [n_samples, n_joints*4])
                     action_sequence = quats
                 elif rep == "euler":
                     expmap = np.reshape(action_sequence, [n_samples*n_joints, 3])
@@ -242,15 +230,12 @@ def load_data(path_to_dataset, subjects, actions, one_hot, rep):
                 else:
                     pass  # the data is already in angle-axis format
 
-                # downsample to 25 fps
-                even_list = range(0, n_samples, 2)
-
                 if one_hot:
                     one = np.zeros([nactions], dtype=np.float)
                     one[action_idx] = 1.0
                     one_hots.append(one)
 
-                poses.append(action_sequence[even_list, :])
+                poses.append(action_sequence)
                 file_ids.append("S{}_{}_{}".format(subj, action, subact))
 
     return poses, one_hots, file_ids
@@ -265,27 +250,44 @@ if __name__ == '__main__':
     rep = "euler"  # "quat", "aa", "rotmat" or "euler"
     test_window_size = 75  # 3 seconds
     test_window_stride = 50  # 2 seconds
+    record_format = C.DATA_RECORD_RAW  # "raw" or "legacy"
+    write_mmap = False  # also store the splits as memory-mapped stores
+    poses_dtype = C.DATA_POSES_FLOAT32  # "float32", "float16" or "int16" (only for "rotmat" and "quat")
+    n_workers = 1  # number of processes per split, at most n_shards
+    lazy_windows = False  # store a window index instead of the windows of the validation and test splits
+    canonical = False  # only store rotation matrices and the statistics of all representations, overrides rep
 
     actions = ["walking", "eating", "smoking", "discussion", "directions",
                "greeting", "phoning", "posing", "purchases", "sitting",
                "sittingdown", "takingphoto", "waiting", "walkingdog",
                "walkingtogether"]
 
+    stats_reps = []
+    if canonical:
+        rep = "rotmat"
+        stats_reps = ["aa", "quat", "euler"]
+
     train_data, train_one_hot, train_ids = load_data(h36m_folder, train_subjects, actions,
                                                      one_hot=True, rep=rep)
     test_data, test_one_hot, test_ids = load_data(h36m_folder, test_subjects, actions,
                                                   one_hot=True, rep=rep)
 
     tr_stats = process_split(train_data, train_one_hot, train_ids, os.path.join(output_folder, rep, "training"),
-                             n_shards, compute_stats=True, create_windows=None)
+                             n_shards, compute_stats=True, create_windows=None, record_format=record_format,
+                             write_mmap=write_mmap, stats_reps=stats_reps, poses_dtype=poses_dtype,
+                             n_workers=n_workers)
 
     print("process validation data ...")
     va_stats = process_split(test_data, test_one_hot, test_ids, os.path.join(output_folder, rep, "validation"),
-                             n_shards, compute_stats=False, create_windows=(test_window_size, test_window_stride))
+                             n_shards, compute_stats=False, create_windows=(test_window_size, test_window_stride),
+                             record_format=record_format, write_mmap=write_mmap, poses_dtype=poses_dtype,
+                             lazy_windows=lazy_windows, n_workers=n_workers)
 
     print("process test data ...")
     te_stats = process_split(test_data, test_one_hot, test_ids, os.path.join(output_folder, rep, "test"),
-                             n_shards, compute_stats=False, create_windows=(test_window_size, test_window_stride))
+                             n_shards, compute_stats=False, create_windows=(test_window_size, test_window_stride),
+                             record_format=record_format, write_mmap=write_mmap, poses_dtype=poses_dtype,
+                             lazy_windows=lazy_windows, n_workers=n_workers)
 
     print("Meta stats for all splits combined")
     total_stats = tr_stats
@@ -5,21 +5,36 @@ the Free Software Foundation, either version 3 of the License, or
 (at your option) any later version.
 """
 import argparse
+import glob
+import hashlib
+import multiprocessing
 import numpy as np
 import os
 import pickle as pkl
+import shutil
 import tensorflow as tf
-import quaternion
-import cv2
+
+from common import conversions
+from common.constants import Constants as C
+from mastnet.data.mmap_dataset import MmapMotionWriter, merge_mmap_stores
+from mastnet.data.sample_index import SampleIndexWriter, load_sample_index, read_record
+from mastnet.data.window_index import WindowIndexWriter, load_window_index
+from mastnet.data.pose_encoding import encode_poses, POSES_RAW_KEYS
 
 
 RNG = np.random.RandomState(42)
+MANIFEST_FILE = "manifest.npz"
+
 
+def get_shard_paths(output_file, n_shards, shard_ids=None):
+    shard_ids = range(n_shards) if shard_ids is None else shard_ids
+    return ["{}-{:0>5d}-of-{:0>5d}".format(output_file, i, n_shards) for i in shard_ids]
 
-def create_tfrecord_writers(output_file, n_shards):
+
+def create_tfrecord_writers(output_file, n_shards, shard_ids=None):
     writers = []
-    for i in range(n_shards):
-        writers.append(tf.python_io.TFRecordWriter("{}-{:0>5d}-of-{:0>5d}".format(output_file, i, n_shards)))
+    for shard_path in get_shard_paths(output_file, n_shards, shard_ids):
+        writers.append(tf.python_io.TFRecordWriter(shard_path))
     return writers
 
 
@@ -28,17 +43,65 @@ def close_tfrecord_writers(writers):
         w.close()
 
 
-def write_tfexample(writers, tf_example):
-    random_writer_idx = RNG.randint(0, len(writers))
-    writers[random_writer_idx].write(tf_example.SerializeToString())
+def get_sample_id(tf_example):
+    """
+    Returns the sample id of a tf.train.Example as it is created by the data loader, i.e., "<db_name>/<file_id>" without
+    the ".pkl" extension.
+    """
+    feature = tf_example.features.feature
+    file_id = feature['file_id'].bytes_list.value[0].decode('utf-8')
+    db_name = feature['db_name'].bytes_list.value[0].decode('utf-8')
+    return "{}/{}".format(db_name, file_id[:-4])
+
+
+def get_file_id(sample_id):
+    """
+    Returns the id of the file a record was created from, i.e., the inverse of `get_sample_id` without the window index.
+    """
+    return sample_id.split('/', 2)[2] + '.pkl'
+
+
+def write_tfexample(writers, tf_example, sample_index=None):
+    """
+    Writes the example into one of the shards. If the shards are indexed, the example is written into the shard with
+    the fewest bytes so far (ties are broken randomly), so that the shards have about the same size. Otherwise, the
+    shard is chosen randomly.
+    """
+    serialized = tf_example.SerializeToString()
+    if sample_index is not None:
+        smallest_shards = sample_index.get_smallest_shards()
+        writer_idx = smallest_shards[RNG.randint(0, len(smallest_shards))]
+    else:
+        writer_idx = RNG.randint(0, len(writers))
+    writers[writer_idx].write(serialized)
+    if sample_index is not None:
+        n_frames = tf_example.features.feature['shape'].int64_list.value[0]
+        sample_index.add(writer_idx, get_sample_id(tf_example), len(serialized), n_frames)
 
 
-def to_tfexample(poses, file_id, db_name):
+def poses_feature(poses, record_format=C.DATA_RECORD_RAW, poses_dtype=C.DATA_POSES_FLOAT32):
+    """
+    Returns the feature name and the tf.train.Feature storing `poses` in the given record format. Raw records store
+    the poses as a single little-endian byte string of the given precision, legacy records as a float32 FloatList.
+    """
+    if record_format == C.DATA_RECORD_RAW:
+        poses_raw = encode_poses(poses, poses_dtype).tobytes()
+        return POSES_RAW_KEYS[poses_dtype], tf.train.Feature(bytes_list=tf.train.BytesList(value=[poses_raw]))
+    elif record_format == C.DATA_RECORD_LEGACY:
+        if poses_dtype != C.DATA_POSES_FLOAT32:
+            raise Exception("Legacy records only store float32 poses.")
+        return 'poses', tf.train.Feature(float_list=tf.train.FloatList(value=poses.flatten()))
+    else:
+        raise Exception("Unknown record format.")
+
+
+def to_tfexample(poses, file_id, db_name, record_format=C.DATA_RECORD_RAW, poses_dtype=C.DATA_POSES_FLOAT32):
     features = dict()
     features['file_id'] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[file_id.encode('utf-8')]))
     features['db_name'] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[db_name.encode('utf-8')]))
     features['shape'] = tf.train.Feature(int64_list=tf.train.Int64List(value=poses.shape))
-    features['poses'] = tf.train.Feature(float_list=tf.train.FloatList(value=poses.flatten()))
+    key, feature = poses_feature(poses, record_format, poses_dtype)
+    features[key] = feature
     example = tf.train.Example(features=tf.train.Features(feature=features))
     return example
 
@@ -100,7 +163,7 @@ def rotmat2quat(rotmats):
     seq_length = rotmats.shape[0]
     assert rotmats.shape[1] % 9 == 0
     ori = np.reshape(rotmats, [seq_length, -1, 3, 3])
-    ori_q = quaternion.as_float_array(quaternion.from_rotation_matrix(ori))
+    ori_q = conversions.rotmat2quat(ori)
     ori_qc = correct_antipodal_quaternions(ori_q)
     ori_qc = np.reshape(ori_qc, [seq_length, -1])
     return ori_qc
@@ -117,80 +180,391 @@ def rotmat2aa(rotmats):
     seq_length = rotmats.shape[0]
     assert rotmats.shape[1] % 9 == 0
     n_joints = rotmats.shape[1] // 9
-    ori = np.reshape(rotmats, [seq_length*n_joints, 3, 3])
-    aas = np.zeros([seq_length*n_joints, 3])
-    for i in range(ori.shape[0]):
-        aas[i] = np.squeeze(cv2.Rodrigues(ori[i])[0])
+    ori = np.reshape(rotmats, [seq_length, n_joints, 3, 3])
+    aas = conversions.rotmat2aa(ori)
     return np.reshape(aas, [seq_length, n_joints*3])
 
 
-def process_split(all_fnames, output_path, n_shards, compute_stats, rep, create_windows=None):
+def rotmat2rep(rotmats, rep):
     """
-    Process data into tfrecords.
+    Convert rotation matrices to the given representation as stored in the tfrecords.
     Args:
-        all_fnames: List of filenames that should be processed.
-        output_path: Where to store the tfrecord files.
-        n_shards: How many tfrecord files to create.
-        compute_stats: Whether to compute and store normalization statistics.
-        rep: If the output data should be rotation matrices, quaternions or angle-axis.
-        create_windows: Tuple (size, stride) of windows that should be extracted from each sequence or None otherwise.
-          If given, it will also store a version where not windows were extracted, stored under a folder with suffix
-          '*_dynamic'. This is helpful for validation and test splits, as they can become quite big if windows are
-          extracted.
+        rotmats: np array of shape (seq_length, n_joints*9).
+        rep: "rotmat", "aa", "quat" or "euler".
 
-    Returns:
-        Some meta statistics (how many sequences processed etc.).
+    Returns: np array of shape (seq_length, n_joints*dof)
     """
-    assert rep in ["aa", "rotmat", "quat"]
-    print("storing into {} computing stats {}".format(output_path, "YES" if compute_stats else "NO"))
+    if rep == "quat":
+        return rotmat2quat(rotmats)
+    elif rep == "aa":
+        return rotmat2aa(rotmats)
+    elif rep == "euler":
+        seq_length = rotmats.shape[0]
+        eulers = conversions.rotmat2euler(np.reshape(rotmats, [-1, 3, 3]))
+        return np.reshape(eulers, [seq_length, -1])
+    elif rep == "rotmat":
+        return rotmats
+    else:
+        raise Exception("Unknown representation.")
 
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
 
-    # save data as tfrecords
-    tfrecord_writers = create_tfrecord_writers(os.path.join(output_path, 'amass'), n_shards)
-    tfrecord_writers_dyn = None
+class StatsAccumulator(object):
+    """
+    Computes the normalization statistics online, i.e., one sequence at a time.
+    """
+    def __init__(self, state=None):
+        """
+        Args:
+            state: Attributes of another accumulator, i.e., `vars(accumulator)`, to continue from. The preprocessing
+              manifest stores the statistics of every file like this.
+        """
+        self.n_all, self.mean_all, self.m2_all = 0.0, 0.0, 0.0
+        self.n_channel, self.mean_channel, self.m2_channel = 0.0, 0.0, 0.0
+        self.min_all, self.max_all = np.inf, -np.inf
+        self.min_seq_len, self.max_seq_len = np.inf, -np.inf
+        if state is not None:
+            self.__dict__.update(state)
+
+    def update(self, poses, weight=1.0):
+        """
+        Args:
+            poses: np array of shape (seq_length, feature_size).
+            weight: Weight of every frame of the sequence, e.g., 1/seq_length so that every sequence counts the same.
+        """
+        seq_len, feature_size = poses.shape
+
+        # Global mean&variance
+        self.n_all += weight * seq_len * feature_size
+        delta_all = poses - self.mean_all
+        self.mean_all = self.mean_all + weight * delta_all.sum() / self.n_all
+        self.m2_all = self.m2_all + weight * (delta_all * (poses - self.mean_all)).sum()
+
+        # Channel-wise mean&variance
+        self.n_channel += weight * seq_len
+        delta_channel = poses - self.mean_channel
+        self.mean_channel = self.mean_channel + weight * delta_channel.sum(axis=0) / self.n_channel
+        self.m2_channel = self.m2_channel + weight * (delta_channel * (poses - self.mean_channel)).sum(axis=0)
+
+        # Global min&max values.
+        self.min_all = np.min(poses) if np.min(poses) < self.min_all else self.min_all
+        self.max_all = np.max(poses) if np.max(poses) > self.max_all else self.max_all
+
+        # Min&max sequence length.
+        self.min_seq_len = seq_len if seq_len < self.min_seq_len else self.min_seq_len
+        self.max_seq_len = seq_len if seq_len > self.max_seq_len else self.max_seq_len
+
+    def merge(self, other):
+        """
+        Adds the statistics of another accumulator, e.g., of the sequences processed by another worker. Means and
+        variances are combined with the parallel algorithm of Chan et al., i.e., the result is the same as if all
+        sequences had been passed to `update`.
+        """
+        if other.n_all == 0:
+            return
+        if self.n_all == 0:
+            self.__dict__.update(other.__dict__)
+            return
+
+        def _combine(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+            n = n_a + n_b
+            delta = mean_b - mean_a
+            return n, mean_a + delta * n_b / n, m2_a + m2_b + delta**2 * n_a * n_b / n
+
+        self.n_all, self.mean_all, self.m2_all = _combine(self.n_all, self.mean_all, self.m2_all,
+                                                          other.n_all, other.mean_all, other.m2_all)
+        self.n_channel, self.mean_channel, self.m2_channel = _combine(self.n_channel, self.mean_channel,
+                                                                      self.m2_channel, other.n_channel,
+                                                                      other.mean_channel, other.m2_channel)
+        self.min_all = min(self.min_all, other.min_all)
+        self.max_all = max(self.max_all, other.max_all)
+        self.min_seq_len = min(self.min_seq_len, other.min_seq_len)
+        self.max_seq_len = max(self.max_seq_len, other.max_seq_len)
+
+    def get_stats(self, num_samples):
+        """
+        Returns:
+            The statistics as stored in `stats.npz`.
+        """
+        return {'mean_all': self.mean_all, 'mean_channel': self.mean_channel,
+                'var_all': self.m2_all / (self.n_all - 1), 'var_channel': self.m2_channel / (self.n_channel - 1),
+                'min_all': self.min_all, 'max_all': self.max_all,
+                'min_seq_len': self.min_seq_len, 'max_seq_len': self.max_seq_len, 'num_samples': num_samples}
+
+
+def save_stats(stats, output_path, stats_file='stats.npz'):
+    stats_file = os.path.join(output_path, stats_file)
+    print('saving statistics to {} ...'.format(stats_file))
+    np.savez(stats_file, stats=stats)
+
+
+def get_mmap_part_path(store_dir, worker_idx):
+    return os.path.join(store_dir, "part-{:0>5d}".format(worker_idx))
+
+
+def create_split_writers(output_path, n_shards, create_windows=None, write_mmap=False,
+                         poses_dtype=C.DATA_POSES_FLOAT32, lazy_windows=False, worker_idx=0, n_workers=1,
+                         first_shard=0):
+    """
+    Creates the writers of a split for one worker. Worker `worker_idx` of `n_workers` only owns the shards
+    first_shard + worker_idx, first_shard + worker_idx + n_workers, ... of the split and writes its memory-mapped
+    stores into part directories, so that the workers never write to the same file. The shards before `first_shard`
+    already exist, e.g., if the split is updated incrementally.
+
+    Returns:
+        A dict with the tfrecord writers, sample indices and memory-mapped writers of the split and its '*_dynamic'
+        version and the window index. Writers that are not needed are None.
+    """
+    assert 0 <= worker_idx < n_workers <= n_shards - first_shard, "every worker must own at least one shard"
+    shard_ids = range(first_shard + worker_idx, n_shards, n_workers)
+
+    writers = {'tfrecord': None, 'sample_index': None, 'tfrecord_dyn': None, 'sample_index_dyn': None,
+               'window_index': None, 'mmap': None, 'mmap_dyn': None}
+    output_file = os.path.join(output_path, 'amass')
+    if create_windows is not None and lazy_windows:
+        writers['window_index'] = WindowIndexWriter(output_path + "_dynamic", create_windows[0])
+    else:
+        writers['tfrecord'] = create_tfrecord_writers(output_file, n_shards, shard_ids)
+        writers['sample_index'] = SampleIndexWriter(get_shard_paths(output_file, n_shards, shard_ids))
     if create_windows is not None:
         if not os.path.exists(output_path + "_dynamic"):
             os.makedirs(output_path + "_dynamic")
-        tfrecord_writers_dyn = create_tfrecord_writers(os.path.join(output_path + "_dynamic", "amass"), n_shards)
+        output_file_dyn = os.path.join(output_path + "_dynamic", "amass")
+        writers['tfrecord_dyn'] = create_tfrecord_writers(output_file_dyn, n_shards, shard_ids)
+        writers['sample_index_dyn'] = SampleIndexWriter(get_shard_paths(output_file_dyn, n_shards, shard_ids))
+
+    if write_mmap:
+        def _mmap_path(store_dir):
+            return store_dir if n_workers == 1 else get_mmap_part_path(store_dir, worker_idx)
+        if writers['window_index'] is None:
+            writers['mmap'] = MmapMotionWriter(_mmap_path(output_path), poses_dtype)
+        if create_windows is not None:
+            writers['mmap_dyn'] = MmapMotionWriter(_mmap_path(output_path + "_dynamic"), poses_dtype)
+    return writers
+
+
+def close_split_writers(writers):
+    """
+    Closes the files of the writers created by `create_split_writers`.
+    Returns:
+        The sample indices and the window index of the worker, which are merged by `merge_worker_results`.
+    """
+    for key in ['tfrecord', 'tfrecord_dyn']:
+        if writers[key] is not None:
+            close_tfrecord_writers(writers[key])
+    for key in ['mmap', 'mmap_dyn']:
+        if writers[key] is not None:
+            writers[key].close()
+    return {key: writers[key] for key in ['sample_index', 'sample_index_dyn', 'window_index']}
+
+
+def run_workers(worker_fn, jobs):
+    """
+    Calls `worker_fn` with the arguments of every job, in a pool of one process per job if there is more than one.
+    Returns:
+        The results of the jobs in the same order.
+    """
+    if len(jobs) <= 1:
+        return [worker_fn(*job) for job in jobs]
+    pool = multiprocessing.Pool(len(jobs))
+    try:
+        return pool.starmap(worker_fn, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def merge_worker_results(results, output_path, create_windows=None, write_mmap=False, existing=None):
+    """
+    Merges the outputs of the workers of a split and saves the indices.
+    Args:
+        results: Dicts returned by the workers, i.e., the indices (see `close_split_writers`) and 'files' mapping the
+          id of every processed file to its manifest entry.
+        output_path: Where the split is stored.
+        create_windows: Tuple (size, stride) if the split is windowed.
+        write_mmap: Whether the workers wrote memory-mapped stores.
+        existing: Indices of the records that are already stored in the split, in the same format as the indices of
+          the workers. The indices of the workers are appended to them.
+    Returns:
+        The manifest entries of the files processed by the workers.
+    """
+    index_keys = ['sample_index', 'sample_index_dyn', 'window_index']
+    indices = existing if existing is not None else {key: results[0][key] for key in index_keys}
+    files = dict()
+    for result in results:
+        for key in index_keys:
+            if result[key] is not None and result[key] is not indices[key]:
+                indices[key].merge(result[key])
+        files.update(result['files'])
+
+    if indices['window_index'] is not None:
+        indices['window_index'].save(output_path)
+    else:
+        indices['sample_index'].save(output_path)
+    if create_windows is not None:
+        indices['sample_index_dyn'].save(output_path + "_dynamic")
 
-    # compute normalization stats online
-    n_all, mean_all, var_all, m2_all = 0.0, 0.0, 0.0, 0.0
-    n_channel, mean_channel, var_channel, m2_channel = 0.0, 0.0, 0.0, 0.0
-    min_all, max_all = np.inf, -np.inf
-    min_seq_len, max_seq_len = np.inf, -np.inf
+    # concatenate the memory-mapped stores of the workers
+    if write_mmap and len(results) > 1:
+        store_dirs = [output_path + "_dynamic"] if create_windows is not None else []
+        if indices['window_index'] is None:
+            store_dirs.append(output_path)
+        for store_dir in store_dirs:
+            part_paths = [get_mmap_part_path(store_dir, worker_idx) for worker_idx in range(len(results))]
+            merge_mmap_stores(part_paths, store_dir)
+            for part_path in part_paths:
+                shutil.rmtree(part_path)
 
-    # keep track of some stats to print in the end
+    return files
+
+
+def get_meta_stats(files):
+    """
+    Returns:
+        The number of samples and frames per database of the files with the given manifest entries.
+    """
     meta_stats_per_db = dict()
+    for entry in files.values():
+        meta_stats = meta_stats_per_db.setdefault(entry['db_name'], {'n_samples': 0, 'n_frames': 0})
+        meta_stats['n_samples'] += entry['n_records']
+        meta_stats['n_frames'] += entry['n_frames']
+    return meta_stats_per_db
+
+
+def merge_file_stats(files):
+    """
+    Merges the normalization statistics of the files with the given manifest entries.
+    Returns:
+        A `StatsAccumulator` per statistics file.
+    """
+    stats_accumulators = dict()
+    for entry in files.values():
+        for stats_file, state in entry['stats'].items():
+            stats_accumulators.setdefault(stats_file, StatsAccumulator()).merge(StatsAccumulator(state))
+    return stats_accumulators
+
+
+def load_manifest(output_path):
+    """
+    Returns:
+        The manifest of a split written by `process_split` or None if there is none. It stores the settings the split
+        was processed with and for every file its content hash, number of records and frames, and its contribution to
+        the normalization statistics.
+    """
+    manifest_path = os.path.join(output_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    return np.load(manifest_path, allow_pickle=True)['manifest'].tolist()
+
+
+def save_manifest(manifest, output_path):
+    np.savez(os.path.join(output_path, MANIFEST_FILE), manifest=manifest)
+
+
+def hash_file(path):
+    with open(path, 'rb') as f_handle:
+        return hashlib.sha1(f_handle.read()).hexdigest()
+
+
+def remove_file_records(split_dir, file_ids):
+    """
+    Removes the records created from the given files from the shards of a split. Only the shards containing such
+    records are rewritten, all other shards are left untouched.
+    Returns:
+        The `SampleIndexWriter` of the remaining records.
+    """
+    shards = sorted(glob.glob(os.path.join(split_dir, 'amass-?????-of-?????')))
+    records = load_sample_index(split_dir)
+    if records is None:
+        raise Exception("{} has no sample index, it must be processed from scratch.".format(split_dir))
+    records_per_shard = {shard: [] for shard in shards}
+    for sample_id, (shard, offset, length, n_frames) in records.items():
+        records_per_shard[shard].append((offset, length, sample_id.decode('utf-8'), n_frames))
+
+    sample_index = SampleIndexWriter(shards)
+    for shard_idx, shard in enumerate(shards):
+        shard_records = sorted(records_per_shard[shard])
+        kept_records = [record for record in shard_records if get_file_id(record[2]) not in file_ids]
+        if len(kept_records) < len(shard_records):
+            print("rewriting {} without {} records".format(shard, len(shard_records) - len(kept_records)))
+            writer = tf.python_io.TFRecordWriter(shard + '.tmp')
+            with open(shard, 'rb') as f_handle:
+                for offset, length, _, _ in kept_records:
+                    writer.write(read_record(f_handle, offset, length))
+            writer.close()
+            os.replace(shard + '.tmp', shard)
+        for _, length, sample_id, n_frames in kept_records:
+            sample_index.add(shard_idx, sample_id, length, n_frames)
+    return sample_index
+
+
+def remove_file_windows(split_dir, file_ids):
+    """
+    Returns:
+        A `WindowIndexWriter` with the windows of the window index of a split that were not extracted from the given
+        files.
+    """
+    index = load_window_index(split_dir)
+    window_index = WindowIndexWriter(index['sequence_dir'], index['window_size'])
+    for sequence_id, file_id, db_name, start in zip(index['sequence_ids'], index['file_ids'], index['db_names'],
+                                                    index['starts']):
+        file_id = file_id.decode('utf-8')
+        if file_id.split('/', 1)[1] not in file_ids:
+            window_index.add(sequence_id.decode('utf-8'), file_id, db_name.decode('utf-8'), int(start))
+    return window_index
+
+
+def remove_shards(split_dir):
+    for shard in glob.glob(os.path.join(split_dir, 'amass-?????-of-?????')):
+        os.remove(shard)
+
+
+def process_files(all_fnames, output_path, n_shards, compute_stats, rep, create_windows=None,
+                  record_format=C.DATA_RECORD_RAW, write_mmap=False, stats_reps=(),
+                  poses_dtype=C.DATA_POSES_FLOAT32, lazy_windows=False, worker_idx=0, n_workers=1, first_shard=0):
+    """
+    Processes the files of a split handled by one worker into its shards (see `create_split_writers`). The arguments
+    are the same as for `process_split`.
+
+    Returns:
+        A dict with the indices (see `close_split_writers`) and 'files' mapping the id of every processed file to its
+        manifest entry, i.e., its database, content hash, number of records and frames, and the state of its
+        `StatsAccumulator` per statistics file.
+    """
+    writers = create_split_writers(output_path, n_shards, create_windows, write_mmap, poses_dtype, lazy_windows,
+                                   worker_idx, n_workers, first_shard)
+    window_index, mmap_writer, mmap_writer_dyn = writers['window_index'], writers['mmap'], writers['mmap_dyn']
+    stats_files = ['stats.npz'] + ['stats_{}.npz'.format(stats_rep) for stats_rep in stats_reps]
+    files = dict()
 
     for idx in range(len(all_fnames)):
         root_dir, f, file_id = all_fnames[idx]
         with open(os.path.join(root_dir, f), 'rb') as f_handle:
             print('\r [{:0>5d} / {:0>5d}] processing file {}'.format(idx + 1, len(all_fnames), f), end='')
-            data = pkl.load(f_handle, encoding='latin1')
+            content = f_handle.read()
+            data = pkl.loads(content, encoding='latin1')
             poses = np.array(data['poses'])  # shape (seq_length, 135)
             assert len(poses) > 0, 'file is empty'
 
-            if rep == "quat":
-                # convert to quaternions
-                poses = rotmat2quat(poses)
-            elif rep == "aa":
-                poses = rotmat2aa(poses)
-            else:
-                pass
+            poses = rotmat2rep(poses, rep)
 
             db_name = file_id.split('/')[0]
-            if db_name not in meta_stats_per_db:
-                meta_stats_per_db[db_name] = {'n_samples': 0, 'n_frames': 0}
+
+            # compute normalization stats online, per file so that they can be updated incrementally
+            stats_accumulators = {stats_file: StatsAccumulator() for stats_file in stats_files} if compute_stats else {}
+            entry = {'db_name': db_name, 'hash': hashlib.sha1(content).hexdigest(), 'n_records': 0, 'n_frames': 0,
+                     'stats': stats_accumulators}
+            files[file_id] = entry
 
             if create_windows is not None:
                 if poses.shape[0] < create_windows[0]:
                     continue
 
                 # first save it without splitting into windows
-                tfexample = to_tfexample(poses, "{}/{}".format(0, file_id), db_name)
-                write_tfexample(tfrecord_writers_dyn, tfexample)
+                tfexample = to_tfexample(poses, "{}/{}".format(0, file_id), db_name, record_format, poses_dtype)
+                write_tfexample(writers['tfrecord_dyn'], tfexample, writers['sample_index_dyn'])
+                if mmap_writer_dyn is not None:
+                    mmap_writer_dyn.write(poses, "{}/{}".format(0, file_id), db_name)
+                sequence_id = get_sample_id(tfexample)
 
                 # then split into windows and save later
                 poses_w = split_into_windows(poses, create_windows[0], create_windows[1])
@@ -201,41 +575,121 @@ def process_split(all_fnames, output_path, n_shards, compute_stats, rep, create_
 
             for w in range(poses_w.shape[0]):
                 poses_window = poses_w[w]
-                tfexample = to_tfexample(poses_window, "{}/{}".format(w, file_id), db_name)
-                write_tfexample(tfrecord_writers, tfexample)
+                if window_index is not None:
+                    window_index.add(sequence_id, "{}/{}".format(w, file_id), db_name, w*create_windows[1])
+                else:
+                    tfexample = to_tfexample(poses_window, "{}/{}".format(w, file_id), db_name, record_format,
+                                             poses_dtype)
+                    write_tfexample(writers['tfrecord'], tfexample, writers['sample_index'])
+                if mmap_writer is not None:
+                    mmap_writer.write(poses_window, "{}/{}".format(w, file_id), db_name)
 
-                meta_stats_per_db[db_name]['n_samples'] += 1
-                meta_stats_per_db[db_name]['n_frames'] += poses_window.shape[0]
+                entry['n_records'] += 1
+                entry['n_frames'] += poses_window.shape[0]
 
                 # update normalization stats
                 if compute_stats:
-                    seq_len, feature_size = poses_window.shape
+                    stats_accumulators['stats.npz'].update(poses_window)
+                    for stats_rep in stats_reps:
+                        stats_accumulators['stats_{}.npz'.format(stats_rep)].update(rotmat2rep(poses_window, stats_rep))
 
-                    # Global mean&variance
-                    n_all += seq_len * feature_size
-                    delta_all = poses_window - mean_all
-                    mean_all = mean_all + delta_all.sum() / n_all
-                    m2_all = m2_all + (delta_all * (poses_window - mean_all)).sum()
+    result = close_split_writers(writers)
+    for entry in files.values():
+        entry['stats'] = {stats_file: vars(accumulator) for stats_file, accumulator in entry['stats'].items()
+                          if accumulator.n_all > 0}
+    result['files'] = files
+    return result
 
-                    # Channel-wise mean&variance
-                    n_channel += seq_len
-                    delta_channel = poses_window - mean_channel
-                    mean_channel = mean_channel + delta_channel.sum(axis=0) / n_channel
-                    m2_channel = m2_channel + (delta_channel * (poses_window - mean_channel)).sum(axis=0)
 
-                    # Global min&max values.
-                    min_all = np.min(poses_window) if np.min(poses_window) < min_all else min_all
-                    max_all = np.max(poses_window) if np.max(poses_window) > max_all else max_all
+def process_split(all_fnames, output_path, n_shards, compute_stats, rep, create_windows=None,
+                  record_format=C.DATA_RECORD_RAW, write_mmap=False, stats_reps=(),
+                  poses_dtype=C.DATA_POSES_FLOAT32, lazy_windows=False, n_workers=1, incremental=False):
+    """
+    Process data into tfrecords.
+    Args:
+        all_fnames: List of filenames that should be processed.
+        output_path: Where to store the tfrecord files.
+        n_shards: How many tfrecord files to create.
+        compute_stats: Whether to compute and store normalization statistics.
+        rep: If the output data should be rotation matrices, quaternions or angle-axis.
+        create_windows: Tuple (size, stride) of windows that should be extracted from each sequence or None otherwise.
+          If given, it will also store a version where not windows were extracted, stored under a folder with suffix
+          '*_dynamic'. This is helpful for validation and test splits, as they can become quite big if windows are
+          extracted.
+        record_format: Layout of the tfrecords, "raw" or "legacy".
+        write_mmap: Whether to also store the sequences in a memory-mapped store next to the tfrecords.
+        stats_reps: Representations other than `rep` to compute normalization statistics for, e.g., if the poses are
+          stored as rotation matrices and converted in the data pipeline. They are stored as `stats_<rep>.npz`.
+        poses_dtype: Storage precision of the poses, "float32", "float16" or "int16". The statistics are computed on the
+          float32 poses.
+        lazy_windows: If set and `create_windows` is given, the windows are not stored. Instead, a window index into
+          the sequences of the '*_dynamic' split is stored and the data loaders extract the windows.
+        n_workers: Number of processes. Every process converts every `n_workers`-th file into its own subset of the
+          shards. The normalization statistics of the processes are merged exactly. At most `n_shards`.
+        incremental: If the split was processed before with the same settings, only new and changed files are
+          processed into additional shards, about `n_shards` times the fraction of processed files. The records of
+          changed and removed files are removed from the existing shards. The normalization statistics are updated
+          with the statistics of the files stored in the manifest of the split.
 
-                    # Min&max sequence length.
-                    min_seq_len = seq_len if seq_len < min_seq_len else min_seq_len
-                    max_seq_len = seq_len if seq_len > max_seq_len else max_seq_len
+    Returns:
+        Some meta statistics (how many sequences processed etc.).
+    """
+    assert rep in ["aa", "rotmat", "quat"]
+    print("storing into {} computing stats {}".format(output_path, "YES" if compute_stats else "NO"))
 
-    close_tfrecord_writers(tfrecord_writers)
-    if create_windows is not None:
-        close_tfrecord_writers(tfrecord_writers_dyn)
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    if stats_reps:
+        assert rep == "rotmat", "statistics of other representations are computed from rotation matrices"
+
+    settings = {'rep': rep, 'create_windows': tuple(create_windows) if create_windows is not None else None,
+                'record_format': record_format, 'poses_dtype': poses_dtype,
+                'lazy_windows': create_windows is not None and lazy_windows,
+                'stats_reps': sorted(stats_reps) if compute_stats else []}
+    manifest = load_manifest(output_path)
+
+    # entries of the files that are already stored and indices of their records
+    files, existing, first_shard = dict(), None, 0
+    if incremental and manifest is not None:
+        assert not write_mmap, "memory-mapped stores can't be updated, convert the updated split with convert_tfrecords"
+        if manifest['settings'] != settings:
+            raise Exception("{} was processed with other settings, it must be processed from scratch.".format(
+                output_path))
+        n_files = len(all_fnames)
+        hashes = {file_id: hash_file(os.path.join(root_dir, f)) for root_dir, f, file_id in all_fnames}
+        files = {file_id: entry for file_id, entry in manifest['files'].items() if hashes.get(file_id) == entry['hash']}
+        removed_files = set(manifest['files']).difference(files)
+        all_fnames = [fname for fname in all_fnames if fname[2] not in files]
+        print("{} files unchanged, {} files to process, {} files to remove".format(
+            len(files), len(all_fnames), len(removed_files)))
+
+        existing = {'sample_index': None, 'sample_index_dyn': None, 'window_index': None}
+        if settings['lazy_windows']:
+            existing['window_index'] = remove_file_windows(output_path, removed_files)
+        else:
+            existing['sample_index'] = remove_file_records(output_path, removed_files)
+        if create_windows is not None:
+            existing['sample_index_dyn'] = remove_file_records(output_path + "_dynamic", removed_files)
+
+        # new files are stored in additional shards
+        first_shard = len((existing['sample_index'] or existing['sample_index_dyn']).shards)
+        n_workers = min(n_workers, len(all_fnames))
+        n_shards = first_shard + max(int(np.ceil(n_shards * len(all_fnames) / max(n_files, 1))), n_workers)
+    elif manifest is not None:
+        # remove the shards of earlier incremental runs, they are not overwritten
+        remove_shards(output_path)
+        if create_windows is not None:
+            remove_shards(output_path + "_dynamic")
+
+    jobs = [(all_fnames[worker_idx::n_workers], output_path, n_shards, compute_stats, rep, create_windows,
+             record_format, write_mmap, stats_reps, poses_dtype, lazy_windows, worker_idx, n_workers, first_shard)
+            for worker_idx in range(n_workers)]
+    results = run_workers(process_files, jobs)
+    files.update(merge_worker_results(results, output_path, create_windows, write_mmap, existing))
+    save_manifest({'settings': settings, 'files': files}, output_path)
 
     # print meta stats
+    meta_stats_per_db = get_meta_stats(files)
     tot_samples = 0
     tot_frames = 0
     for db in meta_stats_per_db.keys():
@@ -248,16 +702,8 @@ def process_split(all_fnames, output_path, n_shards, compute_stats, rep, create_
 
     # finalize and save stats
     if compute_stats:
-        var_all = m2_all / (n_all - 1)
-        var_channel = m2_channel / (n_channel - 1)
-
-        stats = {'mean_all': mean_all, 'mean_channel': mean_channel, 'var_all': var_all,
-                 'var_channel': var_channel, 'min_all': min_all, 'max_all': max_all,
-                 'min_seq_len': min_seq_len, 'max_seq_len': max_seq_len, 'num_samples': tot_samples}
-
-        stats_file = os.path.join(output_path, 'stats.npz')
-        print('saving statistics to {} ...'.format(stats_file))
-        np.savez(stats_file, stats=stats)
+        for stats_file, accumulator in merge_file_stats(files).items():
+            save_stats(accumulator.get_stats(tot_samples), output_path, stats_file)
 
     return meta_stats_per_db
 
@@ -272,10 +718,26 @@ if __name__ == '__main__':
     parser.add_argument("--as_aa", action="store_true", help="Whether to convert data to angle-axis.")
     parser.add_argument("--window_size", type=int, default=180, help="Window size for test and val, in frames.")
     parser.add_argument("--window_stride", type=int, default=120, help="Window stride for test and val, in frames.")
+    parser.add_argument("--record_format", default=C.DATA_RECORD_RAW, choices=[C.DATA_RECORD_RAW, C.DATA_RECORD_LEGACY],
+                        help="Layout of the tfrecords. Legacy records store poses as FloatList.")
+    parser.add_argument("--write_mmap", action="store_true", help="Also store every split as a memory-mapped store.")
+    parser.add_argument("--poses_dtype", default=C.DATA_POSES_FLOAT32,
+                        choices=[C.DATA_POSES_FLOAT32, C.DATA_POSES_FLOAT16, C.DATA_POSES_INT16],
+                        help="Storage precision of the poses. int16 is not valid for angle-axis.")
+    parser.add_argument("--n_workers", type=int, default=1, help="Number of processes per split, at most n_shards.")
+    parser.add_argument("--incremental", action="store_true", help="Only process new and changed files of splits that "
+                                                                   "were processed before.")
+    parser.add_argument("--lazy_windows", action="store_true", help="Store a window index instead of the windows of "
+                                                                    "the validation and test splits.")
+    parser.add_argument("--canonical", action="store_true", help="Only store rotation matrices and the normalization "
+                                                                 "statistics of all representations. The data pipeline "
+                                                                 "converts them on the fly.")
 
     args = parser.parse_args()
 
     assert not (args.as_quat and args.as_aa), 'must choose between quaternion or angle-axis representation'
+    assert not (args.canonical and (args.as_quat or args.as_aa)), 'canonical data is stored as rotation matrices'
+    assert not (args.poses_dtype == C.DATA_POSES_INT16 and args.as_aa), 'int16 can not store angle-axis values'
 
     # Load training, validation and test split.
     def _read_fnames(from_):
@@ -321,19 +783,26 @@ if __name__ == '__main__':
 
     # print("process training data ...")
     rep = "quat" if args.as_quat else "aa" if args.as_aa else "rotmat"
+    stats_reps = ["aa", "quat", "euler"] if args.canonical else []
     tr_stats = process_split(train_fnames_avail, os.path.join(args.output_dir, rep, "training"),
                              args.n_shards, compute_stats=True, rep=rep,
-                             create_windows=None)
+                             create_windows=None, record_format=args.record_format, write_mmap=args.write_mmap,
+                             stats_reps=stats_reps, poses_dtype=args.poses_dtype, n_workers=args.n_workers,
+                             incremental=args.incremental)
 
     print("process validation data ...")
     va_stats = process_split(valid_fnames_avail, os.path.join(args.output_dir, rep, "validation"),
                              args.n_shards, compute_stats=False, rep=rep,
-                             create_windows=(args.window_size, args.window_stride))
+                             create_windows=(args.window_size, args.window_stride), record_format=args.record_format, write_mmap=args.write_mmap,
+                             poses_dtype=args.poses_dtype, lazy_windows=args.lazy_windows, n_workers=args.n_workers,
+                             incremental=args.incremental)
 
     print("process test data ...")
     te_stats = process_split(test_fnames_avail, os.path.join(args.output_dir, rep, "test"),
                              args.n_shards, compute_stats=False, rep=rep,
-                             create_windows=(args.window_size, args.window_stride))
+                             create_windows=(args.window_size, args.window_stride), record_format=args.record_format, write_mmap=args.write_mmap,
+                             poses_dtype=args.poses_dtype, lazy_windows=args.lazy_windows, n_workers=args.n_workers,
+                             incremental=args.incremental)
 
     print("Meta stats for all splits combined")
     total_stats = tr_stats
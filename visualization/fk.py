@@ -16,9 +16,9 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import numpy as np
 import quaternion
-import cv2
 
 from common.conversions import sparse_to_full
+from common.conversions import aa2rotmat
 
 # This comes from Martinez' preprocessing, does not take into account root position.
 H36M_JOINTS_TO_IGNORE = [5, 10, 15, 20, 21, 22, 23, 28, 29, 30, 31]
@@ -38,9 +38,12 @@ SMPL_JOINT_MAPPING = {i: x for i, x in enumerate(SMPL_JOINTS)}
 
 class ForwardKinematics(object):
     """
-    FK Engine.
+    FK Engine. Joints are grouped by their depth in the kinematic tree so that all joints of the same depth are
+    processed with one batched matrix multiplication. Intermediate results are kept in float32 buffers that are
+    allocated once and reused across calls.
     """
-    def __init__(self, offsets, parents, left_mult=False, major_joints=None, norm_idx=None, no_root=True):
+    def __init__(self, offsets, parents, left_mult=False, major_joints=None, norm_idx=None, no_root=True,
+                 chunk_size=4096):
         self.offsets = offsets
         if norm_idx is not None:
             self.offsets = self.offsets / np.linalg.norm(self.offsets[norm_idx])
@@ -49,64 +52,129 @@ class ForwardKinematics(object):
         self.major_joints = major_joints
         self.left_mult = left_mult
         self.no_root = no_root
+        self.chunk_size = chunk_size
         assert self.offsets.shape[0] == self.n_joints
 
-    def fk(self, joint_angles):
+        self.roots, self.depth_levels = self._get_depth_levels(parents)
+        self._offsets_f32 = np.asarray(self.offsets, dtype=np.float32)
+        self._angles_buffer = None
+        self._rotations_buffer = None
+
+    @staticmethod
+    def _get_depth_levels(parents):
+        """
+        Groups the joints by their depth in the kinematic tree.
+        Args:
+            parents: List of parent indices, -1 marks a root.
+
+        Returns:
+            The indices of the root joints and a list of (joint indices, parent indices) tuples, one per depth level
+            starting at depth 1.
+        """
+        depth = [-1] * len(parents)
+
+        def _depth(j):
+            if depth[j] < 0:
+                depth[j] = 0 if parents[j] == -1 else _depth(parents[j]) + 1
+            return depth[j]
+
+        for j in range(len(parents)):
+            _depth(j)
+
+        roots = np.array([j for j in range(len(parents)) if depth[j] == 0], dtype=np.int64)
+        levels = []
+        for d in range(1, max(depth) + 1):
+            joints = np.array([j for j in range(len(parents)) if depth[j] == d], dtype=np.int64)
+            levels.append((joints, np.array([parents[j] for j in joints], dtype=np.int64)))
+        return roots, levels
+
+    def _get_buffers(self, n_frames):
+        """
+        Returns float32 buffers for the local and global rotations of at least `n_frames` frames.
+        """
+        if self._angles_buffer is None or self._angles_buffer.shape[0] < n_frames:
+            self._angles_buffer = np.zeros([n_frames, self.n_joints, 3, 3], dtype=np.float32)
+            self._rotations_buffer = np.zeros([n_frames, self.n_joints, 3, 3], dtype=np.float32)
+        return self._angles_buffer[:n_frames], self._rotations_buffer[:n_frames]
+
+    def _fk_chunk(self, angles, positions):
+        """
+        Forward kinematics for one chunk of frames.
+        Args:
+            angles: np array of local rotations of shape (n, n_joints, 3, 3).
+            positions: np array of shape (n, n_joints, 3) into which the joint positions are written.
+
+        Returns:
+            The global rotations as a float32 array of shape (n, n_joints, 3, 3). This is a view into an internal
+            buffer that is overwritten by the next call.
+        """
+        local_rots, rotations = self._get_buffers(angles.shape[0])
+        local_rots[:] = angles
+        if self.no_root:
+            local_rots[:, 0] = np.eye(3)
+
+        # roots, we don't consider any root translation
+        positions[:, self.roots] = 0.0
+        rotations[:, self.roots] = local_rots[:, self.roots]
+
+        for joints, parents in self.depth_levels:
+            parent_rots = rotations[:, parents]  # (n, n_level_joints, 3, 3)
+            offsets = self._offsets_f32[joints]  # (n_level_joints, 3)
+            if self.left_mult:
+                positions[:, joints] = np.einsum('kj,nkji->nki', offsets, parent_rots) + positions[:, parents]
+                rotations[:, joints] = np.matmul(local_rots[:, joints], parent_rots)
+            else:
+                positions[:, joints] = np.einsum('nkij,kj->nki', parent_rots, offsets) + positions[:, parents]
+                rotations[:, joints] = np.matmul(parent_rots, local_rots[:, joints])
+
+        return rotations
+
+    def fk(self, joint_angles, out=None, return_rotations=False):
         """
         Perform forward kinematics. This requires joint angles to be in rotation matrix format.
         Args:
             joint_angles: np array of shape (N, n_joints*3*3)
+            out: Optional np array of shape (N, n_joints, 3) into which the positions are written.
+            return_rotations: If True, the global rotations computed along the kinematic chain are returned as well.
 
         Returns:
-            The 3D joint positions as a an array of shape (N, n_joints, 3)
+            The 3D joint positions as a an array of shape (N, n_joints, 3). This is `out` if it was given, otherwise
+            a new float32 array. If `return_rotations` is True, also the global rotations as a float32 array of shape
+            (N, n_joints, 3, 3).
         """
         assert joint_angles.shape[-1] == self.n_joints * 9
         angles = np.reshape(joint_angles, [-1, self.n_joints, 3, 3])
         n_frames = angles.shape[0]
-        positions = np.zeros([n_frames, self.n_joints, 3])
-        rotations = np.zeros([n_frames, self.n_joints, 3, 3])  # intermediate storage of global rotation matrices
-        if self.left_mult:
-            offsets = self.offsets[np.newaxis, np.newaxis, ...]  # (1, 1, n_joints, 3)
-        else:
-            offsets = self.offsets[np.newaxis, ..., np.newaxis]  # (1, n_joints, 3, 1)
+        if out is None:
+            out = np.zeros([n_frames, self.n_joints, 3], dtype=np.float32)
+        assert out.shape == (n_frames, self.n_joints, 3)
+        global_rots = np.zeros([n_frames, self.n_joints, 3, 3], dtype=np.float32) if return_rotations else None
 
-        if self.no_root:
-            angles[:, 0] = np.eye(3)
+        # process large inputs in chunks so that the buffers stay small
+        for start in range(0, n_frames, self.chunk_size):
+            end = min(start + self.chunk_size, n_frames)
+            rotations = self._fk_chunk(angles[start:end], out[start:end])
+            if return_rotations:
+                global_rots[start:end] = rotations
 
-        for j in range(self.n_joints):
-            if self.parents[j] == -1:
-                # this is the root, we don't consider any root translation
-                positions[:, j] = 0.0
-                rotations[:, j] = angles[:, j]
-            else:
-                # this is a regular joint
-                if self.left_mult:
-                    positions[:, j] = np.squeeze(np.matmul(offsets[:, :, j], rotations[:, self.parents[j]])) + \
-                                      positions[:, self.parents[j]]
-                    rotations[:, j] = np.matmul(angles[:, j], rotations[:, self.parents[j]])
-                else:
-                    positions[:, j] = np.squeeze(np.matmul(rotations[:, self.parents[j]], offsets[:, j])) + \
-                                      positions[:, self.parents[j]]
-                    rotations[:, j] = np.matmul(rotations[:, self.parents[j]], angles[:, j])
-
-        return positions
+        if return_rotations:
+            return out, global_rots
+        return out
 
     def from_aa(self, joint_angles):
         """
         Get joint positions from angle axis representations in shape (N, n_joints*3).
         """
         angles = np.reshape(joint_angles, [-1, self.n_joints, 3])
-        angles_rot = np.zeros(angles.shape + (3,))
-        for i in range(angles.shape[0]):
-            for j in range(self.n_joints):
-                angles_rot[i, j] = cv2.Rodrigues(angles[i, j])[0]
+        angles_rot = aa2rotmat(angles)
         return self.fk(np.reshape(angles_rot, [-1, self.n_joints * 9]))
 
-    def from_rotmat(self, joint_angles):
+    def from_rotmat(self, joint_angles, return_rotations=False):
         """
-        Get joint positions from rotation matrix representations in shape (N, H36M_NR_JOINTS*3*3).
+        Get joint positions from rotation matrix representations in shape (N, H36M_NR_JOINTS*3*3). If
+        `return_rotations` is True, the global rotations are returned as well, see `fk`.
         """
-        return self.fk(joint_angles)
+        return self.fk(joint_angles, return_rotations=return_rotations)
 
     def from_quat(self, joint_angles):
         """